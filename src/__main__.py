@@ -2,21 +2,163 @@ import argparse
 import logging
 from random import randint
 
+from .utils.constants import (BROADCAST_PORT, DEFAULT_NAMESPACE,
+                              MONITOR_HTTP_PORT, QUEUE_LIMIT,
+                              REQUEST_QUEUE_LIMIT, TRACE_SAMPLE_RATE)
+from .utils.logs import setup_logging
+
 parser = argparse.ArgumentParser(description="No help")
 parser.add_argument("--server", action="store_true", default=False)
 parser.add_argument("--client", action="store_true", default=False)
 parser.add_argument("--monitor", action="store_true", default=False)
 parser.add_argument("--ui", action="store_true", default=False)
+parser.add_argument("--headless", action="store_true", default=False, help="monitor without a display, serves an HTTP api")
+parser.add_argument("--agreement", choices=["om", "king", "signed"], default=None)
+parser.add_argument("--loadgen", action="store_true", default=False)
+parser.add_argument("--data-dir", default=None, help="keep the servers identity and state here across restarts")
+parser.add_argument(
+    "--members-cache",
+    default=None,
+    metavar="FILE",
+    help="where the last seen group is kept for a fast restart, in --data-dir or ~/.admission_handler by default, '' for none",
+)
+parser.add_argument(
+    "--capacity",
+    action="append",
+    default=[],
+    metavar="NAMESPACE=N",
+    help="capacity of a namespace, repeatable, joining servers use the ones of the leader",
+)
+parser.add_argument("--namespace", default=DEFAULT_NAMESPACE, help="venue or area a client counts for")
+parser.add_argument(
+    "--seeds",
+    default=None,
+    metavar="HOST[:PORT],...",
+    help="discover peers by gossip with these servers instead of broadcast, ROM goes unicast too",
+)
+parser.add_argument(
+    "--gossip-port",
+    type=int,
+    default=None,
+    help=f"UDP port for gossip with --seeds, servers default to {BROADCAST_PORT}, others to any",
+)
+parser.add_argument(
+    "--tcp-workers",
+    type=int,
+    default=0,
+    help="processes that accept and decode TCP messages for a server, 0 does it in the server",
+)
+parser.add_argument(
+    "--queue-limit",
+    type=int,
+    default=QUEUE_LIMIT,
+    help="queued items above which a server answers client requests with TRY_AGAIN, 0 for no limit",
+)
+parser.add_argument(
+    "--request-limit",
+    type=int,
+    default=REQUEST_QUEUE_LIMIT,
+    help="requests waiting for a namespace lock above which a server answers with TRY_AGAIN, 0 for no limit",
+)
+parser.add_argument("--metrics-port", type=int, default=None, help="serve Prometheus metrics on localhost")
+parser.add_argument(
+    "--diagnostics",
+    action="store_true",
+    default=False,
+    help="answer --diagnose requests (state, profiles, heap diffs) on the TCP port, off by default",
+)
+parser.add_argument("--trace-file", default=None, help="append spans of sampled requests to this file")
+parser.add_argument("--trace-sample", type=float, default=TRACE_SAMPLE_RATE, help="share of requests a client traces")
+parser.add_argument("--diagnose", default=None, metavar="HOST:PORT", help="query a servers TCP port")
+parser.add_argument(
+    "--command",
+    choices=["state", "profile", "profile_start", "profile_stop", "heap", "heap_stop"],
+    default="state",
+    help="diagnostics command, heap diffs against the previous heap call",
+)
+parser.add_argument("--seconds", type=float, default=10, help="duration of a profile, servers cap it at 60")
+parser.add_argument("--trace-report", default=None, metavar="FILE", help="summarize a trace file per stage")
+parser.add_argument("--log-file", default=None, help="write the log to this file instead of stderr")
+parser.add_argument("--binary-log", default=None, metavar="FILE", help="also write a structured binary log")
+parser.add_argument("--read-log", default=None, metavar="FILE", help="print a binary log")
+parser.add_argument("--no-log-limit", action="store_true", default=False, help="don't rate limit or sample log records")
+
+headless = parser.add_argument_group("headless monitor")
+headless.add_argument("--monitor-port", type=int, default=MONITOR_HTTP_PORT, help="port of the local HTTP api")
+headless.add_argument("--csv", default=None, metavar="FILE", help="export the history on shutdown")
+
+loadgen = parser.add_argument_group("load generator")
+loadgen.add_argument("--clients", type=int, default=10, help="concurrent virtual turnstiles")
+loadgen.add_argument("--duration", type=float, default=30, help="seconds to generate load")
+loadgen.add_argument("--rate", type=float, default=None, help="max requests/s over all clients")
+loadgen.add_argument("--think", type=float, default=0.0, help="mean think time in seconds")
+loadgen.add_argument("--exit-ratio", type=float, default=0.5, help="chance a client inside leaves")
+loadgen.add_argument("--timeout", type=float, default=5.0, help="seconds until a request is retried or counts as error")
+loadgen.add_argument("--retries", type=int, default=0, help="resends of a request with the same idempotency key")
+loadgen.add_argument("--spawn-servers", type=int, default=0, help="start a local cluster first")
+loadgen.add_argument("--warmup", type=float, default=5.0, help="seconds to let spawned servers settle")
 
 args = parser.parse_args()
 
-logging.basicConfig(level=logging.DEBUG, format="%(levelname)s %(name)s - %(message)s")
+if args.no_log_limit:
+    setup_logging(path=args.log_file, binary=args.binary_log, rate_limit=None, sampling=None)
+else:
+    setup_logging(path=args.log_file, binary=args.binary_log)
+
+seeds = None
+if args.seeds:
+    from .utils.broadcast_handler import parse_seeds
+    seeds = parse_seeds(args.seeds)
+# servers listen where the seeds expect them, everyone else anywhere
+gossip_port = args.gossip_port if args.gossip_port is not None else (BROADCAST_PORT if args.server else 0)
+
+if args.trace_file:
+    from .utils.tracing import TRACER
+    TRACER.configure(args.trace_file, args.trace_sample)
 
 if args.server:
     from .server.server import Server
     from .utils.common import RepeatTimer
+    from .utils.constants import AGREEMENT_ENGINE
 
-    server = Server()
+    store = None
+    if args.data_dir:
+        from .utils.persistence import Store
+        store = Store(args.data_dir)
+
+    capacities = {}
+    for option in args.capacity:
+        namespace, _, capacity = option.rpartition("=")
+        if not namespace or not capacity.isdigit():
+            parser.error(f"--capacity expects NAMESPACE=N, got {option}")
+        capacities[namespace] = int(capacity)
+
+    members_cache = None
+    if args.members_cache != "":
+        import os
+
+        from .utils.constants import MEMBERS_CACHE_FILE
+        from .utils.persistence import MembersCache
+        path = args.members_cache
+        if path is None:
+            path = os.path.join(args.data_dir, "members.json") if args.data_dir else MEMBERS_CACHE_FILE
+        members_cache = MembersCache(path)
+
+    from .utils.transport import SocketTransport
+    server = Server(
+        agreement=args.agreement or AGREEMENT_ENGINE,
+        transport=SocketTransport(seeds, gossip_port, args.tcp_workers),
+        store=store,
+        capacities=capacities,
+        members_cache=members_cache,
+        queue_limit=args.queue_limit,
+        request_limit=args.request_limit,
+        diagnostics=args.diagnostics,
+    )
+
+    if args.metrics_port is not None:
+        from .utils.metrics import start_http_server
+        start_http_server(args.metrics_port)
 
     #def send():
     #   server._rom_handler.send({"msg": "test"})
@@ -28,7 +170,7 @@ elif args.client:
 
     #TODO do this better, currently only acceptable for testing
     number = randint(1,100)
-    client = Client(number)
+    client = Client(number, args.namespace, seeds, gossip_port)
 
     if args.ui:
         from .client import interface
@@ -37,8 +179,59 @@ elif args.client:
     else:
         client.run()
 
+elif args.loadgen:
+    import json
+
+    from .client.loadgen import LoadGenerator, spawn_servers, stop_servers
+
+    # per request logging would drown the report and skew the numbers
+    logging.disable(logging.INFO)
+
+    servers = spawn_servers(args.spawn_servers, args.warmup) if args.spawn_servers else []
+    try:
+        generator = LoadGenerator(
+            clients=args.clients,
+            rate=args.rate,
+            think=args.think,
+            exit_ratio=args.exit_ratio,
+            timeout=args.timeout,
+            retries=args.retries,
+        )
+        report = generator.run(args.duration)
+    finally:
+        stop_servers(servers)
+    print(json.dumps(report, indent=2))
+
+elif args.diagnose:
+    import json
+
+    from .utils import diagnostics
+
+    host, port = args.diagnose.rsplit(":", 1)
+    options = {"seconds": args.seconds} if args.command == "profile" else {}
+    print(json.dumps(diagnostics.request((host, int(port)), args.command, **options), indent=2))
+
+elif args.trace_report:
+    import json
+
+    from .utils.tracing import report
+    print(json.dumps(report(args.trace_report), indent=2))
+
+elif args.read_log:
+    from datetime import datetime
+
+    from .utils.logs import read_binary_log
+    for record in read_binary_log(args.read_log):
+        created = datetime.fromtimestamp(record["created"]).isoformat(sep=" ", timespec="milliseconds")
+        suppressed = f" ({record['suppressed']} similar suppressed)" if record["suppressed"] else ""
+        print(f"{created} {record['level']} {record['name']} - {record['message']}{suppressed}")
+
+elif args.monitor and args.headless:
+    from .utils.aggregator import start_headless
+    start_headless(args.monitor_port, args.csv, seeds=seeds, gossip_port=gossip_port)
+
 elif args.monitor:
     from .utils import monitor
-    monitor.start_monitor()
+    monitor.start_monitor(seeds, gossip_port)
 else:
     parser.print_help()
@@ -0,0 +1,80 @@
+import argparse
+import fnmatch
+import json
+import logging
+import platform
+import statistics
+import sys
+
+from .hotpaths import BENCHMARKS, measure
+
+SCHEMA = 1
+
+parser = argparse.ArgumentParser(description="Micro-benchmarks of the protocol hot paths")
+parser.add_argument("--filter", default="*", help="glob on benchmark names, e.g. 'rom.*'")
+parser.add_argument("--repeat", type=int, default=5)
+parser.add_argument("--min-time", type=float, default=0.2, help="seconds per sample")
+parser.add_argument("--output", default=None, help="write the JSON report to this file")
+parser.add_argument("--compare", default=None, help="a previous report to check against")
+parser.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio counted as regression")
+parser.add_argument("--list", action="store_true", default=False)
+
+args = parser.parse_args()
+
+# the handlers log at debug level in their hot paths, formatting those lines
+# would dominate what we are trying to measure
+logging.disable(logging.CRITICAL)
+
+
+def key(result):
+    return result["name"], json.dumps(result["params"], sort_keys=True)
+
+
+cases = [case for case in BENCHMARKS if fnmatch.fnmatch(case[0], args.filter)]
+if args.list:
+    for name, params, _ in cases:
+        print(name, json.dumps(params, sort_keys=True))
+    sys.exit(0)
+
+results = []
+for name, params, setup in cases:
+    number, samples = measure(setup(**params), repeat=args.repeat, min_time=args.min_time)
+    results.append({
+        "name": name,
+        "params": params,
+        "number": number,
+        "repeat": args.repeat,
+        "min_us": min(samples),
+        "median_us": statistics.median(samples),
+        "mean_us": statistics.mean(samples),
+    })
+    print(f"{name:<22} {json.dumps(params, sort_keys=True):<40} {statistics.median(samples):>12.2f} us", file=sys.stderr)
+results.sort(key=key)
+
+report = {
+    "schema": SCHEMA,
+    "python": platform.python_version(),
+    "implementation": platform.python_implementation(),
+    "results": results,
+}
+payload = json.dumps(report, indent=2, sort_keys=True)
+if args.output:
+    with open(args.output, "w") as f:
+        f.write(payload + "\n")
+else:
+    print(payload)
+
+if args.compare:
+    with open(args.compare) as f:
+        baseline = {key(result): result for result in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get(key(result))
+        if before is None:
+            continue
+        ratio = result["median_us"] / before["median_us"]
+        if ratio > args.threshold:
+            regressions.append((key(result), before["median_us"], result["median_us"], ratio))
+    for (name, params), before, after, ratio in regressions:
+        print(f"REGRESSION {name} {params}: {before:.2f} us -> {after:.2f} us ({ratio:.2f}x)", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
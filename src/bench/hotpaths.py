@@ -0,0 +1,263 @@
+import json
+import marshal
+import pickle
+import queue
+import timeit
+from collections import deque
+from types import SimpleNamespace
+
+from src.server.server import Server
+from src.utils.broadcast_handler import BroadcastHandler
+from src.utils.byzantine import ByzantineTree
+from src.utils.common import SocketThread
+from src.utils.constants import MAX_MSG_BUFF_SIZE, Intention, Purpose
+from src.utils.rom_handler import ROMulticastHandler
+from src.utils.tcp_handler import TCPHandler
+
+BENCHMARKS = []
+
+
+def benchmark(name, **params):
+    """
+    Registers a benchmark case. The decorated function gets `params` and
+    returns a zero argument callable, that callable is what gets timed.
+    """
+    def register(setup):
+        BENCHMARKS.append((name, params, setup))
+        return setup
+    return register
+
+
+def measure(fn, repeat=5, min_time=0.2):
+    """
+    Times `fn` like timeit does: pick a loop count that runs at least
+    `min_time` seconds, then take `repeat` samples. Returns microseconds per
+    call for every sample.
+    """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    samples = timer.repeat(repeat=repeat, number=number)
+    return number, [1e6 * sample / number for sample in samples]
+
+
+class _QuietROM(ROMulticastHandler):
+    """ROM handler without sockets, only the protocol state machine remains."""
+    def _open_sockets(self, timeout):
+        pass
+
+    def _multicast(self, mesg: dict):
+        pass
+
+    def _unicast(self, mesg: dict, addr):
+        pass
+
+
+class _Sink:
+    """Swallows emitted signals so a long benchmark doesn't pile them up."""
+    def put(self, item):
+        pass
+
+
+class _QuietBroadcast(BroadcastHandler):
+    """Broadcast handler without sockets, only the duplicate filter remains."""
+    def __init__(self, server_queue):
+        SocketThread.__init__(self, server_queue)
+        self._msg_buffer = deque([], maxlen=MAX_MSG_BUFF_SIZE)
+
+
+# representative messages -----------------------------------------------------
+
+def _uuid(i):
+    return f"00000000-0000-4000-8000-{i:012d}"
+
+
+def _group_view(n):
+    return {_uuid(i): ["10.0.0.1", 10000 + i] for i in range(n)}
+
+
+MESSAGES = {
+    "heartbeat": {
+        "intention": str(Intention.HEARTBEAT),
+        "uuid": _uuid(1),
+        "seq": 1234,
+        "digest": "0123456789abcdef",
+    },
+    "request_action": {
+        "intention": str(Intention.REQUEST_ACTION),
+        "uuid": _uuid(2),
+        "address": "10.0.0.2",
+        "port": 50123,
+        "number": 42,
+        "increase": True,
+    },
+    "rom_update_entries": {
+        "uuid": _uuid(1),
+        "intention": str(Intention.UPDATE_ENTRIES),
+        "entries": 17,
+        "purpose": str(Purpose.REAL_MSG),
+        "id": _uuid(99),
+        "original": _uuid(1),
+        "sender": _uuid(3),
+        "S": 812,
+    },
+    "group_view_10": {
+        "intention": str(Intention.UPDATE_GROUP_VIEW),
+        "group_view": _group_view(10),
+        "leader": _uuid(0),
+    },
+    "om_round_10": {
+        "intention": str(Intention.OM),
+        "id": _uuid(98),
+        "from": _uuid(4),
+        "round": 3,
+        "entries": [[[i, j], 17] for i in range(8) for j in range(8) if i != j],
+    },
+}
+
+
+# benchmarks ------------------------------------------------------------------
+
+for _kind, _mesg in MESSAGES.items():
+    @benchmark("json.encode", message=_kind)
+    def _json_encode(message, _mesg=_mesg):
+        return lambda: json.dumps(_mesg).encode()
+
+    @benchmark("json.decode", message=_kind)
+    def _json_decode(message, _mesg=_mesg):
+        payload = json.dumps(_mesg).encode()
+        return lambda: json.loads(payload.decode())
+
+
+for _kind in ("request_action", "rom_update_entries", "group_view_10", "om_round_10"):
+    for _encoding in ("pickle", "marshal"):
+        @benchmark("tcp.pool_receive", message=_kind, encoding=_encoding)
+        def _tcp_pool_receive(message, encoding):
+            """
+            What the server process pays per message a `PooledTCPHandler`
+            worker decoded: unpickling what the queue carries and, for
+            marshal bytes in place of the dict, loading those too. Compare
+            with json.decode, what the server pays without workers.
+            """
+            mesg = MESSAGES[message]
+            data = marshal.dumps(mesg) if encoding == "marshal" else mesg
+            payload = pickle.dumps((data, ("10.0.0.2", 50123), 160), protocol=pickle.HIGHEST_PROTOCOL)
+            if encoding == "marshal":
+                return lambda: marshal.loads(pickle.loads(payload)[0])
+            return lambda: pickle.loads(payload)
+
+
+@benchmark("tcp.send_listen", message="request_action")
+def _tcp_send_listen(message):
+    """One message over loopback: connect, send, accept, read until closed."""
+    receiver = TCPHandler(queue.SimpleQueue())
+    receiver._socket.listen()
+    sender = TCPHandler(queue.SimpleQueue())
+    mesg = MESSAGES[message]
+    dest = ("127.0.0.1", receiver.port)
+
+    def run():
+        sender.send(mesg, dest)
+        receiver.listen()
+    return run
+
+
+for _gap in (0, 1, 4, 16):
+    @benchmark("rom.handle", messages=64, gap=_gap)
+    def _rom_handle(messages, gap):
+        """
+        Feeds `messages` REAL_MSGs of one sender into a fresh handler. With a
+        gap every block of `gap + 1` messages arrives in reverse, so all but
+        the last of each block wait in the holdback queue.
+        """
+        sender = _uuid(1)
+        template = dict(MESSAGES["rom_update_entries"], sender=sender, original=sender)
+        batch = [dict(template, id=_uuid(1000 + s), S=s) for s in range(1, messages + 1)]
+        order = []
+        for start in range(0, messages, gap + 1):
+            order.extend(reversed(batch[start:start + gap + 1]))
+        view = _group_view(3)
+
+        def run():
+            rom = _QuietROM(_uuid(0), view, queue.SimpleQueue())
+            rom.register_new_member(sender)
+            for mesg in order:
+                rom._handle(dict(mesg), ("10.0.0.1", 9999))
+        return run
+
+
+def _byzantine_paths(n, max_nodes):
+    """Paths of the OM tree of member n-1 in breadth first order."""
+    leader, me = 0, n - 1
+    members = range(1, n - 1)
+    height = (n - 1) // 3 + 1
+    paths = [[leader]]
+    level = [[leader]]
+    for _ in range(1, height):
+        level = [[m] + path for path in level for m in members if m not in path]
+        paths.extend(level)
+        if len(paths) >= max_nodes:
+            break
+    return paths[:max_nodes]
+
+
+for _n in (4, 7, 10, 13, 16, 22, 31):
+    @benchmark("byzantine.push", n=_n, max_nodes=5000)
+    def _byzantine_push(n, max_nodes):
+        """Full tree up to n=13, the first `max_nodes` nodes above."""
+        paths = _byzantine_paths(n, max_nodes)
+
+        def run():
+            tree = ByzantineTree(n)
+            for path in paths:
+                tree.push(path, 1)
+        return run
+
+    @benchmark("byzantine.complete", n=_n, max_nodes=5000)
+    def _byzantine_complete(n, max_nodes):
+        tree = ByzantineTree(n)
+        for i, path in enumerate(_byzantine_paths(n, max_nodes)):
+            tree.push(path, i % 2)
+        return tree.complete
+
+
+def _ring_server(n):
+    server = SimpleNamespace(_group_view=_group_view(n), _uuid=_uuid(n // 2))
+    server._get_ring = lambda: Server._get_ring(server)
+    return server
+
+
+for _n in (3, 10, 100):
+    @benchmark("ring.get_ring", members=_n)
+    def _get_ring(members):
+        server = _ring_server(members)
+        return server._get_ring
+
+    @benchmark("ring.get_neighbor", members=_n)
+    def _get_neighbor(members):
+        server = _ring_server(members)
+        return lambda: Server._get_neighbor(server)
+
+
+for _hit in (False, True):
+    @benchmark("broadcast.dedup", duplicate=_hit)
+    def _broadcast_dedup(duplicate):
+        """
+        A full duplicate buffer and either a fresh message or the newest known
+        one, which is the last the linear scan reaches.
+        """
+        handler = _QuietBroadcast(_Sink())
+        for i in range(MAX_MSG_BUFF_SIZE):
+            handler._msg_buffer.append(_uuid(i))
+        known = {"intention": str(Intention.MONITOR_MESSAGE), "msg_uuid": _uuid(MAX_MSG_BUFF_SIZE - 1)}
+        counter = iter(range(MAX_MSG_BUFF_SIZE, 1 << 62))
+
+        def run():
+            if duplicate:
+                handler._on_datagram(known, ("10.0.0.1", 0))
+            else:
+                handler._on_datagram(
+                    {"intention": str(Intention.MONITOR_MESSAGE), "msg_uuid": _uuid(next(counter))},
+                    ("10.0.0.1", 0),
+                )
+        return run
@@ -1,8 +1,11 @@
 import logging
 import os
 import queue
+import random
 import sys
+import time
 import uuid
+from threading import Timer
 
 from src.utils.broadcast_handler import BroadcastHandler
 from src.utils.signals import (ON_BROADCAST_MESSAGE, ON_ENTRY_REQUEST,
@@ -10,22 +13,42 @@ from src.utils.signals import (ON_BROADCAST_MESSAGE, ON_ENTRY_REQUEST,
 from src.utils.tcp_handler import TCPHandler
 
 from ..utils.common import Invokeable, SocketThread
-from ..utils.constants import LOGGING_LEVEL, MAX_ENTRIES, MAX_TRIES, Intention
+from ..utils.constants import (DEFAULT_NAMESPACE, LOGGING_LEVEL, MAX_ENTRIES,
+                               MAX_TRIES, RETRY_AFTER, RETRY_BACKOFF_MAX,
+                               Intention)
+from ..utils.tracing import TRACER
 from .signals import (ON_ACCESS_RESPONSE, ON_CLIENT_SHUTDOWN, ON_COUNT_CHANGED,
                       ON_REQUEST_ACCESS, ON_SERVER_CHANGED)
 
 
+def backoff(retry_after, attempt, rng=random):
+    """
+    Seconds to wait before sending a request again after its `attempt`th
+    TRY_AGAIN (from 0): at least the `retry_after` of the server and up to
+    twice as long per attempt, at random so clients turned away together
+    don't come back together.
+    """
+    ceiling = max(retry_after, min(RETRY_BACKOFF_MAX, retry_after * 2 ** (attempt + 1)))
+    return rng.uniform(retry_after, ceiling)
+
+
 class KeyboardListener(SocketThread):
     def __init__(self, queue):
         super().__init__(queue)
 
     def run(self):
         while not self.stopped:
-            inpt = input("Please enter dec to decrease or anything else to send an entry request\n")
-            if inpt == "dec":
+            inpt = input(
+                "Please enter dec to decrease or anything else to send an entry request,"
+                " a number (dec 3) asks for a group at once\n"
+            )
+            words = inpt.split()
+            count = int(words[-1]) if words and words[-1].isdigit() else 1
+            if words and words[0] == "dec":
                 self.emit(
                     signal=ON_ENTRY_REQUEST,
-                    inc=False
+                    inc=False,
+                    count=count,
                 )
             elif inpt == "exit":
                 self.emit(
@@ -35,23 +58,32 @@ class KeyboardListener(SocketThread):
             else:
                 self.emit(
                     signal=ON_ENTRY_REQUEST,
+                    count=count,
                 )
 
 
 class Client:
 
-    QUEUE = queue.SimpleQueue()
-    UI_QUEUE = queue.SimpleQueue()
-
-    def __init__(self, number):
-        """Set up handlers, uuid etc."""
+    def __init__(self, number, namespace=DEFAULT_NAMESPACE, seeds=None, gossip_port=0):
+        """
+        Set up handlers, uuid etc. `namespace` is the venue or area this client
+        counts for, with `seeds` servers are found by gossip on `gossip_port`
+        instead of by broadcast.
+        """
+        # per instance so several clients can live in one process (see loadgen)
+        self.QUEUE = queue.SimpleQueue()
+        self.UI_QUEUE = queue.SimpleQueue()
         self._tcp_listener = TCPHandler(self.QUEUE)
-        self._broadcast_handler = BroadcastHandler(self.QUEUE)
+        self._broadcast_handler = BroadcastHandler(self.QUEUE, seeds=seeds, port=gossip_port)
         self._uuid = str(uuid.uuid4())
         # a human readable number for calling and verifying purposes
         self.number = number
+        self.namespace = namespace
         self.entries = None
+        self.capacity = MAX_ENTRIES  # of our namespace, the servers tell us
         self.server = None
+        self._trace = None  # (trace id, start) of the sampled request in flight
+        self._pending = None  # (key, inc, count, attempt) of the request waiting for an answer
         self._logger = logging.getLogger(f"Client No. {self.number}") # with UUID {self._uuid}")
         self._logger.setLevel(LOGGING_LEVEL)
 
@@ -64,6 +96,7 @@ class Client:
             "uuid": f"{self._uuid}",
             "address": self._tcp_listener.address,
             "port": self._tcp_listener.port,
+            "namespace": self.namespace,
         }
         self._broadcast_handler.send(mes)
 
@@ -73,49 +106,85 @@ class Client:
             if data is not None:
                 self._logger.debug(data)
                 if data.get("intention") == str(Intention.ACCEPT_CLIENT):
-                    self._logger.debug(f"Recieved client accept message {data} from {add}")
+                    self._logger.debug("Recieved client accept message %s from %s", data, add)
                     self.server = (data.get("address"),data.get("port"))
                     mes = {
                         "intention": str(Intention.CHOOSE_SERVER),
                         "uuid": self._uuid,
                         "address": self._tcp_listener.address,
-                        "port": self._tcp_listener.port
+                        "port": self._tcp_listener.port,
+                        "namespace": self.namespace,
                     }
                     if self._tcp_listener.send(mes, self.server):
                         self.entries = data["entries"]
+                        self.capacity = data.get("capacity", self.capacity)
                         self.UI_QUEUE.put(Invokeable(ON_SERVER_CHANGED, server=data["uuid"], count=self.entries or 0))
                         break
                     else:
                         self.server = None
-                        self._logger.warn("Failed to notify chosen server, discarding choice!")
-
-    def _on_action_request(self, inc=True):
-
+                        self._logger.warning("Failed to notify chosen server, discarding choice!")
+
+    def _on_action_request(self, inc=True, count=1, key=None, attempt=0):
+        """
+        Asks to let in (or out) a group of `count`, a group gets in as a whole
+        or not at all. `key` identifies the request, sending it again with the
+        same key gets the first answer and is never counted twice. `attempt`
+        counts the TRY_AGAINs it got so far. Returns the key, None if the
+        request could not be sent to any server.
+        """
+        key = key or uuid.uuid4().hex
+        self._pending = (key, inc, count, attempt)
         if inc:
             self.UI_QUEUE.put(Invokeable(ON_REQUEST_ACCESS))
 
         if self.server == None:
-            self._logger.debug(f"Client No. {self.number} asked to request an action, but didn't have a server. Please try again.")
-            msg = "Could not find a server. Please try again."
+            self._logger.debug("Client No. %s asked to request an action, but didn't have a server. Looking for one.", self.number)
             self.find_server()
-        else:
+
+        sent = False
+        if self.server is not None:
             mes = {
                 "intention": str(Intention.REQUEST_ACTION),
                 "uuid": f"{self._uuid}",
                 "address": self._tcp_listener.address,
                 "port": self._tcp_listener.port,
                 "number": self.number,
-                "increase": inc
+                "increase": inc,
+                "namespace": self.namespace,
             }
-            if self._tcp_listener.send(mes, self.server):
-                self._logger.debug("Success! Waiting for response")
-            else:
-                self._logger.warn(f"Client No. {self.number} discarding current server, connection seems to be malfunctioning.")
+            if count != 1:
+                mes["count"] = count
+            mes["key"] = key
+            trace = TRACER.new_trace()
+            if trace is not None:
+                mes["trace"] = trace
+                mes["sent_at"] = time.time()
+            sent = self._tcp_listener.send(mes, self.server)
+            if not sent:
+                self._logger.warning("Client No. %s discarding current server, connection seems to be malfunctioning.", self.number)
                 self.server = None
-
-                msg = "Could not connect to server. Please try again."
-                self.UI_QUEUE.put(Invokeable(ON_ACCESS_RESPONSE, response={"message": msg, "status": False}))
                 self.find_server()
+                # same key, the old server may have decided it before the connection broke
+                sent = self.server is not None and self._tcp_listener.send(mes, self.server)
+            if sent:
+                self._logger.debug("Success! Waiting for response")
+                if trace is not None:
+                    TRACER.span(trace, "client.send", self._service, mes["sent_at"], time.time())
+                    self._trace = (trace, mes["sent_at"]) if inc else None
+
+        if not sent:
+            # nobody will answer, don't wait for it
+            self._pending = None
+            self.server = None
+            msg = "Could not find a server. Please try again."
+            self.UI_QUEUE.put(Invokeable(ON_ACCESS_RESPONSE, response={"message": msg, "status": False}))
+            return None
+        return key
+
+    def _decided(self, data):
+        """Forgets the pending request `data` answers, an answer without a key is for it too."""
+        if self._pending is not None and data.get("key", self._pending[0]) == self._pending[0]:
+            self._pending = None
 
     #TODO potentially discard address in the handler
     def _on_broadcast(self, data=None, addr=None):
@@ -127,27 +196,61 @@ class Client:
             self.server == None
             self.find_server()
         elif data["intention"] == str(Intention.ACCEPT_CLIENT):
-            self._logger.info(f"Received random client accept message: {data}")
+            self._logger.info("Received random client accept message: %s", data)
         elif data["intention"] == str(Intention.ACCEPT_ENTRY):
-            msg = "Entry granted, please enjoy yourself!"
+            self._decided(data)
+            self._finish_trace(data)
+            if data.get("count", 1) > 1:
+                msg = f"Entry granted for {data['count']}, please enjoy yourselves!"
+            else:
+                msg = "Entry granted, please enjoy yourself!"
             self._logger.info(msg)
 
             self.UI_QUEUE.put(Invokeable(ON_ACCESS_RESPONSE, response={"status": True, "message": msg}))
 
+        elif data["intention"] == str(Intention.TRY_AGAIN):
+            if self._pending is None or data.get("key") != self._pending[0]:
+                return
+            key, inc, count, attempt = self._pending
+            delay = backoff(data.get("retry_after", RETRY_AFTER), attempt)
+            self._logger.info("The server is busy, asking again in %.2fs.", delay)
+            timer = Timer(delay, self.QUEUE.put, args=[Invokeable(ON_ENTRY_REQUEST, inc=inc, count=count, key=key, attempt=attempt + 1)])
+            timer.daemon = True
+            timer.start()
+
         elif data["intention"] == str(Intention.UPDATE_ENTRIES):
+            if "key" in data:
+                # the acknowledgement of an exit
+                self._decided(data)
             self.entries = data["entries"]
-            self._logger.info(f"Current Entries: {self.entries} of {MAX_ENTRIES}")
+            self.capacity = data.get("capacity", self.capacity)
+            self._logger.info("Current Entries: %s of %s", self.entries, self.capacity)
 
             self.UI_QUEUE.put(Invokeable(ON_ACCESS_RESPONSE, response={"status": None}))
             self.UI_QUEUE.put(Invokeable(ON_COUNT_CHANGED, count=data["entries"]))
 
         elif data["intention"] == str(Intention.DENY_ENTRY):
-            msg = "Entry denied. Seems like we are full, sorry."
+            self._decided(data)
+            self._finish_trace(data)
+            if data.get("count", 1) > 1:
+                msg = f"Entry denied for all {data['count']}. Seems like there is not enough room, sorry."
+            else:
+                msg = "Entry denied. Seems like we are full, sorry."
             self._logger.info(msg)
             #TODO shut this client down here?
 
             self.UI_QUEUE.put(Invokeable(ON_ACCESS_RESPONSE, response={"message": msg, "status": False}))
 
+    @property
+    def _service(self):
+        return f"client {self.number}"
+
+    def _finish_trace(self, data):
+        if self._trace is not None and data.get("trace") == self._trace[0]:
+            trace, start = self._trace
+            TRACER.span(trace, "client.request", self._service, start, time.time(), decision=data["intention"])
+            self._trace = None
+
     def _shut_down(self):
         self._keyboard_listener.join()
         self._tcp_listener.send({"intention": str(Intention.SHUTDOWN_CLIENT), "uuid": self._uuid},self.server)
@@ -163,10 +266,10 @@ class Client:
         #TODO potentially make less spammy and include in normal routine
 
         while self.server == None:
-            self._logger.debug(f"Client {self.number} trying to find a server.")
+            self._logger.debug("Client %s trying to find a server.", self.number)
             self.find_server()
 
-        self._logger.debug(f"Connected to server {self.server}")
+        self._logger.debug("Connected to server %s", self.server)
         self._tcp_listener.start()
         self._broadcast_handler.start()
         self._keyboard_listener.start()
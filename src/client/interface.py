@@ -8,7 +8,6 @@ from typing import Optional
 from PySide2 import QtCore, QtGui, QtWidgets
 
 from ..utils.common import Invokeable
-from ..utils.constants import MAX_ENTRIES
 from ..utils.signals import ON_ENTRY_REQUEST
 from .signals import (ON_ACCESS_RESPONSE, ON_CLIENT_SHUTDOWN, ON_COUNT_CHANGED,
                       ON_REQUEST_ACCESS, ON_SERVER_CHANGED)
@@ -83,9 +82,16 @@ class ClientUI(QtWidgets.QDialog):
         self._server_lbl = QtWidgets.QLabel("Not connected to a server.")
         main.addWidget(self._server_lbl)
 
-        self._count_lbl = QtWidgets.QLabel(f"Current count: 0/{MAX_ENTRIES}")
+        self._count_lbl = QtWidgets.QLabel(f"Current count: 0/{self._client.capacity}")
         main.addWidget(self._count_lbl)
 
+        party = QtWidgets.QHBoxLayout()
+        party.addWidget(QtWidgets.QLabel("People:"))
+        self._count_spin = QtWidgets.QSpinBox()
+        self._count_spin.setRange(1, max(1, self._client.capacity))
+        party.addWidget(self._count_spin)
+        main.addLayout(party)
+
         self._action_btn = QtWidgets.QPushButton("Request Access")
         main.addWidget(self._action_btn)
 
@@ -119,17 +125,19 @@ class ClientUI(QtWidgets.QDialog):
         self._stack.setCurrentIndex(0)
 
     def _on_leaving_btn_clicked(self):
-        self._client.QUEUE.put(Invokeable(ON_ENTRY_REQUEST, inc=False))
+        self._client.QUEUE.put(Invokeable(ON_ENTRY_REQUEST, inc=False, count=self._count_spin.value()))
 
     def _on_action_btn_clicked(self):
-        self._client.QUEUE.put(Invokeable(ON_ENTRY_REQUEST))
+        # a group is one request, it gets in as a whole or not at all
+        self._client.QUEUE.put(Invokeable(ON_ENTRY_REQUEST, count=self._count_spin.value()))
 
     def _on_count_changed(self, data):
         if data['count'] < self._count:
             self._status_lbl.setText("Someone has left the venue.")
 
         self._count = int(data['count'])
-        self._count_lbl.setText(f"Current count: {data['count']}/{MAX_ENTRIES}.")
+        self._count_lbl.setText(f"Current count: {data['count']}/{self._client.capacity}.")
+        self._count_spin.setMaximum(max(1, self._client.capacity))
 
     def _on_request_access(self, *args):
         self._action_btn.setEnabled(False)
@@ -160,7 +168,7 @@ class ClientUI(QtWidgets.QDialog):
         count = data["count"]
         msg = f"Currently connected to server: :{server}."
         self._server_lbl.setText(msg)
-        self._count_lbl.setText(f"Current count: {count}/{MAX_ENTRIES}.")
+        self._count_lbl.setText(f"Current count: {count}/{self._client.capacity}.")
 
     def _on_client_shutdown(self, *args):
         self.close()
@@ -0,0 +1,262 @@
+import logging
+import random
+import subprocess
+import sys
+import time
+from threading import Lock, Thread
+
+from ..utils.common import percentile
+from ..utils.constants import JOIN_WAIT, LOGGING_LEVEL, RETRY_AFTER, Intention
+from .client import Client, backoff
+
+
+class _Discard:
+    """Stands in for the UI queue, nobody is watching a generated client."""
+    def put(self, item):
+        pass
+
+
+class LoadClient(Client):
+    """
+    A `Client` without keyboard or UI that can wait for the answer to its own
+    request. Uses the same protocol as the interactive client: IDENT_CLIENT to
+    find a server, CHOOSE_SERVER to register and REQUEST_ACTION to ask.
+    """
+    def __init__(self, number):
+        super().__init__(number)
+        self.UI_QUEUE = _Discard()
+        self.try_again = 0  # TRY_AGAINs received, the generator takes them
+
+    def request(self, inc, timeout, count=1, retries=0):
+        """
+        Sends one request for `count` people and blocks until it was decided.
+        Returns "accepted", "denied", "left" (an exit that was counted),
+        "no_server", "send" or "timeout".
+        An exit is answered with an entries update carrying its key, other
+        entries updates only refresh the count.
+        Without an answer after `timeout` seconds the request is sent again
+        with the same key, up to `retries` times. A TRY_AGAIN sends it again
+        after a jittered backoff within the same `timeout`.
+        """
+        if self.server is None:
+            self.find_server()
+            if self.server is None:
+                return "no_server"
+
+        key = None
+        attempt = 0  # TRY_AGAINs so far
+        for _ in range(retries + 1):
+            key = self._on_action_request(inc, count, key, attempt)
+            if self.server is None:
+                return "send"
+
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                data, addr = self._tcp_listener.listen()
+                if data is None:
+                    continue
+                if data["intention"] == str(Intention.TRY_AGAIN):
+                    if data.get("key") == key:
+                        self.try_again += 1
+                        delay = backoff(data.get("retry_after", RETRY_AFTER), attempt)
+                        time.sleep(max(0, min(delay, deadline - time.monotonic())))
+                        attempt += 1
+                        self._on_action_request(inc, count, key, attempt)
+                        if self.server is None:
+                            return "send"
+                    continue
+                if data["intention"] == str(Intention.UPDATE_ENTRIES) and data.get("key") != key:
+                    # a count broadcast or the late answer to an earlier exit
+                    self._on_tcp_msg(data=data, addr=addr)
+                    continue
+                if data.get("key", key) != key:
+                    # the late answer to an earlier request that timed out
+                    continue
+                self._on_tcp_msg(data=data, addr=addr)
+                if inc and data["intention"] == str(Intention.ACCEPT_ENTRY):
+                    return "accepted"
+                elif inc and data["intention"] == str(Intention.DENY_ENTRY):
+                    return "denied"
+                elif not inc and data["intention"] == str(Intention.UPDATE_ENTRIES):
+                    return "left"
+        return "timeout"
+
+    def close(self):
+        self._tcp_listener.close()
+        self._broadcast_handler.listen_socket.close()
+
+
+class VirtualClient(Thread):
+    """One closed loop turnstile: request, wait for the decision, think, repeat."""
+    def __init__(self, number, generator):
+        super().__init__(daemon=True)
+        self._generator = generator
+        self._client = LoadClient(number)
+        self._inside = 0
+        self._random = random.Random(number)
+
+    def run(self):
+        gen = self._generator
+        while not gen.stopped:
+            gen.pace()
+            if gen.stopped:
+                break
+            inc = not (self._inside and self._random.random() < gen.exit_ratio)
+
+            start = time.monotonic()
+            outcome = self._client.request(inc, gen.timeout, retries=gen.retries)
+            gen.record(outcome, time.monotonic() - start, self._client.try_again)
+            self._client.try_again = 0
+
+            if outcome == "accepted":
+                self._inside += 1
+            elif outcome == "left":
+                self._inside -= 1
+            if gen.think > 0:
+                time.sleep(self._random.expovariate(1 / gen.think))
+        self._client.close()
+
+
+class LoadGenerator:
+    """
+    Drives many `VirtualClient`s against a running cluster and collects
+    admission throughput and decision latency.
+
+    Arguments:
+    clients -- number of concurrent turnstiles;
+    rate -- upper bound for requests per second over all clients, None for as fast as possible;
+    think -- mean think time in seconds between the decision and the next request;
+    exit_ratio -- probability that a client holding an entry leaves instead of asking again;
+    timeout -- seconds to wait for a decision before sending the request again or counting an error;
+    retries -- times a request is sent again with the same idempotency key
+    """
+    def __init__(self, clients=10, rate=None, think=0.0, exit_ratio=0.5, timeout=5.0, retries=0):
+        self.clients = clients
+        self.rate = rate
+        self.think = think
+        self.exit_ratio = exit_ratio
+        self.timeout = timeout
+        self.retries = retries
+        self.stopped = False
+
+        self._lock = Lock()
+        self._next_slot = None
+        self._latencies = []  # entry decisions, seconds
+        self._try_again = 0  # requests the servers shed, each one was sent again
+        self._exit_latencies = []
+        self._outcomes = {
+            "accepted": 0,
+            "denied": 0,
+            "left": 0,
+            "no_server": 0,
+            "send": 0,
+            "timeout": 0,
+        }
+        self._logger = logging.getLogger("LoadGenerator")
+        self._logger.setLevel(LOGGING_LEVEL)
+
+    def pace(self):
+        """Waits for the next global arrival slot if a rate is configured."""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self._next_slot is None or self._next_slot < now:
+                self._next_slot = now
+            slot = self._next_slot
+            self._next_slot += 1 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def record(self, outcome, latency, try_again=0):
+        with self._lock:
+            self._outcomes[outcome] += 1
+            self._try_again += try_again
+            if outcome in ("accepted", "denied"):
+                self._latencies.append(latency)
+            elif outcome == "left":
+                self._exit_latencies.append(latency)
+
+    def run(self, duration):
+        """Runs all clients for `duration` seconds and returns the report."""
+        workers = [VirtualClient(i, self) for i in range(self.clients)]
+        self._logger.info("Starting %s clients for %ss", len(workers), duration)
+        start = time.monotonic()
+        for worker in workers:
+            worker.start()
+        time.sleep(duration)
+        self.stopped = True
+        elapsed = time.monotonic() - start
+        for worker in workers:
+            worker.join(self.timeout * (self.retries + 1) + 1)
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        with self._lock:
+            outcomes = dict(self._outcomes)
+            try_again = self._try_again
+            latencies = sorted(self._latencies)
+            exit_latencies = sorted(self._exit_latencies)
+
+        decided = outcomes["accepted"] + outcomes["denied"]
+        errors = {k: outcomes[k] for k in ("no_server", "send", "timeout")}
+        return {
+            "clients": self.clients,
+            "duration": elapsed,
+            "requests": sum(outcomes.values()),
+            "admissions": outcomes["accepted"],
+            "admissions_per_sec": outcomes["accepted"] / elapsed if elapsed else 0,
+            "denials": outcomes["denied"],
+            "denial_rate": outcomes["denied"] / decided if decided else 0,
+            "exits": outcomes["left"],
+            "try_again": try_again,
+            "errors": errors,
+            "error_rate": sum(errors.values()) / max(1, sum(outcomes.values())),
+            "latency_ms": _latency_summary(latencies),
+            "exit_latency_ms": _latency_summary(exit_latencies),
+        }
+
+
+def _latency_summary(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": 1000 * sum(values) / len(values),
+        "p50": 1000 * percentile(values, 50),
+        "p99": 1000 * percentile(values, 99),
+        "p999": 1000 * percentile(values, 99.9),
+        "max": 1000 * values[-1],
+    }
+
+
+def spawn_servers(count, warmup):
+    """
+    Starts a local cluster of `count` servers and gives it `warmup` seconds to
+    settle. The first one founds the group, the others start together once it
+    had the time to, the leader admits their joins in one batch.
+    """
+    def spawn():
+        return subprocess.Popen(
+            [sys.executable, "-m", "src", "--server"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    servers = [spawn()]
+    if count > 1:
+        # a lone server waits this long for a leader before it founds the group
+        time.sleep(JOIN_WAIT)
+        servers += [spawn() for _ in range(count - 1)]
+    time.sleep(warmup)
+    return servers
+
+
+def stop_servers(servers):
+    for server in servers:
+        server.terminate()
+    for server in servers:
+        try:
+            server.wait(5)
+        except subprocess.TimeoutExpired:
+            server.kill()
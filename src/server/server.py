@@ -1,105 +1,195 @@
-import datetime
+import hashlib
 import json
 import logging
 import math
 import os
 import queue
 import sys
-import time
+from collections import OrderedDict, deque
 from copy import deepcopy
-from queue import Queue
-from uuid import uuid4
-
-from src.utils.broadcast_handler import BroadcastHandler
-from src.utils.byzantine import (ByzantineLeaderCache, ByzantineMemberCache,
-                                 ByzantineStates)
-from src.utils.rom_handler import ROMulticastHandler
-from src.utils.tcp_handler import TCPHandler
-
-from ..utils.common import (CircularList, Invokeable, RepeatTimer,
-                            get_hostname, get_real_ip)
-from ..utils.constants import (HEARTBEAT_TIMEOUT, LOGGING_LEVEL, MAX_ENTRIES,
-                               MAX_TIMEOUTS, MAX_TRIES, Intention, LockState,
-                               State)
+
+from src.utils.agreement import ENGINES
+from src.utils.byzantine import ByzantineLeaderCache, ByzantineStates
+from src.utils.transport import SocketTransport
+
+from ..utils.common import CircularList, Invokeable, percentile
+from ..utils.diagnostics import HeapTracker, SamplingProfiler, chunks
+from ..utils.constants import (AGREEMENT_ENGINE, AGREEMENT_PENDING_RUNS,
+                               AGREEMENT_SAFETY_INTERVAL,
+                               DEFAULT_NAMESPACE, DELTA_HISTORY,
+                               DIAGNOSTICS_MAX_LIMIT, DIAGNOSTICS_MAX_SECONDS,
+                               DIGEST_HISTORY,
+                               HEARTBEAT_TIMEOUT, JOIN_BATCH_MAX,
+                               JOIN_WAIT, JOIN_WAIT_FACTOR, JOIN_WAIT_MIN,
+                               JOIN_WINDOW,
+                               LOGGING_LEVEL, MAX_ENTRIES, MAX_TIMEOUTS,
+                               MAX_TRIES, MONITOR_STATS_INTERVAL,
+                               NAMESPACE_CAPACITIES, QUEUE_LIMIT,
+                               REQUEST_QUEUE_LIMIT, STATE_CHUNK_SIZE,
+                               STATE_TRANSFERS, TIMEOUT, Intention,
+                               LockState, State)
+from ..utils.dedup import DecisionCache, chunked, short_key
+from ..utils.metrics import (AGREEMENT, DECISION, DUPLICATES, ELECTION,
+                             HEARTBEAT_RTT, LOCK_HOLD, LOCK_WAIT, QUEUE_DEPTH,
+                             ROM_HOLDBACK, ROM_PENDING, SHED, StatsWindow)
+from ..utils.logs import stop_logging
+from ..utils.namespaces import HashRing, Namespace
+from ..utils.tracing import TRACER, attach
 from ..utils.signals import (ON_BROADCAST_MESSAGE, ON_HEARTBEAT_TIMEOUT,
-                             ON_MULTICAST_MESSAGE, ON_TCP_MESSAGE)
+                             ON_JOIN_WINDOW, ON_MULTICAST_MESSAGE,
+                             ON_STATS_TIMEOUT, ON_TCP_MESSAGE)
 
-logging.basicConfig(format="%(levelname)s:%(message)s", level=logging.DEBUG)
 
-class Server:
+def _milliseconds(seconds):
+    return None if seconds is None else round(1000 * seconds, 3)
+
 
-    QUEUE = queue.SimpleQueue()
+class Server:
 
-    def __init__(self):
-        """Set up handlers, uuid etc."""
+    def __init__(
+        self, agreement=AGREEMENT_ENGINE, transport=None, store=None, capacities=None, members_cache=None,
+        queue_limit=QUEUE_LIMIT, request_limit=REQUEST_QUEUE_LIMIT, diagnostics=False,
+    ):
+        """
+        Set up handlers, uuid etc.
+        With a `store` (see `src.utils.persistence.Store`) the uuid, entries
+        and clients survive restarts. `capacities` ({ namespace: capacity })
+        adds to NAMESPACE_CAPACITIES, a joining server takes the ones of the
+        leader. With a `members_cache` (see `src.utils.persistence.MembersCache`)
+        a restarted server asks the group it last saw directly. Client
+        requests beyond `queue_limit` items in the server queue or
+        `request_limit` requests waiting for the lock of their namespace are
+        answered with TRY_AGAIN, 0 for no limit. Profiles, heap diffs and
+        state dumps are only answered with `diagnostics`, anyone who can reach
+        the TCP port could ask for them.
+        """
+        self._transport = transport or SocketTransport()
+        self.QUEUE = self._transport.queue()
+        self._store = store
+        self._members_cache = members_cache
         self._state = State.PENDING
-        self._uuid = str(uuid4())
+        if store is not None and store.recovered:
+            self._uuid = store.state["uuid"]
+        else:
+            self._uuid = self._transport.uuid()
         self._group_view = dict()
+        # the leader numbers its group views and sends members the changes
+        # since the previous one, a member that missed one asks for all of it
+        self._view_version = 0
+        self._view_source = None  # leader the version counts for
+        self._distributed_view = dict()  # what the members have, as the leader
         self._current_leader = None
         self._participating = False
+        self._election_started = None
         self._heartbeats = {}
         self._heartbeat_timer = None
-
-        self._my_ip = get_real_ip()
-        self._my_hostname = get_hostname()
-
-        self._tcp_handler = TCPHandler(self.QUEUE)
-        self._broadcast_handler = BroadcastHandler(self.QUEUE)
-        self._rom_handler = ROMulticastHandler(str(self._uuid), self._group_view, self.QUEUE)
+        self._heartbeat_rtt = None
+        self._stats = StatsWindow()
+        self._stats_timer = None
+        self._stats_published_at = None
+
+        self._my_ip = self._transport.address()
+        self._my_hostname = self._transport.hostname()
+
+        self._tcp_handler = self._transport.tcp_handler(self.QUEUE)
+        self._broadcast_handler = self._transport.broadcast_handler(self.QUEUE)
+        self._rom_handler = self._transport.rom_handler(
+            str(self._uuid), self._group_view, self.QUEUE, port=self._tcp_handler.port
+        )
+        self._tcp_handler.limit_requests(queue_limit)
+        self._request_limit = request_limit
+        self._diagnostics = diagnostics
+        self._shed_requests = 0  # answered with TRY_AGAIN because a namespace had too many waiting
 
         self._logger = logging.getLogger(f"Server {self._uuid}")
         self._logger.setLevel(LOGGING_LEVEL)
 
         self._clients = dict()
-        self._requests = Queue()
-        self._lock = LockState.OPEN
-        self._entries = 0
+        self._client_namespaces = dict()  # { uuid: namespace } of our clients
+        self._capacities = {**NAMESPACE_CAPACITIES, **(capacities or {})}
+        self._namespaces = dict()  # { name: Namespace }, created on first use
+        # byzantine agreement, digests and the monitor look at the default namespace
+        self._default = self._namespace(DEFAULT_NAMESPACE)
+        self._ring = HashRing()
+        # by idempotency key, a retried request gets the first answer again
+        self._decisions = DecisionCache()
 
         self._byzantine_leader_cache = None
         self._byzantine_member_cache = None
         self._byzantine_history = {}
+        self._byzantine_epochs = {}  # { id: encoded `_namespace_state` at the epoch mark }
+        self._byzantine_pending = OrderedDict()  # { id: [om, ...] } received before the mark
+        self._byzantine_started = None
+        self._last_byzantine = self._transport.now()
+        self._divergent = False
+
+        # ROM messages delivered so far, the same on every server at the same
+        # point of the total order unlike the agreed priorities
+        self._delivered_seq = 0
+        self._digests = OrderedDict()  # { seq: digest } of our recent state
+        # (seq, entries) of the latest UPDATE_ENTRIES, what a rejoining server missed
+        self._entries_history = deque(maxlen=DELTA_HISTORY)
+        self._reset_members = set()  # restarted servers, their ROM numbers start over
+        # { uuid: restarts } of the members, part of the full view so a member
+        # that missed a delta still learns whose ROM numbers started over
+        self._incarnations = {}
+        self._transfers = OrderedDict()  # { transfer: serialized state } offered to joiners
+        self._transfer = None  # the state we are receiving as a joiner
+        self._pending_joins = OrderedDict()  # { uuid: IDENT_SERVER } admitted with the next batch
+        self._join_window = None
+        # a joiner asks by broadcast and every cached member at once, the
+        # copies of an admitted request are dropped by its join id
+        self._admitted_joins = deque(maxlen=4 * JOIN_BATCH_MAX)
+
+        if not ENGINES[agreement].available():
+            self._logger.error("Agreement engine %s is not available, falling back to om.", agreement)
+            agreement = "om"
+        self._agreement = ENGINES[agreement]
+
+        QUEUE_DEPTH.labels(self._uuid).set_function(self.QUEUE.qsize)
+
+        self._profiler = SamplingProfiler()
+        self._heap = HeapTracker()
+
+        if store is not None:
+            self._recover()
 
     # network message handler methods -----------------------------------------
 
     def _on_udp_msg(self, data=None, addr=None):
         if data == None:
-            self._logger.warn("Got called for an empty Broadcast message!")
+            self._logger.warning("Got called for an empty Broadcast message!")
             return
         if data.get("uuid") == self._uuid:
             return
-        if (data["intention"] == str(Intention.IDENT_SERVER)) and (self._state == State.LEADER):
-            if (self._byzantine_leader_cache is not None) or self._participating:
-                wait_for = {
-                    "intention": str(Intention.TRY_AGAIN)
-                }
-                if not self._tcp_handler.send(wait_for, self._group_view[data["uuid"]]):
-                    self._logger.warn("Wasn't able to answer with a wait for message")
-            else:
-                self._register_server(data)
+        if data["intention"] == str(Intention.IDENT_SERVER):
+            self._on_join_request(data)
         elif data["intention"] == str(Intention.IDENT_CLIENT):
             self._register_client(data)
         elif data["intention"] == str(Intention.SHUTDOWN_SERVER):
             add = "(leader)" if data["uuid"] == self._current_leader else ""
             self._logger.debug(
-                f"Received shutdown message from {data['uuid']}{add}, will start an election."
+                "Received shutdown message from %s%s, will start an election.", data['uuid'], add
             )
             self._start_election()
-        elif data["intention"] == str(Intention.MONITOR_MESSAGE):
+        elif data["intention"] in (str(Intention.MONITOR_MESSAGE), str(Intention.MONITOR_STATS)):
             pass
         elif data["intention"] == str(Intention.RUN_BYZ) and (self._state == State.LEADER):
             self._logger.info("Got byzantine request.")
-            if self._can_byzantine():
-                    self._rom_handler.pause()
-                    self._start_byzantine()
+            self._maybe_byzantine(force=True)
         else:
-            self._logger.debug(f"Received broadcast message: {data}")
+            self._logger.debug("Received broadcast message: %s", data)
 
     def _on_tcp_msg(self, data=None, addr=None):
         if data == None:
-            self._logger.warn("Got called for an empty TCP message!")
+            self._logger.warning("Got called for an empty TCP message!")
             return
         if data["intention"] == str(Intention.UPDATE_GROUP_VIEW):
             self._on_received_grp_view(data)
+        elif data["intention"] == str(Intention.IDENT_SERVER):
+            self._on_join_request(data, direct=True)
+        elif data["intention"] == str(Intention.VIEW_SYNC):
+            self._on_view_sync(data)
         elif data["intention"] == str(Intention.ELECTION_MESSAGE):
             self._on_election_message(data)
         elif data["intention"] == str(Intention.SHUTDOWN_SERVER):
@@ -112,21 +202,31 @@ class Server:
             except:
                 pass
             self._logger.debug(
-                f"Received shutdown message from sever {data['uuid']}. Removing from group view."
+                "Received shutdown message from sever %s. Removing from group view.", data['uuid']
             )
             self._distribute_group_view()
         elif data["intention"] == str(Intention.HEARTBEAT):
             self._on_received_heartbeat(data)
         elif data["intention"] == str(Intention.CHOOSE_SERVER):
             self._clients[data["uuid"]] = (data['address'],data['port'])
-            self._logger.info("Was chosen by client with uuid " + data["uuid"])
+            self._client_namespaces[data["uuid"]] = data.get("namespace", DEFAULT_NAMESPACE)
+            self._persist("client", uuid=data["uuid"], address=self._clients[data["uuid"]])
+            self._logger.info("Was chosen by client with uuid %s", data["uuid"])
         elif data["intention"] == str(Intention.SHUTDOWN_CLIENT):
             self._clients.pop(data["uuid"])
-            self._logger.info("Client "+data["uuid"]+" shut down, removed it from client list.")
+            self._client_namespaces.pop(data["uuid"], None)
+            self._persist("client_gone", uuid=data["uuid"])
+            self._logger.info("Client %s shut down, removed it from client list.", data["uuid"])
         elif data["intention"] == str(Intention.REQUEST_ACTION):
             self._on_request_action(data)
+        elif data["intention"] == str(Intention.ACCEPT_SERVER) and self._transfer is None:
+            self._on_accepted(data)
+        elif data["intention"] == str(Intention.STATE_REQUEST):
+            self._on_state_request(data)
+        elif data["intention"] == str(Intention.STATE_CHUNK):
+            self._on_state_chunk(data)
         elif data["intention"] == str(Intention.OM):
-            if "v" not in data:
+            if "result" in data or "error" in data:
                 self._stop_byzantine(data)
             else:
                 self._on_byzantine_om(data)
@@ -134,70 +234,264 @@ class Server:
                 self._start_byzantine(data["id"])
         elif data["intention"] == str(Intention.NOT_LEADER):
             self._request_join(rejoin=True)
+        elif data["intention"] == str(Intention.DIAGNOSTICS):
+            self._on_diagnostics(data)
         elif data["intention"] == str(Intention.MANUAL_VALUE_OVERRIDE):
-            self._entries = data["value"]
-            self._logger.info(f"Manually changed entires to: {data['value']}")
+            self._default.entries = data["value"]
+            self._default.delivered_entries = data["value"]
+            self._persist("entries", entries=data["value"])
+            self._logger.info("Manually changed entires to: %s", data['value'])
+            self._record_digest()
             self._promote_monitoring_data()
         else:
-            self._logger.warning(f"Got message I can not process: {data}")
+            self._logger.warning("Got message I can not process: %s", data)
     def _on_rom_msg(self, data=None):
         if data == None:
-            self._logger.warn("Got called for an empty ROM message!")
+            self._logger.warning("Got called for an empty ROM message!")
             return
+
+        self._delivered_seq += 1
+        if data["intention"] == str(Intention.BYZ_EPOCH):
+            self._on_byzantine_epoch(data)
         elif data["intention"] == str(Intention.OM_RESULT):
-            self._entries = data["result"]
+            self._on_byzantine_result(data)
         elif data["intention"] == str(Intention.LOCK) or data["intention"] == str(Intention.UNLOCK):
-            self._update_lock(data)
-        elif data["intention"] == str(Intention.UPDATE_ENTRIES) and data["uuid"] != self._uuid:
-            self._entries = data["entries"]
-            self._logger.info("Current Entries: " + str(self._entries) + " of " + str(MAX_ENTRIES))
-            self._update_client_entries()
+            self._update_lock(self._namespace(data.get("namespace", DEFAULT_NAMESPACE)), data)
+        elif data["intention"] == str(Intention.DECISIONS):
+            self._add_decisions(data["decisions"])
+        elif data["intention"] == str(Intention.UPDATE_ENTRIES):
+            self._add_decisions(data.get("decisions", {}))
+            namespace = self._namespace(data.get("namespace", DEFAULT_NAMESPACE))
+            # the sender computed the count before the corrections ordered in
+            # between, rebase it so every server ends up with the same value
+            entries = data["entries"] + namespace.corrected - data.get("corrected", namespace.corrected)
+            namespace.delivered_entries = entries
+            self._entries_history.append((self._delivered_seq, namespace.name, entries))
+            self._persist("entries", entries=entries, seq=self._delivered_seq, namespace=namespace.name)
+            if data["uuid"] != self._uuid:
+                namespace.entries = entries
+                self._logger.info("Current Entries of %s: %s of %s", namespace.name, namespace.entries, namespace.capacity)
+                self._update_client_entries(namespace)
         else:
-            self._logger.debug(f"TODO: Do something with rom message: {data}")
+            self._logger.debug("TODO: Do something with rom message: %s", data)
 
+        self._record_digest()
         self._promote_monitoring_data()
 
     # group view methods ------------------------------------------------------
 
-    def _distribute_group_view(self):
+    def _distribute_group_view(self, full=False):
+        """
+        Sends the members what changed since the last distribution as a new
+        version of the group view. `full` sends the whole view instead, e.g.
+        after an election when we don't know which version the members have.
+        """
         self._logger.debug(
-            f"Distributing group view to {len(self._group_view.keys())-1} members."
+            "Distributing group view to %s members.", len(self._group_view.keys())-1
         )
         self._rom_handler.set_group_view(self._group_view)
+        reset, self._reset_members = list(self._reset_members), set()
+        added = {
+            uuid: address for uuid, address in self._group_view.items()
+            if self._distributed_view.get(uuid) != tuple(address)
+        }
+        removed = [uuid for uuid in self._distributed_view if uuid not in self._group_view]
+        self._view_version += 1
+        self._view_source = self._uuid
+        self._distributed_view = {uuid: tuple(address) for uuid, address in self._group_view.items()}
+
+        if full:
+            data = self._full_view()
+        else:
+            data = {
+                "intention": str(Intention.UPDATE_GROUP_VIEW),
+                "leader": self._uuid,
+                "version": self._view_version,
+                "base": self._view_version - 1,
+                "add": added,
+                "remove": removed,
+            }
+        if reset:
+            data.setdefault("incarnations", {}).update({uuid: self._incarnations[uuid] for uuid in reset})
         for uuid, address in self._group_view.items():
             if uuid != self._uuid:
-                data = {"intention": str(Intention.UPDATE_GROUP_VIEW), "group_view": self._group_view}
                 if not self._tcp_handler.send(data, address):
-                    self._logger.warning(f"Could not send group view to: {uuid}.")
+                    self._logger.warning("Could not send group view to: %s.", uuid)
+        self._remember_members()
 
-        self._broadcast_handler.send({"intention": str(Intention.MONITOR_MESSAGE), "group_view": self._group_view})
+        # joined servers show up in the monitor with their own messages
+        self._broadcast_handler.send({
+            "intention": str(Intention.MONITOR_MESSAGE),
+            "view_version": self._view_version,
+            "joined": list(added),
+            "left": removed,
+        })
+
+    def _full_view(self):
+        return {
+            "intention": str(Intention.UPDATE_GROUP_VIEW),
+            "leader": self._uuid,
+            "version": self._view_version,
+            "group_view": self._group_view,
+            "incarnations": self._member_incarnations(),
+        }
+
+    def _member_incarnations(self):
+        return {uuid: n for uuid, n in self._incarnations.items() if uuid in self._group_view}
+
+    def _on_view_sync(self, data):
+        if self._state != State.LEADER:
+            return
+        self._logger.debug("Sending the full group view to %s.", data["uuid"])
+        self._tcp_handler.send(self._full_view(), (data["address"], data["port"]))
+
+    def _request_view_sync(self):
+        leader = self._group_view.get(self._current_leader)
+        if leader is None:
+            return
+        mesg = {
+            "intention": str(Intention.VIEW_SYNC),
+            "uuid": self._uuid,
+            "address": self._my_ip,
+            "port": self._tcp_handler.port,
+        }
+        if not self._tcp_handler.send(mesg, tuple(leader)):
+            self._logger.warning("Could not request the group view from the leader.")
 
     def _on_received_grp_view(self, data):
-        group_view = {}
-        for key, value in data["group_view"].items():
-            group_view[key] = tuple(value)
-        for new_member in set(group_view.keys()) - set(self._group_view.keys()):
+        same_source = data.get("leader") == self._view_source
+        if "group_view" in data:
+            if same_source and data["version"] < self._view_version:
+                # a sync that was overtaken by newer changes
+                return
+            group_view = {key: tuple(value) for key, value in data["group_view"].items()}
+        elif same_source and data["base"] == self._view_version:
+            group_view = dict(self._group_view)
+            for uuid in data["remove"]:
+                group_view.pop(uuid, None)
+            for key, value in data["add"].items():
+                group_view[key] = tuple(value)
+        elif same_source and data["version"] <= self._view_version:
+            return
+        else:
+            self._logger.info(
+                "Missed group view changes (have %s, got %s on top of %s), requesting the full view.",
+                self._view_version, data["version"], data["base"],
+            )
+            self._request_view_sync()
+            return
+
+        restarted = {
+            uuid for uuid, n in data.get("incarnations", {}).items()
+            if uuid != self._uuid and n != self._incarnations.get(uuid, 0)
+        }
+        self._incarnations.update(data.get("incarnations", {}))
+        for new_member in (set(group_view.keys()) - set(self._group_view.keys())) | restarted:
             self._rom_handler.register_new_member(new_member)
         self._group_view = group_view
+        self._view_version = data["version"]
+        self._view_source = data.get("leader")
         self._rom_handler.set_group_view(self._group_view)
+        self._remember_members()
         self._logger.debug(
-            f"Received updated group view with {len(list(self._group_view.keys()))} items."
+            "Received group view version %s with %s items.", self._view_version, len(self._group_view)
         )
 
     def _on_accepted(self, data):
         self._logger.info("Found a group leader.")
         self._state = State.MEMBER
-        self._entries = data["entries"]
+        self._capacities = data.get("capacities", self._capacities)
+        for namespace in self._namespaces.values():
+            namespace.capacity = self._capacities.get(namespace.name, MAX_ENTRIES)
+        self._default.entries = data["entries"]
+        self._default.delivered_entries = data["entries"]
+        self._default.corrected = data.get("corrected", 0)
+        for name, entries in data.get("namespaces", {}).items():
+            namespace = self._namespace(name)
+            namespace.entries = namespace.delivered_entries = entries
+        self._delivered_seq = data.get("seq", 0)
         self._current_leader = data.get("leader")
         self._group_view = data.get("group_view")
+        self._view_version = data.get("view_version", 0)
+        self._incarnations = dict(data.get("incarnations", {}))
+        self._view_source = self._current_leader
         self._logger.debug(
-            f"I have been accepted by leader {self._current_leader}. Group view has been populated."
+            "I have been accepted by leader %s. Group view has been populated.", self._current_leader
         )
         self._set_leader(False)
-        self._rom_handler.sync_state(
-            json.loads(data.get("rnumbers")),
-            json.loads(data.get("deliver_queue")),
+        # ROM traffic is held back until we know where the snapshot ends
+        self._rom_handler.begin_transfer()
+        self._transfer = {
+            "id": data["transfer"],
+            "size": data["size"],
+            "offset": 0,
+            "parts": [],
+            "failures": 0,
+            "welcome": data,
+        }
+        self._request_state_chunk()
+
+    # state transfer ----------------------------------------------------------
+
+    def _on_state_request(self, data):
+        payload = self._transfers.get(data["transfer"])
+        mesg = {"intention": str(Intention.STATE_CHUNK), "transfer": data["transfer"]}
+        if payload is None:
+            mesg["error"] = "unknown transfer"
+        else:
+            mesg["offset"] = data["offset"]
+            mesg["data"] = payload[data["offset"]:data["offset"] + STATE_CHUNK_SIZE]
+        self._tcp_handler.send(mesg, (data["address"], data["port"]))
+
+    def _request_state_chunk(self):
+        """Asks the leader for the next chunk, also resumes a stream that stalled."""
+        transfer = self._transfer
+        mesg = {
+            "intention": str(Intention.STATE_REQUEST),
+            "transfer": transfer["id"],
+            "offset": transfer["offset"],
+            "address": self._my_ip,
+            "port": self._tcp_handler.port,
+        }
+        leader = self._group_view.get(self._current_leader)
+        if leader is not None and self._tcp_handler.send(mesg, tuple(leader)):
+            return
+        transfer["failures"] += 1
+        if transfer["failures"] >= MAX_TRIES:
+            self._abort_transfer("leader is unreachable")
+
+    def _on_state_chunk(self, data):
+        transfer = self._transfer
+        if transfer is None or data["transfer"] != transfer["id"]:
+            return
+        if "error" in data:
+            self._abort_transfer(data["error"])
+            return
+        if data["offset"] != transfer["offset"]:
+            # answer to a request we repeated
+            return
+        transfer["parts"].append(data["data"])
+        transfer["offset"] += len(data["data"])
+        transfer["failures"] = 0
+        if transfer["offset"] < transfer["size"]:
+            self._request_state_chunk()
+            return
+
+        self._transfer = None
+        state = json.loads("".join(transfer["parts"]))
+        self._rom_handler.finish_transfer(state["rnumbers"], state["deliver_queue"], state.get("agreed"))
+        self._add_decisions(dict(state.get("decisions", [])))
+        self._logger.info(
+            "Received state at sequence %s in %s chunks.", transfer["welcome"].get("seq"), len(transfer["parts"])
         )
+        if self._store is not None:
+            self._persist_welcome(transfer["welcome"], state.get("delta"))
+
+    def _abort_transfer(self, reason):
+        self._logger.warning("State transfer failed (%s), joining again.", reason)
+        self._transfer = None
+        self._rom_handler.cancel_transfer()
+        self._request_join(rejoin=True)
 
     def _request_join(self, rejoin=False):
         self._tcp_handler._paused = True
@@ -205,32 +499,60 @@ class Server:
             "intention": str(Intention.IDENT_SERVER),
             "uuid": f"{self._uuid}",
             "address": self._my_ip,
-            "port": self._tcp_handler.port
+            "port": self._tcp_handler.port,
+            "join": self._transport.uuid(),
         }
+        if self._store is not None and self._store.recovered:
+            mes["resume_seq"] = self._delivered_seq
 
-        self._broadcast_handler.send(mes)
+        cache = self._members_cache.read() if self._members_cache is not None else None
+        probed = self._probe_members(mes, cache)
+        if not probed or rejoin:
+            self._broadcast_handler.send(mes)
         self._logger.info("Looking for a server group.")
+        started = self._transport.now()
 
         if not rejoin:
             tries = 0
-            while tries < MAX_ENTRIES:
-                data, _ = self._tcp_handler.listen()
+            wait = self._join_wait(cache)
+            while tries < wait:
+                data, addr = self._tcp_handler.listen()
                 if data is not None:
                     if data.get("intention") == str(Intention.ACCEPT_SERVER):
                         self._on_accepted(data)
+                    elif data.get("intention") == str(Intention.STATE_CHUNK):
+                        self._on_state_chunk(data)
+                    elif data.get("intention") == str(Intention.TRY_AGAIN):
+                        # the leader is busy, e.g. electing, ask it again a little later
+                        self._transport.sleep(TIMEOUT)
+                        if "address" in data:
+                            self._tcp_handler.send(mes, (data["address"], data["port"]))
+                        else:
+                            self._broadcast_handler.send(mes)
+                    else:
+                        # e.g. the group view that follows our welcome
+                        self.QUEUE.put(Invokeable(ON_TCP_MESSAGE, data=data, addr=addr))
+                    if self._state != State.PENDING and self._transfer is None:
                         break
-
-                    if data.get("intention") == str(Intention.TRY_AGAIN):
-                        self._broadcast_handler.send(mes)
                 else:
                     tries += 1
+                    if tries == 1 and probed and self._state == State.PENDING:
+                        # none of the cached members answered, the group may have moved
+                        self._broadcast_handler.send(mes)
+                    if self._transfer is not None:
+                        self._request_state_chunk()
 
             self._tcp_handler._paused = False
+            if self._state != State.PENDING:
+                join_seconds = self._transport.now() - started
+                self._logger.info("Joined the group in %.1f ms.", 1000 * join_seconds)
+                self._remember_members(join_seconds)
             if self._state == State.PENDING:
                 self._logger.info(
                     "Could not find a leader. Declaring myself."
                 )
                 self._set_leader(True)
+                self._current_leader = self._uuid
                 self._group_view[self._uuid] = (
                     self._my_ip,
                     self._tcp_handler.port,
@@ -241,43 +563,175 @@ class Server:
 
         self._promote_monitoring_data()
 
+    def _probe_members(self, mes, cache):
+        """
+        Sends `mes` to the cached leader and members at once, a member that
+        isn't the leader forwards it. Returns whether there was anyone to ask.
+        """
+        if not cache:
+            return False
+        addresses = [cache["leader"]] if cache.get("leader") else []
+        addresses += [address for address in cache.get("members", ()) if address != cache.get("leader")]
+        own = (self._my_ip, self._tcp_handler.port)
+        addresses = [tuple(address) for address in addresses if tuple(address) != own]
+        for address in addresses:
+            # connecting to a member that is gone can block for a while
+            self._transport.call_later(0, self._tcp_handler.send, args=[mes, address])
+        return bool(addresses)
+
+    def _join_wait(self, cache):
+        """
+        Listens of TIMEOUT without an answer before we found our own group.
+        Without a cached join time we don't know how long a leader takes to
+        answer and wait JOIN_WAIT.
+        """
+        seconds = JOIN_WAIT
+        if cache and cache.get("join_seconds") is not None:
+            seconds = min(seconds, max(JOIN_WAIT_MIN, JOIN_WAIT_FACTOR * cache["join_seconds"]))
+        return math.ceil(seconds / TIMEOUT)
+
+    def _remember_members(self, join_seconds=None):
+        """Updates the members cache, a group of just us tells a restart nothing."""
+        if self._members_cache is None:
+            return
+        members = [address for uuid, address in self._group_view.items() if uuid != self._uuid]
+        if not members:
+            return
+        leader = self._group_view.get(self._current_leader) if self._current_leader != self._uuid else None
+        self._members_cache.write(leader, members, join_seconds)
+
+    def _on_join_request(self, data, direct=False):
+        if data.get("join") in self._admitted_joins:
+            # another copy of a request we admitted
+            return
+        if self._state == State.LEADER:
+            if (self._byzantine_leader_cache is not None) or self._participating:
+                self._send_try_again(data)
+            else:
+                self._queue_join(data)
+        elif direct and not data.get("forwarded") and self._state == State.MEMBER:
+            # a joiner with an outdated cache, only the leader admits
+            leader = self._group_view.get(self._current_leader)
+            if leader is not None:
+                self._tcp_handler.send({**data, "forwarded": True}, tuple(leader))
+
+    def _send_try_again(self, data):
+        wait_for = {
+            "intention": str(Intention.TRY_AGAIN),
+            # the joiner asks us again directly, as a member we forward it
+            "address": self._my_ip,
+            "port": self._tcp_handler.port,
+        }
+        if not self._tcp_handler.send(wait_for, (data["address"], data["port"])):
+            self._logger.warning("Wasn't able to answer with a wait for message")
+
+    def _queue_join(self, data):
+        """
+        Joins are admitted in batches: requests arriving within JOIN_WINDOW
+        share one group view update, election check and agreement run. The
+        first request after a quiet window is admitted right away, so a lone
+        joiner doesn't wait for a batch that never comes.
+        """
+        # a joiner that was told to try again asks a second time
+        self._pending_joins[data["uuid"]] = data
+        if self._join_window is None:
+            self._admit_joins()
+            self._open_join_window()
+        elif len(self._pending_joins) >= JOIN_BATCH_MAX:
+            self._admit_joins()
+
+    def _open_join_window(self):
+        self._join_window = self._transport.call_later(
+            JOIN_WINDOW, self.QUEUE.put, args=[Invokeable(ON_JOIN_WINDOW)]
+        )
+
+    def _on_join_window(self):
+        self._join_window = None
+        if self._pending_joins:
+            self._admit_joins()
+            # more are probably on their way, keep batching
+            self._open_join_window()
+
+    def _admit_joins(self):
+        if self._join_window is not None:
+            self._join_window.cancel()
+            self._join_window = None
+        joins, self._pending_joins = list(self._pending_joins.values()), OrderedDict()
+        if not joins:
+            return
+        if self._state != State.LEADER or (self._byzantine_leader_cache is not None) or self._participating:
+            # things changed during the window, the joiners ask again
+            for data in joins:
+                self._send_try_again(data)
+            return
+
+        for data in joins:
+            self._register_server(data, batch=True)
+        if len(joins) > 1:
+            self._logger.info("Admitted %s servers at once.", len(joins))
+        self._group_view_changed()
+
     def _register_server(self, data, batch=False):
+        if data.get("join") is not None:
+            self._admitted_joins.append(data["join"])
+        if data["uuid"] in self._group_view or "resume_seq" in data:
+            # a restarted server sends from sequence number 0 again
+            self._reset_members.add(data["uuid"])
+            self._incarnations[data["uuid"]] = self._incarnations.get(data["uuid"], 0) + 1
         self._group_view[data["uuid"]] = (data["address"], data["port"])
 
+        # ROM state as of now, the joiner replays what it receives past it
+        state = {
+            "rnumbers": self._rom_handler._rnumbers,
+            "deliver_queue": self._rom_handler._deliver_queue,
+            "agreed": self._rom_handler.agreed(),
+            "decisions": self._decisions.items(),
+        }
+        if "resume_seq" in data:
+            state["delta"] = self._entries_delta(data["resume_seq"])
+        transfer = self._transport.uuid()
+        self._transfers[transfer] = json.dumps(state)
+        while len(self._transfers) > STATE_TRANSFERS:
+            self._transfers.popitem(last=False)
+
         welcome_msg = {
             "intention": str(Intention.ACCEPT_SERVER),
             "leader": f"{self._uuid}",
             "group_view": self._group_view,
-            "rnumbers": json.dumps(self._rom_handler._rnumbers),
-            "deliver_queue": json.dumps(self._rom_handler._deliver_queue),
-            "entries": self._entries,
+            "entries": self._default.entries,
+            "corrected": self._default.corrected,
+            "namespaces": self._namespace_entries(),
+            "capacities": self._capacities,
+            "seq": self._delivered_seq,
+            "view_version": self._view_version,
+            "incarnations": self._member_incarnations(),
+            "transfer": transfer,
+            "size": len(self._transfers[transfer]),
         }
 
         self._rom_handler.register_new_member(data["uuid"])
         if not self._tcp_handler.send(welcome_msg, self._group_view[data["uuid"]]):
             #TODO handle this case?
-            self._logger.warn("Added a server to my groupview but was unable to send it a welcome message!")
-        self._logger.info(
-            "Received server join request from {}".format(
-                (data["address"], data["port"])
-            )
-        )
+            self._logger.warning("Added a server to my groupview but was unable to send it a welcome message!")
+        self._logger.info("Received server join request from %s", (data["address"], data["port"]))
 
-        self._heartbeats[data["uuid"]] = {"ts": datetime.datetime.now().timestamp(), "strikes": 0}
+        self._heartbeats[data["uuid"]] = {"ts": self._transport.now(), "strikes": 0}
 
         if not batch:
-            self._logger.debug("New group view is: {}".format(self._group_view))
-            self._distribute_group_view()
+            self._group_view_changed()
 
-            self._logger.debug("Checking election required.")
-            if self._election_required():
-                self._logger.info("Election is required, starting election.")
-                self._start_election()
-            else:
-                self._logger.debug("No election required.")
-                if self._can_byzantine():
-                    self._rom_handler.pause()
-                    self._start_byzantine()
+    def _group_view_changed(self):
+        """Leader side follow up of new members, once per join or batch of joins."""
+        self._logger.debug("New group view is: %s", self._group_view)
+        self._distribute_group_view()
+
+        self._logger.debug("Checking election required.")
+        if self._election_required():
+            self._logger.info("Election is required, starting election.")
+            self._start_election()
+        else:
+            self._logger.debug("No election required.")
+            self._maybe_byzantine()
 
     # election methods --------------------------------------------------------
 
@@ -287,8 +741,10 @@ class Server:
             "mid": self._uuid,
             "is_leader": False,
         }
-        self._logger.info(f"Starting election.")
+        self._logger.info("Starting election.")
         self._participating = True
+        if self._election_started is None:
+            self._election_started = self._transport.now()
         self._promote_monitoring_data()
         self._send_election_message(election_msg)
 
@@ -308,7 +764,7 @@ class Server:
     def _send_election_message(self, message):
 
         neighbor = self._get_neighbor()
-        self._logger.info(f"Sending election message to {neighbor}.")
+        self._logger.info("Sending election message to %s.", neighbor)
         if neighbor == self._uuid:
             self._logger.warning(
                 "Could not find any available neighbors. Calling my own method."
@@ -323,31 +779,34 @@ class Server:
                 if success:
                     break
                 self._logger.warning("Retrying..")
-                time.sleep(0.5)
+                self._transport.sleep(0.5)
                 tries += 1
 
             if not success:
-                self._logger.warning(f"Could not send election message to {neighbor}. Will start a new election.")
+                self._logger.warning("Could not send election message to %s. Passing it on to the next neighbor.", neighbor)
 
                 self._group_view.pop(neighbor)
 
-                self._start_election()
+                # starting a new election here would lose the message we hold,
+                # participants swallow smaller ids so the election would stall
+                self._send_election_message(message)
 
     def _on_election_message(self, data):
-        self._logger.debug(f"Received an Election Message from {data['mid']}")
+        self._logger.debug("Received an Election Message from %s", data['mid'])
         neighbor = self._get_neighbor()
 
         if data["is_leader"]:
-            self._logger.debug(f"Message is a leader message.")
-            self._logger.info(f"Setting {data['mid']} to leader.")
+            self._logger.debug("Message is a leader message.")
+            self._logger.info("Setting %s to leader.", data['mid'])
 
             if self._participating:
                 self._current_leader = data["mid"]
                 self._participating = False
+                self._election_finished()
                 if self._state == State.LEADER:
                     self._set_leader(False)
                 self._state = State.MEMBER
-                self._logger.debug(f"Relaying leader message to {neighbor}.")
+                self._logger.debug("Relaying leader message to %s.", neighbor)
                 self._send_election_message(data)
             else:
                 if self._uuid != data["mid"]:
@@ -355,6 +814,7 @@ class Server:
                     self._start_election()
                 else:
                     self._set_leader(True)
+                    self._election_finished()
 
                     self._logger.debug(
                         "Received my own leader message, will terminate the election."
@@ -369,10 +829,8 @@ class Server:
 
                     self._group_view = group_view
 
-                    self._distribute_group_view()
-                    if self._can_byzantine():
-                        self._rom_handler.pause()
-                        self._start_byzantine()
+                    self._distribute_group_view(full=True)
+                    self._maybe_byzantine()
             self._promote_monitoring_data()
 
             return
@@ -383,20 +841,22 @@ class Server:
             data["is_leader"] = False
 
             self._participating = True
-            self._logger.debug(f"Sending election message on to {neighbor}.")
+            if self._election_started is None:
+                self._election_started = self._transport.now()
+            self._logger.debug("Sending election message on to %s.", neighbor)
             self._send_election_message(data)
 
         elif data["mid"] > self._uuid:
             self._logger.debug(
-                f"UUID is smaller than previous neighbor, relaying message to {neighbor}."
+                "UUID is smaller than previous neighbor, relaying message to %s.", neighbor
             )
             self._participating = True
             self._send_election_message(data)
 
         elif data["mid"] == self._uuid:
-            self._logger.debug(f"Received my own election message.")
+            self._logger.debug("Received my own election message.")
             self._logger.info("Declaring myself leader.")
-            self._logger.debug(f"Sending leader message to {neighbor}")
+            self._logger.debug("Sending leader message to %s", neighbor)
             self._current_leader = self._uuid
             data["mid"] = self._uuid
             data["is_leader"] = True
@@ -406,8 +866,61 @@ class Server:
         else:
             self._logger.warning("Looks like a new election. Todo: handle this")
 
+    def _election_finished(self):
+        if self._election_started is not None:
+            ELECTION.observe(self._transport.now() - self._election_started)
+            self._election_started = None
+
     # byzantine ---------------------------------------------------------------
 
+    def _namespace_state(self):
+        """
+        Delivered entries of every namespace, what the digests compare and the
+        agreement runs on. Namespaces are created on first use, so one at 0 is
+        left out, it is the same state as one a server never saw.
+        """
+        return {
+            name: namespace.delivered_entries
+            for name, namespace in self._namespaces.items() if namespace.delivered_entries
+        }
+
+    @staticmethod
+    def _encode_state(state):
+        # the engines need a hashable value that is the same on every server
+        return json.dumps(sorted(state.items()))
+
+    def _digest(self):
+        state = f"{self._delivered_seq}:{self._encode_state(self._namespace_state())}"
+        return hashlib.sha1(state.encode()).hexdigest()[:16]
+
+    def _record_digest(self):
+        self._digests[self._delivered_seq] = self._digest()
+        self._digests.move_to_end(self._delivered_seq)
+        while len(self._digests) > DIGEST_HISTORY:
+            self._digests.popitem(last=False)
+
+    def _compare_digest(self, data):
+        """Compares a members digest with ours at the same ROM sequence."""
+        if "digest" not in data:
+            return
+        own = self._digests.get(data["seq"])
+        if own is not None and own != data["digest"]:
+            self._logger.warning("State of %s diverged at sequence %s.", data['uuid'], data['seq'])
+            self._divergent = True
+
+    def _maybe_byzantine(self, force=False):
+        """
+        Only run the agreement if a digest mismatch was seen or the safety
+        interval has passed since the last run.
+        """
+        if not self._can_byzantine() or self._byzantine_leader_cache is not None:
+            return
+        now = self._transport.now()
+        if force or self._divergent or now - self._last_byzantine >= AGREEMENT_SAFETY_INTERVAL:
+            self._divergent = False
+            self._last_byzantine = now
+            self._start_byzantine()
+
     def _can_byzantine(self):
         n = len(self._group_view)
         f = math.floor((n - 1) / 3)
@@ -419,35 +932,65 @@ class Server:
                 return
 
             self._byzantine_history[id] = ByzantineStates.ABORTED
+            self._byzantine_epochs.pop(id, None)
 
-        id = str(uuid4())
+        id = self._transport.uuid()
         self._byzantine_leader_cache = ByzantineLeaderCache(id)
         self._byzantine_history[self._byzantine_leader_cache.id] = ByzantineStates.STARTED
         self._promote_monitoring_data()
 
-        v = self._entries
+        if not self._can_byzantine():
+            self._byzantine_leader_cache = None
+            return
+
+        self._byzantine_started = self._transport.now()
+        # Mark the epoch in the total order instead of pausing the ROM, every
+        # server snapshots its value once it delivers the mark
+        self._logger.info("Marking byzantine epoch")
+        self._rom_handler.send({"uuid": self._uuid, "intention": str(Intention.BYZ_EPOCH), "epoch": id})
+
+    def _on_byzantine_epoch(self, data):
+        id = data["epoch"]
+        # runs never overlap, so older snapshots are of no use anymore
+        self._byzantine_epochs = {id: self._encode_state(self._namespace_state())}
+        if data["uuid"] == self._uuid:
+            if self._byzantine_leader_cache is not None and self._byzantine_leader_cache.id == id:
+                self._run_byzantine(id)
+        else:
+            for om in self._byzantine_pending.pop(id, []):
+                self._on_byzantine_om(om)
+        # messages of runs that ended or were replaced never get their mark
+        for stale in [run for run in self._byzantine_pending if run in self._byzantine_history]:
+            del self._byzantine_pending[stale]
+
+    def _run_byzantine(self, id):
+        v = self._byzantine_epochs[id]
         n = len(self._group_view)
         f = math.floor((n - 1) / 3)
-        if f == 0:
-            return
 
-        self._logger.info("Starting byzantine algorithm")
-        dests = list(set(self._group_view.keys()) - set([self._uuid]))
+        self._logger.info("Starting byzantine algorithm (%s)", self._agreement.name)
+        members = sorted(self._group_view.keys())
         om = {
             "intention": str(Intention.OM),
-            "v": v,
-            "dests": dests,
-            "list": [self._uuid],
-            "faulty": f,
-            "id": self._byzantine_leader_cache.id,
+            "id": id,
+            "engine": self._agreement.name,
+            "from": self._uuid,
+            **self._agreement.initial(id, self._uuid, members, v, f),
         }
-        for uuid in dests:
-            if not self._tcp_handler.send(om, self._group_view[uuid]):
-                self._logger.warning(f"Could not send om to: {uuid}.")
+        for uuid in members:
+            if uuid != self._uuid and not self._tcp_handler.send(om, self._group_view[uuid]):
+                self._logger.warning("Could not send om to: %s.", uuid)
 
     def _stop_byzantine(self, om):
-        if self._byzantine_leader_cache == None:
-            self._logger.error(f"We shouldn't get byzantine messages. Byzantine isn't running: {om}")
+        if self._byzantine_leader_cache == None or self._byzantine_leader_cache.id != om["id"]:
+            self._logger.error("We shouldn't get byzantine messages. Byzantine isn't running: %s", om)
+            return
+
+        if "error" in om:
+            self._logger.error("%s cannot take part in the agreement: %s. Aborting it.", om["from"], om["error"])
+            self._byzantine_leader_cache = None
+            self._byzantine_history[om["id"]] = ByzantineStates.ABORTED
+            self._promote_monitoring_data()
             return
 
         self._byzantine_leader_cache.results.append(om["from"])
@@ -455,78 +998,138 @@ class Server:
         leader_less_group = set(self._group_view.keys()) - set([self._uuid])
         missing = leader_less_group - set(self._byzantine_leader_cache.results)
         if len(missing) == 0:
-            self._logger.info(f"Stopping byzantine algorithm")
+            self._logger.info("Stopping byzantine algorithm")
             mc = self._byzantine_leader_cache.counter.most_common()
-            self._logger.info("Resuming ROM")
             self._byzantine_leader_cache = None
+            AGREEMENT.labels(self._agreement.name).observe(self._transport.now() - self._byzantine_started)
             self._byzantine_history[om["id"]] = ByzantineStates.FINISHED
-            self._entries = mc[0][0]
-            self._rom_handler.resume(value=mc[0][0])
+            # The result belongs to the marked epoch, every server applies it as
+            # a correction relative to its own snapshot of that epoch
+            self._rom_handler.send({
+                "uuid": self._uuid,
+                "intention": str(Intention.OM_RESULT),
+                "epoch": om["id"],
+                "result": mc[0][0],
+            })
             self._promote_monitoring_data()
 
+    def _on_byzantine_result(self, data):
+        if "epoch" not in data:
+            self._default.entries = data["result"]
+            self._default.delivered_entries = data["result"]
+            return
+
+        snapshot = self._byzantine_epochs.pop(data["epoch"], None)
+        if snapshot is None:
+            return
+        if data["result"] is None:
+            self._logger.warning("The byzantine agreement found no common value, keeping the entries.")
+            return
+        try:
+            snapshot, result = dict(json.loads(snapshot)), dict(json.loads(data["result"]))
+            if not all(type(entries) is int for entries in result.values()):
+                raise ValueError("entries have to be integers")
+        except (TypeError, ValueError):
+            self._logger.error("Ignoring the malformed agreement result %r.", data["result"])
+            return
+        for name in sorted(set(snapshot) | set(result)):
+            correction = result.get(name, 0) - snapshot.get(name, 0)
+            if correction == 0:
+                continue
+            namespace = self._namespace(name)
+            namespace.entries += correction
+            namespace.delivered_entries += correction
+            namespace.corrected += correction
+            self._logger.info(
+                "Byzantine agreement corrected entries of %s by %s to %s.", name, correction, namespace.entries
+            )
+            self._update_client_entries(namespace)
+
     def _on_byzantine_om(self, om):
-        self._logger.debug(f"Received byzantine message: {om}")
+        self._logger.debug("Received %s agreement message from %s", om['engine'], om['from'])
         byzantine_id = om["id"]
+        if self._byzantine_history.get(byzantine_id) in (ByzantineStates.FINISHED, ByzantineStates.ABORTED):
+            return
+        if byzantine_id not in self._byzantine_epochs:
+            # we haven't delivered the epoch mark yet, so we don't know our value
+            self._byzantine_pending.setdefault(byzantine_id, []).append(om)
+            while len(self._byzantine_pending) > AGREEMENT_PENDING_RUNS:
+                self._byzantine_pending.popitem(last=False)
+            return
         if self._byzantine_member_cache == None:
             self._logger.info("Started byzantine")
-            self._byzantine_member_cache = ByzantineMemberCache(byzantine_id, len(self._group_view))
+            self._byzantine_member_cache = ENGINES[om["engine"]](byzantine_id, self._uuid, self._byzantine_epochs[byzantine_id])
             self._byzantine_history[byzantine_id] = ByzantineStates.STARTED
             self._promote_monitoring_data()
-        else:
-            if byzantine_id not in self._byzantine_history and self._byzantine_member_cache.id != byzantine_id:
-                self._logger.info("Aborted and restarted byzantine")
-                self._byzantine_history[self._byzantine_member_cache.id] = ByzantineStates.ABORTED
-                self._byzantine_member_cache = ByzantineMemberCache(byzantine_id, len(self._group_view))
-                self._byzantine_history[byzantine_id] = ByzantineStates.STARTED
-
-        if not self._byzantine_member_cache.tree.is_full():
-            dests = list(set(om["dests"]) - set([self._uuid]))
-            l = om["list"]
-            f = om["faulty"]
-            self._byzantine_member_cache.tree.push(deepcopy(l), om["v"])
-            if f - 1 >= 0:
-                l.insert(0, self._uuid)
-                om_new = {
-                    "intention": str(Intention.OM),
-                    "v": self._entries,
-                    "dests": dests,
-                    "list": l,
-                    "faulty": f - 1,
-                    "id": byzantine_id,
-                }
-                for uuid in dests:
-                    if not self._tcp_handler.send(om_new, self._group_view[uuid]):
-                        self._logger.warning(f"Could not send om to: {uuid}. Requesting byzantine restart")
-                        if self._current_leader != self._uuid:
-                            request = {
-                                "intention": str(Intention.OM_RESTART),
-                                "id": byzantine_id,
-                            }
-                            self._tcp_handler.send(request, self._group_view[self._current_leader])
-                        else:
-                            self._start_byzantine(byzantine_id)
+        elif self._byzantine_member_cache.id != byzantine_id:
+            if byzantine_id in self._byzantine_history:
+                return
+            self._logger.info("Aborted and restarted byzantine")
+            self._byzantine_history[self._byzantine_member_cache.id] = ByzantineStates.ABORTED
+            self._byzantine_pending.pop(self._byzantine_member_cache.id, None)
+            self._byzantine_member_cache = ENGINES[om["engine"]](byzantine_id, self._uuid, self._byzantine_epochs[byzantine_id])
+            self._byzantine_history[byzantine_id] = ByzantineStates.STARTED
+
+        engine = self._byzantine_member_cache
+        engine.add(om)
+        for uuid, payload in engine.advance():
+            om_new = {
+                "intention": str(Intention.OM),
+                "id": byzantine_id,
+                "engine": engine.name,
+                "from": self._uuid,
+                **payload,
+            }
+            address = self._group_view.get(uuid)
+            if address is None or not self._tcp_handler.send(om_new, address):
+                self._logger.warning("Could not send om to: %s. Requesting byzantine restart", uuid)
+                if self._current_leader != self._uuid:
+                    request = {
+                        "intention": str(Intention.OM_RESTART),
+                        "id": byzantine_id,
+                    }
+                    self._tcp_handler.send(request, self._group_view[self._current_leader])
+                else:
+                    self._start_byzantine(byzantine_id)
+                return
 
         # Are we now done? Then complete the algorithm
-        if self._byzantine_member_cache.tree.is_full():
-            res = self._byzantine_member_cache.tree.complete()
+        if engine.done:
             self._byzantine_member_cache = None
-            self._byzantine_history[byzantine_id] = ByzantineStates.FINISHED
             self._promote_monitoring_data()
             om_new = {
                 "intention": str(Intention.OM),
                 "from": self._uuid,
-                "result": res,
                 "id": byzantine_id,
             }
+            if engine.error is not None:
+                self._logger.error("Cannot take part in the agreement: %s", engine.error)
+                self._byzantine_history[byzantine_id] = ByzantineStates.ABORTED
+                om_new["error"] = engine.error
+            else:
+                self._byzantine_history[byzantine_id] = ByzantineStates.FINISHED
+                om_new["result"] = engine.result
             if not self._tcp_handler.send(om_new, self._group_view[self._current_leader]):
-                self._logger.warning(f"Could not send stop om to current leader")
+                self._logger.warning("Could not send stop om to current leader")
 
     # heartbeat methods -------------------------------------------------------
 
     def _send_heartbeat(self):
         if not self._participating:
-            msg = {"intention": str(Intention.HEARTBEAT), "uuid": f"{self._uuid}", "address": self._my_ip, "port": self._tcp_handler.port }
-            if not self._tcp_handler.send(msg, self._group_view[self._current_leader]):
+            msg = {
+                "intention": str(Intention.HEARTBEAT),
+                "uuid": f"{self._uuid}",
+                "address": self._my_ip,
+                "port": self._tcp_handler.port,
+                "seq": self._delivered_seq,
+                "digest": self._digests.get(self._delivered_seq, self._digest()),
+            }
+            sent_at = self._transport.now()
+            if self._tcp_handler.send(msg, self._group_view[self._current_leader]):
+                # connecting takes one round trip, the payload fits into a segment
+                self._heartbeat_rtt = self._transport.now() - sent_at
+                HEARTBEAT_RTT.observe(self._heartbeat_rtt)
+            else:
                 self._logger.warning("Leader seems to be offline, starting new election.")
                 self._start_election()
         else:
@@ -544,7 +1147,7 @@ class Server:
         else:
             self._logger.debug("Checking heartbeats.")
 
-            now = datetime.datetime.now().timestamp()
+            now = self._transport.now()
             remove = []
             for uuid in self._group_view.keys():
                 if uuid == self._uuid:
@@ -553,14 +1156,14 @@ class Server:
                 if latest_beat:
                     diff = now - latest_beat
                     if diff > HEARTBEAT_TIMEOUT:
-                        self._logger.debug(f"Node {uuid} has timed out.")
+                        self._logger.debug("Node %s has timed out.", uuid)
                         self._heartbeats[uuid]["strikes"] = self._heartbeats[uuid]["strikes"] +1
                         if self._heartbeats[uuid]["strikes"] >= MAX_TIMEOUTS:
-                            self._logger.info(f"Node {uuid} has timed out twice in a row. Removing.")
+                            self._logger.info("Node %s has timed out twice in a row. Removing.", uuid)
                             remove.append(uuid)
                 else:
                     self._logger.info(
-                        f"Node {uuid} does not appear to be in group view. Removing."
+                        "Node %s does not appear to be in group view. Removing.", uuid
                     )
                     remove.append(uuid)
 
@@ -575,102 +1178,460 @@ class Server:
             if len(self._group_view) == 1:
                 self._logger.info("Looks like I am the only server.")
                 self._request_join(rejoin=True)
+            else:
+                self._maybe_byzantine()
 
     def _on_received_heartbeat(self, data):
         if self._state == State.LEADER:
             if data['uuid'] in self._group_view:
-                self._logger.debug(f"Received heartbeat from {data['uuid']}.")
-                self._heartbeats[data["uuid"]] = {"ts": datetime.datetime.now().timestamp(), "strikes": 0}
+                self._logger.debug("Received heartbeat from %s.", data['uuid'])
+                self._heartbeats[data["uuid"]] = {"ts": self._transport.now(), "strikes": 0}
+                self._compare_digest(data)
             else:
                 self._logger.warning(
-                    f"Received heartbeat from {data['uuid']} who is not in group view. Will register them as a new member."
+                    "Received heartbeat from %s who is not in group view. Will register them as a new member.", data['uuid']
                 )
                 self._register_server(data)
         else:
             self._tcp_handler.send({"intention": str(Intention.NOT_LEADER)}, (data['address'],data['port']))
 
+    def _record_decision(self, decision, res):
+        seconds = self._transport.now() - res["received_at"]
+        count = res.get("count", 1)
+        DECISION.labels(decision).observe(seconds)
+        self._stats.decision(decision, seconds, count)
+        if count == 1:
+            self._persist("decision", decision=decision, client=res["uuid"])
+        else:
+            self._persist("decision", decision=decision, client=res["uuid"], count=count)
+
     def _on_heartbeat_timeout(self, heartbeat_func):
-        self._logger.debug(f"Heartbeat timed out, calling {heartbeat_func}.")
+        self._logger.debug("Heartbeat timed out, calling %s.", heartbeat_func)
         heartbeat_func()
 
     # client methods ----------------------------------------------------------
 
     def _register_client(self, data):
+        namespace = self._namespace(data.get("namespace", DEFAULT_NAMESPACE))
         mes = {
             "intention": str(Intention.ACCEPT_CLIENT),
             "uuid": self._uuid,
             "address": self._my_ip,
             "port": self._tcp_handler.port,
-            "entries": self._entries
+            "namespace": namespace.name,
+            "entries": namespace.entries,
+            "capacity": namespace.capacity,
         }
-        self._logger.info(f"Trying to register a client with uuid {data['uuid']}")
+        self._logger.info("Trying to register a client with uuid %s", data['uuid'])
         if self._tcp_handler.send(mes, (data['address'],data['port'])):
             pass
         else:
-            self._logger.warn("Failed to accept a client, seems to have already disappeared again!")
+            self._logger.warning("Failed to accept a client, seems to have already disappeared again!")
 
-    def _update_client_entries(self):
+    def _update_client_entries(self, namespace=None):
+        namespace = namespace or self._default
+        mes = {
+            "intention": str(Intention.UPDATE_ENTRIES),
+            "namespace": namespace.name,
+            "entries": namespace.entries,
+            "capacity": namespace.capacity,
+        }
         to_remove = []
         for (uuid,addr_and_port) in self._clients.items():
-            if not self._tcp_handler.send({"intention": str(Intention.UPDATE_ENTRIES), "entries": self._entries}, addr_and_port):
+            if self._client_namespaces.get(uuid, DEFAULT_NAMESPACE) != namespace.name:
+                continue
+            if not self._tcp_handler.send(mes, addr_and_port):
                 to_remove.append(uuid)
-                self._logger.warn("Marking a client for removal due to failure of sending them a message")
+                self._logger.warning("Marking a client for removal due to failure of sending them a message")
         for uuid in to_remove:
             self._clients.pop(uuid)
+            self._client_namespaces.pop(uuid, None)
+            self._persist("client_gone", uuid=uuid)
 
     def _on_request_action(self,res):
-        if not self._clients.get(res["uuid"]):
-            self._clients[res["uuid"]] = (res["address"],res["port"])
-            self._logger.info("Seems like a discarded client reconnected, readding it to the client list.")
-        self._logger.info(f"Client {res['uuid']} is requesting an action.")
-        self._requests.put(res)
-        self._update_lock()
-
-    def _update_lock(self, data={"intention": "TODO"}): #TODO
-        if self._lock == LockState.CLOSED:
+        namespace = self._namespace(res.get("namespace", DEFAULT_NAMESPACE))
+        count = res.get("count", 1)
+        if isinstance(count, bool) or not isinstance(count, int) or count < 1:
+            self._logger.warning("Client %s sent a request for %r people, ignoring it.", res["uuid"], count)
+            if res["increase"]:
+                self._tcp_handler.send({"intention": str(Intention.DENY_ENTRY), "uuid": self._uuid}, (res["address"], res["port"]))
+            return
+        if not res.get("forwarded"):
+            if not self._clients.get(res["uuid"]):
+                self._clients[res["uuid"]] = (res["address"],res["port"])
+                self._persist("client", uuid=res["uuid"], address=self._clients[res["uuid"]])
+                self._logger.info("Seems like a discarded client reconnected, readding it to the client list.")
+            self._client_namespaces[res["uuid"]] = namespace.name
+            self._logger.info("Client %s is requesting an action.", res['uuid'])
+            res["received_at"] = self._transport.now()
+            if "trace" in res:
+                TRACER.span(res["trace"], "server.tcp", self._uuid, res["sent_at"], res["received_at"])
+            if self._answer_duplicate(res):
+                return
+            if self._forward_request(namespace, res):
+                return
+        else:
+            res["received_at"] = self._transport.now()
+        if self._request_limit and namespace.requests.qsize() >= self._request_limit:
+            SHED.labels("requests").inc()
+            self._shed_requests += 1
+            self._logger.info("Namespace %s has %s requests waiting, client %s should try again.", namespace.name, namespace.requests.qsize(), res["uuid"])
+            self._tcp_handler.try_again(res)
+            return
+        namespace.requests.put(res)
+        self._update_lock(namespace)
+
+    def _answer_duplicate(self, res):
+        """
+        Answers a request that was decided before, e.g. a retry after a
+        timeout or a copy sent to another server, like the first time
+        without counting it again. Returns whether it was one.
+        """
+        if "key" not in res:
+            return False
+        decision = self._decisions.get(short_key(res["key"]))
+        if decision is None:
+            return False
+        DUPLICATES.labels(decision).inc()
+        self._logger.info("Request %s of client %s was %s before, answering again.", res["key"], res["uuid"], decision)
+        namespace = self._namespace(res.get("namespace", DEFAULT_NAMESPACE))
+        if decision == "accepted":
+            mes = {"intention": str(Intention.ACCEPT_ENTRY), "uuid": self._uuid, "count": res.get("count", 1)}
+        elif decision == "denied":
+            mes = {"intention": str(Intention.DENY_ENTRY), "uuid": self._uuid, "count": res.get("count", 1)}
+        else:
+            # exits have no answer of their own, clients wait for the count
+            mes = {
+                "intention": str(Intention.UPDATE_ENTRIES),
+                "namespace": namespace.name,
+                "entries": namespace.entries,
+                "capacity": namespace.capacity,
+            }
+        if "trace" in res:
+            mes["trace"] = res["trace"]
+        mes["key"] = res["key"]
+        self._tcp_handler.send(mes, (res["address"], res["port"]))
+        return True
+
+    def _add_decisions(self, decisions):
+        """Ordered decisions of any server, kept so retries are answered after a restart too."""
+        if decisions:
+            self._decisions.update(decisions)
+            self._persist("dedup", decisions=decisions)
+
+    def _remember_decision(self, res, decision, decided):
+        if "key" in res:
+            key = short_key(res["key"])
+            self._decisions.add(key, decision)
+            decided[key] = decision
+
+    def _namespace(self, name):
+        namespace = self._namespaces.get(name)
+        if namespace is None:
+            namespace = self._namespaces[name] = Namespace(name, self._capacities.get(name, MAX_ENTRIES))
+        return namespace
+
+    def _namespace_entries(self):
+        """{ name: entries } of every namespace but the default one."""
+        return {
+            name: namespace.entries for name, namespace in self._namespaces.items()
+            if name != DEFAULT_NAMESPACE
+        }
+
+    def _owner(self, namespace):
+        """The server that takes the lock of `namespace`, see `HashRing`."""
+        self._ring.update(self._group_view)
+        return self._ring.owner(namespace.name)
+
+    def _forward_request(self, namespace, res):
+        """
+        Hands a request to the owner of its namespace, who answers the client
+        directly. Only the owner asks for the lock of a namespace, so locks of
+        different namespaces are taken on different servers and never compete.
+        The lock still decides if two servers disagree on the owner for a while.
+        """
+        owner = self._owner(namespace)
+        if owner is None or owner == self._uuid:
+            return False
+        forward = {key: value for key, value in res.items() if key != "received_at"}
+        forward["forwarded"] = True
+        if self._tcp_handler.send(forward, tuple(self._group_view[owner])):
+            return True
+        self._logger.warning("Could not forward a request to %s, the owner of %s.", owner, namespace.name)
+        return False
+
+    def _update_lock(self, namespace, data={"intention": "TODO"}): #TODO
+        if namespace.lock == LockState.CLOSED:
             if data["intention"] == str(Intention.UNLOCK):
-                self._lock = LockState.OPEN
+                namespace.lock = LockState.OPEN
                 self._logger.info("Lock unlocked by someone else!")
-        if self._lock == LockState.OPEN:
+        if namespace.lock == LockState.OPEN:
             if data["intention"] == str(Intention.LOCK):
                 if data["uuid"] == self._uuid:
-                    self._lock = LockState.MINE
+                    namespace.lock = LockState.MINE
                     self._logger.info("Lock acquired!")
-                    while not self._requests.empty():
-                        res = self._requests.get()
+                    namespace.lock_acquired_at = self._transport.now()
+                    if namespace.lock_requested_at is not None:
+                        LOCK_WAIT.observe(namespace.lock_acquired_at - namespace.lock_requested_at)
+                        TRACER.spans(data.get("traces"), "server.lock", self._uuid, namespace.lock_requested_at, namespace.lock_acquired_at)
+                        namespace.lock_requested_at = None
+                    traces = []
+                    decided = {}  # { key: decision } replicated with the entries
+                    while not namespace.requests.empty():
+                        res = namespace.requests.get()
+                        if "trace" in res:
+                            traces.append(res["trace"])
+                            TRACER.span(res["trace"], "server.queue", self._uuid, res["received_at"], namespace.lock_acquired_at)
+                        # every decision before our lock is in the cache by now
+                        if self._answer_duplicate(res):
+                            continue
+                        # a group is admitted as a whole or not at all
+                        count = res.get("count", 1)
                         if res["increase"]:
-                            if self._entries < MAX_ENTRIES:
+                            if namespace.entries + count <= namespace.capacity:
                                 mes = {
                                     "intention": str(Intention.ACCEPT_ENTRY),
-                                    "uuid": self._uuid
+                                    "uuid": self._uuid,
+                                    "count": count,
                                     }
+                                if "trace" in res:
+                                    mes["trace"] = res["trace"]
+                                if "key" in res:
+                                    mes["key"] = res["key"]
                                 if self._tcp_handler.send(mes, (res["address"],res["port"])):
-                                    self._entries += 1
-                                    self._logger.info("Granted someone entry. Current count: " + str(self._entries) + " of " + str(MAX_ENTRIES))
+                                    self._record_decision("accepted", res)
+                                    self._remember_decision(res, "accepted", decided)
+                                    namespace.entries += count
+                                    self._logger.info("Granted %s entry. Current count: %s of %s", count, namespace.entries, namespace.capacity)
                                 else:
-                                    self._logger.warn("Failed to send entry acceptance to a client, ignoring the request!")
+                                    self._logger.warning("Failed to send entry acceptance to a client, ignoring the request!")
                             else:
                                 mes = {
                                     "intention": str(Intention.DENY_ENTRY),
-                                    "uuid": self._uuid
+                                    "uuid": self._uuid,
+                                    "count": count,
                                     }
+                                if "trace" in res:
+                                    mes["trace"] = res["trace"]
+                                if "key" in res:
+                                    mes["key"] = res["key"]
                                 self._tcp_handler.send(mes, (res["address"],res["port"]))
+                                self._record_decision("denied", res)
+                                self._remember_decision(res, "denied", decided)
                         else:
-                            self._entries -= 1
-                            self._logger.info("Someone left the venue. Current count: " + str(self._entries) + " of " + str(MAX_ENTRIES))
-                    self._update_client_entries()
-                    self._rom_handler.send({"uuid": self._uuid, "intention": str(Intention.UPDATE_ENTRIES), "entries": self._entries})
-                    self._rom_handler.send({"uuid": self._uuid, "intention": str(Intention.UNLOCK)})
+                            self._record_decision("left", res)
+                            self._remember_decision(res, "left", decided)
+                            # more exits than entries, e.g. people that came in before a restart
+                            namespace.entries = max(0, namespace.entries - count)
+                            self._logger.info("%s left the venue. Current count: %s of %s", count, namespace.entries, namespace.capacity)
+                            if "key" in res:
+                                # the count broadcast below reaches every client, this one tells the requester its exit was counted
+                                mes = {
+                                    "intention": str(Intention.UPDATE_ENTRIES),
+                                    "namespace": namespace.name,
+                                    "entries": namespace.entries,
+                                    "capacity": namespace.capacity,
+                                    "key": res["key"],
+                                }
+                                if "trace" in res:
+                                    mes["trace"] = res["trace"]
+                                self._tcp_handler.send(mes, (res["address"], res["port"]))
+                        if "trace" in res:
+                            TRACER.span(res["trace"], "server.decide", self._uuid, namespace.lock_acquired_at, self._transport.now())
+                    self._update_client_entries(namespace)
+                    namespace.commit_traces = traces
+                    namespace.commit_started = self._transport.now()
+                    update = {
+                        "uuid": self._uuid,
+                        "intention": str(Intention.UPDATE_ENTRIES),
+                        "namespace": namespace.name,
+                        "entries": namespace.entries,
+                        "corrected": namespace.corrected,
+                    }
+                    decisions = chunked(decided)
+                    if decisions:
+                        update["decisions"] = decisions.pop(0)
+                    self._rom_handler.send(attach(update, traces))
+                    # the rest of a big batch, ordered before our unlock
+                    for more in decisions:
+                        self._rom_handler.send({"uuid": self._uuid, "intention": str(Intention.DECISIONS), "decisions": more})
+                    self._rom_handler.send({"uuid": self._uuid, "intention": str(Intention.UNLOCK), "namespace": namespace.name})
                 else:
-                    self._lock = LockState.CLOSED
+                    namespace.lock = LockState.CLOSED
                     self._logger.info("Lock acquired by someone else!")
-            elif not self._requests.empty():
-                self._rom_handler.send({"intention":str(Intention.LOCK), "uuid": self._uuid})
-        if self._lock == LockState.MINE:
+            elif not namespace.requests.empty():
+                self._request_lock(namespace)
+        if namespace.lock == LockState.MINE:
             if data["intention"] == str(Intention.UNLOCK) and data["uuid"] == self._uuid:
-                self._lock = LockState.OPEN
+                namespace.lock = LockState.OPEN
                 self._logger.info("Lock unlocked by me!")
+                if namespace.lock_acquired_at is not None:
+                    LOCK_HOLD.observe(self._transport.now() - namespace.lock_acquired_at)
+                    namespace.lock_acquired_at = None
+                TRACER.spans(namespace.commit_traces, "server.commit", self._uuid, namespace.commit_started, self._transport.now())
+                namespace.commit_traces = []
+                # requests that arrived while we held the lock would otherwise wait for the next one
+                if not namespace.requests.empty():
+                    self._request_lock(namespace)
+
+    def _request_lock(self, namespace):
+        if namespace.lock_requested_at is None:
+            namespace.lock_requested_at = self._transport.now()
+        traces = [res.get("trace") for res in list(namespace.requests.queue)]
+        self._rom_handler.send(attach({"intention":str(Intention.LOCK), "uuid": self._uuid, "namespace": namespace.name}, traces))
+
+
+    # diagnostics methods -----------------------------------------------------
+
+    def _on_diagnostics(self, data):
+        command = data.get("command")
+        self._logger.info("Diagnostics command %s from %s:%s", command, data['address'], data['port'])
+        if not self._diagnostics:
+            self._send_diagnostics(data, {"error": "diagnostics are disabled, start the server with --diagnostics"})
+            return
+        limit = data.get("limit", 30)
+        if isinstance(limit, bool) or not isinstance(limit, int):
+            limit = 30
+        limit = min(max(limit, 1), DIAGNOSTICS_MAX_LIMIT)
+        seconds = data.get("seconds", 10)
+        if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or seconds != seconds:
+            seconds = 10
+        seconds = min(max(seconds, 0), DIAGNOSTICS_MAX_SECONDS)
+        if command == "profile":
+            # answers by itself once the time is up, from the profiler thread
+            if self._profiler.start(seconds, lambda result: self._send_diagnostics(data, result)):
+                return
+            result = {"error": "profiler is already running"}
+        elif command == "profile_start":
+            # sampling stops by itself at the cap, profile_stop still returns it
+            result = {"started": self._profiler.start(DIAGNOSTICS_MAX_SECONDS)}
+        elif command == "profile_stop":
+            result = self._profiler.stop(limit)
+        elif command == "heap":
+            result = self._heap.diff(limit)
+        elif command == "heap_stop":
+            result = self._heap.stop()
+        elif command == "state":
+            result = self._diagnostics_state()
+        else:
+            result = {"error": f"unknown command {command}"}
+        self._send_diagnostics(data, result)
+
+    def _send_diagnostics(self, data, result):
+        for mesg in chunks(data.get("request"), self._uuid, result):
+            if not self._tcp_handler.send(mesg, (data["address"], data["port"])):
+                self._logger.warning("Could not send diagnostics result, requester is gone.")
+                return
 
+    def _diagnostics_state(self):
+        rom = self._rom_handler
+        leader_cache = self._byzantine_leader_cache
+        member_cache = self._byzantine_member_cache
+        return {
+            "uuid": self._uuid,
+            "state": self._state.name,
+            "leader": self._current_leader,
+            "participating": self._participating,
+            "group_view": len(self._group_view),
+            "clients": len(self._clients),
+            "queue": self.QUEUE.qsize(),
+            "requests": self._default.requests.qsize(),
+            "shed": {"queue": self._tcp_handler.shed, "requests": self._shed_requests},
+            "lock": self._default.lock.name,
+            "entries": self._default.entries,
+            "delivered_entries": self._default.delivered_entries,
+            "namespaces": {
+                name: {
+                    "entries": namespace.entries,
+                    "capacity": namespace.capacity,
+                    "requests": namespace.requests.qsize(),
+                    "lock": namespace.lock.name,
+                    "owner": self._owner(namespace),
+                }
+                for name, namespace in self._namespaces.items()
+            },
+            "delivered_seq": self._delivered_seq,
+            "heartbeats": len(self._heartbeats),
+            "digests": len(self._digests),
+            "rom": {
+                "holdback": len(rom._holdback),
+                "received": len(rom._received),
+                "out": len(rom._out),
+                "out_a": len(rom._out_a),
+                "group_view_backlog": len(rom._group_view_backlog),
+                "deliver_queue": len(rom._deliver_queue),
+                "priorities": len(rom._priorities),
+                "rnumbers": dict(rom._rnumbers),
+                "paused": rom._paused,
+                "aq": rom._aq,
+                "pq": rom._pq,
+            },
+            "byzantine": {
+                "agreement": self._agreement.name,
+                "leader_cache": None if leader_cache is None else {
+                    "id": leader_cache.id,
+                    "results": len(leader_cache.results),
+                },
+                "member_cache": None if member_cache is None else {
+                    "id": member_cache.id,
+                    "engine": member_cache.name,
+                    "done": member_cache.done,
+                },
+                "history": len(self._byzantine_history),
+                "epochs": list(self._byzantine_epochs),
+                "pending": {id: len(oms) for id, oms in self._byzantine_pending.items()},
+            },
+            "profiling": self._profiler.running,
+        }
+
+    # persistence -------------------------------------------------------------
+
+    def _recover(self):
+        state = self._store.state
+        if not self._store.recovered:
+            self._persist("identity", uuid=self._uuid)
+            return
+        self._default.entries = state.get("entries", 0)
+        self._default.delivered_entries = self._default.entries
+        for name, entries in state.get("namespaces", {}).items():
+            namespace = self._namespace(name)
+            namespace.entries = namespace.delivered_entries = entries
+        self._delivered_seq = state.get("seq", 0)
+        self._decisions.update(state.get("dedup", {}))
+        self._clients = {uuid: tuple(address) for uuid, address in state.get("clients", {}).items()}
+        self._record_digest()
+        self._logger.info(
+            "Recovered state: %s entries at sequence %s, %s clients.",
+            self._default.entries, self._delivered_seq, len(self._clients),
+        )
+
+    def _persist(self, kind, **fields):
+        if self._store is not None:
+            self._store.log(kind, **fields)
+
+    def _entries_delta(self, seq):
+        """The updates after `seq`, None if `seq` is older than our history."""
+        if seq == self._delivered_seq:
+            return []
+        seqs = [s for s, _, _ in self._entries_history]
+        if seq not in seqs:
+            return None
+        return [
+            {"seq": s, "namespace": name, "entries": e}
+            for s, name, e in list(self._entries_history)[seqs.index(seq) + 1:]
+        ]
+
+    def _persist_welcome(self, data, delta):
+        if delta is not None:
+            for update in delta:
+                self._persist("entries", entries=update["entries"], seq=update["seq"], namespace=update["namespace"])
+            self._logger.info("Resumed at sequence %s, replayed %s missed updates.", data.get("seq"), len(delta))
+        if delta is None or self._store.state.get("entries") != data["entries"]:
+            self._persist("entries", entries=data["entries"], seq=data.get("seq", 0))
+        persisted = self._store.state.get("namespaces", {})
+        for name, entries in data.get("namespaces", {}).items():
+            if delta is None or persisted.get(name) != entries:
+                self._persist("entries", entries=entries, seq=data.get("seq", 0), namespace=name)
 
     # other methods -----------------------------------------------------------
 
@@ -685,23 +1646,41 @@ class Server:
             "election": self._participating,
             "byzantine": self._byzantine_leader_cache is not None or self._byzantine_member_cache is not None,
             "state": self._state.name,
-            "entries": self._entries
+            "entries": self._default.entries
         }
         self._broadcast_handler.send(msg)
 
+    def _publish_stats(self):
+        """Broadcasts what happened since the last call, the monitor charts it."""
+        now = self._transport.now()
+        interval = max(now - self._stats_published_at, 1e-9)
+        self._stats_published_at = now
+        admissions, latencies = self._stats.take()
+        self._broadcast_handler.send({
+            "intention": str(Intention.MONITOR_STATS),
+            "uuid": self._uuid,
+            "admissions": round(admissions / interval, 3),
+            "p50": _milliseconds(percentile(latencies, 50)),
+            "p99": _milliseconds(percentile(latencies, 99)),
+            "queue": self.QUEUE.qsize(),
+            "holdback": len(self._rom_handler._holdback),
+            "rtt": _milliseconds(self._heartbeat_rtt),
+        })
+
     def _set_leader(self, state=True):
         if state:
             self._state = State.LEADER
             if self._heartbeat_timer is not None:
                 self._heartbeat_timer.cancel()
-            self._heartbeat_timer = RepeatTimer(
+            self._heartbeat_timer = self._transport.timer(
                 HEARTBEAT_TIMEOUT + 5, self.QUEUE.put, args=[Invokeable(ON_HEARTBEAT_TIMEOUT, heartbeat_func=self._check_heartbeats)]
             )
             self._heartbeat_timer.start()
         else:
             if self._heartbeat_timer is not None:
                 self._heartbeat_timer.cancel()
-            self._heartbeat_timer = RepeatTimer(HEARTBEAT_TIMEOUT, self.QUEUE.put, args=[Invokeable(ON_HEARTBEAT_TIMEOUT, heartbeat_func=self._send_heartbeat)]
+            self._heartbeat_timer = self._transport.timer(
+                HEARTBEAT_TIMEOUT, self.QUEUE.put, args=[Invokeable(ON_HEARTBEAT_TIMEOUT, heartbeat_func=self._send_heartbeat)]
             )
             self._heartbeat_timer.start()
 
@@ -720,9 +1699,17 @@ class Server:
         self._broadcast_handler.join()
         #TODO currently doesn't work
         self._rom_handler.join()
+        for gauge in (QUEUE_DEPTH, ROM_HOLDBACK, ROM_PENDING):
+            gauge.remove(self._uuid)
         self._logger.debug("Stopping heartbeat timer.")
         if self._heartbeat_timer is not None:
             self._heartbeat_timer.cancel()
+        if self._stats_timer is not None:
+            self._stats_timer.cancel()
+        if self._join_window is not None:
+            self._join_window.cancel()
+        if self._store is not None:
+            self._store.close()
 
         if leader_address and self._current_leader != self._uuid:
             self._logger.debug("Sending shutdown signal to leader.")
@@ -731,8 +1718,8 @@ class Server:
             self._logger.debug("Broadcasting shutdown signal.")
             self._broadcast_handler.send(msg)
 
-    def run(self):
-
+    def start(self):
+        """Join or found a group and start listening."""
         self._logger.info("Starting Server...")
 
         self._request_join()
@@ -744,29 +1731,48 @@ class Server:
         self._logger.info("Starting Multicast hander.")
         self._rom_handler.start()
 
+        self._stats_published_at = self._transport.now()
+        self._stats_timer = self._transport.timer(
+            MONITOR_STATS_INTERVAL, self.QUEUE.put, args=[Invokeable(ON_STATS_TIMEOUT)]
+        )
+        self._stats_timer.start()
+
+    def handle(self, item):
+        """Dispatch a single item of our queue."""
+        try:
+            if item.signal == ON_TCP_MESSAGE:
+                self._on_tcp_msg(**item.kwargs)
+            elif item.signal == ON_BROADCAST_MESSAGE:
+                self._on_udp_msg(**item.kwargs)
+            elif item.signal == ON_MULTICAST_MESSAGE:
+                self._on_rom_msg(**item.kwargs)
+            elif item.signal == ON_HEARTBEAT_TIMEOUT:
+                self._on_heartbeat_timeout(**item.kwargs)
+            elif item.signal == ON_STATS_TIMEOUT:
+                self._publish_stats()
+            elif item.signal == ON_JOIN_WINDOW:
+                self._on_join_window()
+        except Exception as e:
+            self._logger.error(e)
+
+    def run(self):
+
+        self.start()
+
         self._logger.info("Running.")
         try:
             while True:
                 try:
-                    try:
-                        item = self.QUEUE.get(block=False)
-                        if item.signal == ON_TCP_MESSAGE:
-                            self._on_tcp_msg(**item.kwargs)
-                        elif item.signal == ON_BROADCAST_MESSAGE:
-                            self._on_udp_msg(**item.kwargs)
-                        elif item.signal == ON_MULTICAST_MESSAGE:
-                            self._on_rom_msg(**item.kwargs)
-                        elif item.signal == ON_HEARTBEAT_TIMEOUT:
-                            self._on_heartbeat_timeout(**item.kwargs)
-
-                    except queue.Empty:
-                        pass
-                except Exception as e:
-                    self._logger.error(e)
+                    self.handle(self.QUEUE.get(block=False))
+                except queue.Empty:
+                    pass
         except KeyboardInterrupt:
             self._logger.info("Shutting down...")
             self._shut_down()
             self._logger.info("Shut down successfull.")
+            # os._exit skips atexit, write out what is still queued
+            TRACER.close()
+            stop_logging()
             try:
                 sys.exit(0)
             except SystemExit:
@@ -0,0 +1,60 @@
+import argparse
+import json
+import logging
+
+from src.utils.constants import AGREEMENT_ENGINE
+
+from .simulation import Simulation
+
+parser = argparse.ArgumentParser(description="Run a simulated cluster and report protocol costs")
+parser.add_argument("--servers", type=int, default=10)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--latency", type=float, nargs=2, default=(0.0005, 0.002), metavar=("MIN", "MAX"))
+parser.add_argument("--loss", type=float, default=0.0)
+parser.add_argument("--reorder", type=float, default=0.0)
+parser.add_argument("--requests", type=int, default=20)
+parser.add_argument("--namespaces", type=int, default=0, help="spread the requests over this many namespaces")
+parser.add_argument("--agreement", choices=["om", "king", "signed"], default=AGREEMENT_ENGINE)
+parser.add_argument(
+    "--no-agreement",
+    action="store_true",
+    default=False,
+    help="skip the agreement run, OM(f) grows with n^f and gets slow above ~15 servers",
+)
+parser.add_argument("--no-election", action="store_true", default=False)
+parser.add_argument("--verbose", action="store_true", default=False)
+
+args = parser.parse_args()
+
+if not args.verbose:
+    logging.disable(logging.CRITICAL)
+
+sim = Simulation(
+    seed=args.seed,
+    agreement=args.agreement,
+    latency=tuple(args.latency),
+    loss=args.loss,
+    reorder=args.reorder,
+)
+
+for _ in range(args.servers):
+    sim.add_server()
+    sim.run_for(0.5)
+sim.measure("converge", sim.converged, 120)
+
+namespaces = [f"venue-{i}" for i in range(args.namespaces)] or None
+decisions = sim.admit(args.requests, namespaces=namespaces)
+if not args.no_agreement and len(sim.servers) >= 4:
+    sim.agree()
+if not args.no_election and len(sim.servers) > 1:
+    sim.elect()
+
+report = sim.report()
+report["decisions"] = decisions
+report["entries"] = sorted(set(server._default.entries for server in sim.servers))
+if namespaces:
+    report["namespaces"] = {
+        name: sorted(set(server._namespace(name).delivered_entries for server in sim.servers))
+        for name in namespaces
+    }
+print(json.dumps(report, indent=2, sort_keys=True))
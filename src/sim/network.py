@@ -0,0 +1,481 @@
+import heapq
+import itertools
+import json
+import logging
+import queue
+import random
+import uuid
+from collections import defaultdict, deque
+
+from src.utils.broadcast_handler import BroadcastHandler
+from src.utils.common import SocketThread, summarize
+from src.utils.constants import (LOGGING_LEVEL, MAX_MSG_BUFF_SIZE,
+                                 ROM_REPAIR_INTERVAL, TIMEOUT)
+from src.utils.rom_handler import ROMulticastHandler
+from src.utils.signals import ON_MULTICAST_MESSAGE
+from src.utils.tcp_handler import TCPHandler
+
+
+class SimStats:
+    def __init__(self):
+        self.messages = defaultdict(lambda: defaultdict(int))  # { transport: { kind: count } }
+        self.bytes = defaultdict(lambda: defaultdict(int))
+        self.latencies = defaultdict(list)  # { name: [seconds, ...] }
+
+    def record(self, transport, kind, size):
+        self.messages[transport][kind] += 1
+        self.bytes[transport][kind] += size
+
+    def observe(self, name, value):
+        self.latencies[name].append(value)
+
+    def report(self):
+        return {
+            "messages": {t: dict(sorted(k.items())) for t, k in sorted(self.messages.items())},
+            "bytes": {t: dict(sorted(k.items())) for t, k in sorted(self.bytes.items())},
+            "latency": {name: summarize(values) for name, values in sorted(self.latencies.items())},
+        }
+
+
+class SimNetwork:
+    """
+    A seeded, single threaded network with a virtual clock.
+    Every send is turned into an event on a heap ordered by delivery time, so
+    two runs with the same seed and the same scenario behave identically.
+    """
+    def __init__(self, seed=0, latency=(0.0005, 0.002), loss=0.0, reorder=0.0, reorder_delay=0.01):
+        self.rng = random.Random(seed)
+        self.now = 0.0
+        self.stats = SimStats()
+        self.latency_range = latency
+        self.loss = loss
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.events = 0
+
+        self.tcp = {}  # { (host, port): SimTCPHandler }
+        self.udp = {}  # { (host, port): SimROMulticastHandler }
+        self.broadcast = []
+        self.multicast = []
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._ports = itertools.count(10000)
+        self._hosts = itertools.count(1)
+        self._partitions = None
+        self._handlers = {}  # { id(queue): handle function }
+        self._ready = {}  # ordered set of queues with pending items
+        self._active = set()
+        self._rom_sent = {}
+        self._fifo = {}  # { (source, destination): last delivery time }
+
+    # addressing --------------------------------------------------------------
+
+    def new_host(self):
+        i = next(self._hosts)
+        return f"10.0.{i // 256}.{i % 256}"
+
+    def new_port(self):
+        return next(self._ports)
+
+    def uuid(self):
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+    # faults ------------------------------------------------------------------
+
+    def partition(self, *groups):
+        """Only hosts inside the same group can talk to each other."""
+        self._partitions = [set(group) for group in groups]
+
+    def heal(self):
+        self._partitions = None
+
+    def connected(self, a, b):
+        if self._partitions is None or a == b:
+            return True
+        return any(a in group and b in group for group in self._partitions)
+
+    def latency(self, source, destination):
+        """
+        Messages between the same pair of endpoints arrive in the order they
+        were sent, like on a switched LAN or over sequential TCP connects.
+        With `reorder` some messages get an extra delay and can be overtaken.
+        """
+        at = max(self.now + self.rng.uniform(*self.latency_range), self._fifo.get((source, destination), 0))
+        self._fifo[(source, destination)] = at
+        if self.reorder and self.rng.random() < self.reorder:
+            at += self.rng.uniform(0, self.reorder_delay)
+        return at - self.now
+
+    def lost(self):
+        return self.loss > 0 and self.rng.random() < self.loss
+
+    # scheduling --------------------------------------------------------------
+
+    def schedule(self, delay, function, *args):
+        heapq.heappush(self._heap, (self.now + delay, next(self._seq), function, args))
+
+    def attach(self, server_queue, handle):
+        """Dispatch the items of `server_queue` to `handle` from now on."""
+        self._handlers[id(server_queue)] = (server_queue, handle)
+        if not server_queue.empty():
+            self._ready[id(server_queue)] = None
+
+    def detach(self, server_queue):
+        self._handlers.pop(id(server_queue), None)
+        self._ready.pop(id(server_queue), None)
+
+    def notify(self, server_queue):
+        if id(server_queue) in self._handlers:
+            self._ready[id(server_queue)] = None
+
+    def call(self, server_queue, function, *args):
+        """Run `function` on behalf of the owner of `server_queue`."""
+        self._active.add(id(server_queue))
+        try:
+            return function(*args)
+        finally:
+            self._active.discard(id(server_queue))
+            self.dispatch()
+
+    def dispatch(self):
+        progress = True
+        while progress:
+            progress = False
+            for key in list(self._ready.keys()):
+                if key in self._active or key not in self._ready:
+                    continue
+                del self._ready[key]
+                server_queue, handle = self._handlers[key]
+                self._active.add(key)
+                try:
+                    while not server_queue.empty():
+                        handle(server_queue.get(block=False))
+                finally:
+                    self._active.discard(key)
+                progress = True
+
+    def step(self, deadline=None):
+        """Process the next event, returns False if there is none before `deadline`."""
+        if not self._heap or (deadline is not None and self._heap[0][0] > deadline):
+            return False
+        at, _, function, args = heapq.heappop(self._heap)
+        self.now = max(self.now, at)
+        self.events += 1
+        function(*args)
+        self.dispatch()
+        return True
+
+    def run_until(self, predicate, deadline):
+        """Run events until `predicate` holds or the virtual clock hits `deadline`."""
+        while not predicate():
+            if not self.step(deadline):
+                self.now = max(self.now, deadline)
+                return predicate()
+        return True
+
+    def run_for(self, seconds):
+        self.run_until(lambda: False, self.now + seconds)
+
+    # measurements ------------------------------------------------------------
+
+    def rom_sent(self, id):
+        self._rom_sent.setdefault(id, self.now)
+
+    def rom_delivered(self, id):
+        if id in self._rom_sent:
+            self.stats.observe("rom_delivery", self.now - self._rom_sent[id])
+
+
+class SimQueue:
+    """The subset of `queue.SimpleQueue` the server uses, waking up the network."""
+    def __init__(self, network):
+        self._network = network
+        self._items = deque()
+
+    def put(self, item):
+        self._items.append(item)
+        self._network.notify(self)
+
+    def get(self, block=True, timeout=None):
+        if not self._items:
+            raise queue.Empty
+        return self._items.popleft()
+
+    def empty(self):
+        return not self._items
+
+    def qsize(self):
+        return len(self._items)
+
+
+class SimTimer:
+    """Virtual clock replacement of `RepeatTimer`."""
+    def __init__(self, network, interval, function, args=None):
+        self._network = network
+        self.interval = interval
+        self.function = function
+        self.args = args or []
+        self._cancelled = False
+
+    def start(self):
+        self._network.schedule(self.interval, self._tick)
+
+    def _tick(self):
+        if self._cancelled:
+            return
+        self.function(*self.args)
+        self._network.schedule(self.interval, self._tick)
+
+    def cancel(self):
+        self._cancelled = True
+
+
+class SimCall:
+    """Virtual clock replacement of a one shot `threading.Timer`."""
+    def __init__(self, function, args=None):
+        self.function = function
+        self.args = args or []
+        self._cancelled = False
+
+    def __call__(self):
+        if not self._cancelled:
+            self.function(*self.args)
+
+    def cancel(self):
+        self._cancelled = True
+
+
+class SimTCPHandler(TCPHandler):
+    def __init__(self, network, host, server_queue, timeout=TIMEOUT):
+        SocketThread.__init__(self, server_queue)
+        self._network = network
+        self._address = host
+        self._port = network.new_port()
+        self._timeout = timeout
+        self._open = True
+        self._started = False
+        self._is_paused = False
+        self._inbox = deque()
+        network.tcp[(host, self._port)] = self
+
+        self._logger = logging.getLogger("TCPListener")
+        self._logger.setLevel(LOGGING_LEVEL)
+
+    @property
+    def _paused(self):
+        return self._is_paused
+
+    @_paused.setter
+    def _paused(self, value):
+        self._is_paused = value
+        self._flush()
+
+    def reset_timeout(self):
+        self._timeout = TIMEOUT
+
+    def set_timeout(self, value):
+        self._timeout = value
+
+    def send(self, json_msg, dest):
+        target = self._network.tcp.get(tuple(dest))
+        if target is None or not target._open or not self._network.connected(self._address, dest[0]):
+            return False
+        payload = json.dumps(json_msg)
+        self._network.stats.record("tcp", json_msg.get("intention"), len(payload))
+        delay = self._network.latency((self._address, self._port), tuple(dest))
+        self._network.schedule(delay, target._receive, payload, (self._address, self._port))
+        return True
+
+    def _reply(self, mes, dest):
+        # sending never blocks here, and a thread would break determinism
+        self.send(mes, dest)
+
+    def _receive(self, payload, addr):
+        if not self._open:
+            return
+        self._inbox.append((json.loads(payload), addr))
+        self._flush()
+
+    def _flush(self):
+        if not self._started or self._is_paused:
+            return
+        while self._inbox:
+            data, addr = self._inbox.popleft()
+            self._emit_message(data, addr)
+
+    def listen(self):
+        self._network.run_until(lambda: self._inbox, self._network.now + self._timeout)
+        if self._inbox:
+            return self._inbox.popleft()
+        return None, None
+
+    def start(self):
+        self.stopped = False
+        self._started = True
+        self._flush()
+
+    def join(self):
+        self.stopped = True
+        self.close()
+
+    def close(self):
+        if self._open:
+            self._open = False
+            self._network.tcp.pop((self._address, self._port), None)
+
+
+class SimBroadcastHandler(BroadcastHandler):
+    def __init__(self, network, host, server_queue):
+        SocketThread.__init__(self, server_queue)
+        self._network = network
+        self._host = host
+        self._started = False
+        self._inbox = deque()
+        self._msg_buffer = deque([], maxlen=MAX_MSG_BUFF_SIZE)
+        network.broadcast.append(self)
+
+        self._logger = logging.getLogger("UDPListener")
+        self._logger.setLevel(LOGGING_LEVEL)
+
+    def send(self, msg):
+        msg["msg_uuid"] = self._network.uuid()
+        payload = json.dumps(msg)
+        self._network.stats.record("broadcast", msg.get("intention"), len(payload))
+        for handler in list(self._network.broadcast):
+            if self._network.connected(self._host, handler._host) and not self._network.lost():
+                delay = self._network.latency(self._host, handler._host)
+                self._network.schedule(delay, handler._receive, payload, (self._host, 0))
+
+    def _receive(self, payload, addr):
+        if self.stopped:
+            return
+        self._inbox.append((json.loads(payload), addr))
+        if self._started:
+            while self._inbox:
+                self._on_datagram(*self._inbox.popleft())
+
+    def start(self):
+        self.stopped = False
+        self._started = True
+        while self._inbox:
+            self._on_datagram(*self._inbox.popleft())
+
+    def join(self):
+        self.stopped = True
+        if self in self._network.broadcast:
+            self._network.broadcast.remove(self)
+
+
+class SimROMulticastHandler(ROMulticastHandler):
+    def __init__(self, network, host, id, view, server_queue):
+        self._network = network
+        self._host = host
+        super().__init__(id, view, server_queue)
+
+    def _open_sockets(self, timeout):
+        self._address = (self._host, self._network.new_port())
+        self._started = False
+        self._inbox = deque()
+        self._network.udp[self._address] = self
+        self._network.multicast.append(self)
+
+    def _clock(self):
+        return self._network.now
+
+    def _tick(self):
+        if self.stopped:
+            return
+        self._repair()
+        self._network.schedule(ROM_REPAIR_INTERVAL, self._tick)
+
+    def _transmit(self, payload, handler):
+        if self._network.connected(self._host, handler._host) and not self._network.lost():
+            delay = self._network.latency(self._address, handler._address)
+            self._network.schedule(delay, handler._receive, payload, self._address)
+
+    def _multicast(self, mesg: dict):
+        payload = json.dumps(mesg)
+        self._network.stats.record("rom", mesg.get("purpose"), len(payload))
+        for handler in list(self._network.multicast):
+            self._transmit(payload, handler)
+
+    def _unicast(self, mesg: dict, addr):
+        payload = json.dumps(mesg)
+        self._network.stats.record("rom", mesg.get("purpose"), len(payload))
+        handler = self._network.udp.get(tuple(addr))
+        if handler is not None:
+            self._transmit(payload, handler)
+
+    def send(self, mesg: dict):
+        super().send(mesg)
+        if mesg.get("original") == self._name:
+            self._network.rom_sent(mesg["id"])
+
+    def emit(self, **kwargs):
+        if kwargs.get("signal") == ON_MULTICAST_MESSAGE and "id" in kwargs["data"]:
+            self._network.rom_delivered(kwargs["data"]["id"])
+        super().emit(**kwargs)
+
+    def _receive(self, payload, addr):
+        if self.stopped:
+            return
+        self._inbox.append((json.loads(payload), addr))
+        if self._started:
+            while self._inbox:
+                self._handle(*self._inbox.popleft())
+
+    def start(self):
+        self.stopped = False
+        self._started = True
+        self._network.schedule(ROM_REPAIR_INTERVAL, self._tick)
+        while self._inbox:
+            self._handle(*self._inbox.popleft())
+
+    def join(self):
+        self.stopped = True
+        self._network.udp.pop(self._address, None)
+        if self in self._network.multicast:
+            self._network.multicast.remove(self)
+
+
+class SimTransport:
+    """Drop in replacement of `SocketTransport` for one simulated host."""
+    def __init__(self, network):
+        self._network = network
+        self._host = network.new_host()
+
+    def queue(self):
+        return SimQueue(self._network)
+
+    def tcp_handler(self, server_queue):
+        return SimTCPHandler(self._network, self._host, server_queue)
+
+    def broadcast_handler(self, server_queue):
+        return SimBroadcastHandler(self._network, self._host, server_queue)
+
+    def rom_handler(self, id, view, server_queue, port=None):
+        return SimROMulticastHandler(self._network, self._host, id, view, server_queue)
+
+    def timer(self, interval, function, args=None):
+        return SimTimer(self._network, interval, function, args)
+
+    def call_later(self, delay, function, args=None):
+        call = SimCall(function, args)
+        self._network.schedule(delay, call)
+        return call
+
+    def now(self):
+        return self._network.now
+
+    def sleep(self, seconds):
+        self._network.run_for(seconds)
+
+    def uuid(self):
+        return self._network.uuid()
+
+    def address(self):
+        return self._host
+
+    def hostname(self):
+        return f"sim-{self._host}"
@@ -0,0 +1,170 @@
+import json
+
+from src.client.client import backoff
+from src.server.server import Server
+from src.utils.constants import (AGREEMENT_ENGINE, RETRY_AFTER, Intention,
+                                 State)
+
+from .network import SimNetwork, SimTransport
+
+
+class SimClient:
+    """
+    A TCP endpoint standing in for a turnstile, records decision latency.
+    Requests the servers shed are sent again after a jittered backoff.
+    """
+    def __init__(self, network, namespace=None):
+        self._network = network
+        self.namespace = namespace
+        self.address = network.new_host()
+        self.port = network.new_port()
+        self.uuid = network.uuid()
+        self.decisions = {"accepted": 0, "denied": 0, "left": 0}
+        self.try_again = 0
+        self._pending = []
+        self._requests = {}  # { key: (server, increase, count, attempt) } for TRY_AGAIN
+        self._sent = 0
+        self._open = True
+        network.tcp[(self.address, self.port)] = self
+
+    def request(self, server, increase=True, count=1, key=None, attempt=0):
+        if key is None:
+            self._sent += 1
+            key = f"{self.uuid}/{self._sent}"
+        self._requests[key] = (server, increase, count, attempt)
+        mesg = {
+            "intention": str(Intention.REQUEST_ACTION),
+            "uuid": self.uuid,
+            "address": self.address,
+            "port": self.port,
+            "number": 0,
+            "increase": increase,
+            "count": count,
+        }
+        if self.namespace is not None:
+            mesg["namespace"] = self.namespace
+        mesg["key"] = key
+        if increase and not attempt:
+            self._pending.append(self._network.now)
+        payload = json.dumps(mesg)
+        self._network.stats.record("tcp", mesg["intention"], len(payload))
+        destination = (server._tcp_handler.address, server._tcp_handler.port)
+        self._network.schedule(
+            self._network.latency((self.address, self.port), destination),
+            server._tcp_handler._receive,
+            payload,
+            (self.address, self.port),
+        )
+
+    def _receive(self, payload, addr):
+        data = json.loads(payload)
+        if data["intention"] in (str(Intention.ACCEPT_ENTRY), str(Intention.DENY_ENTRY)):
+            if self._pending:
+                self._network.stats.observe("admission", self._network.now - self._pending.pop(0))
+            key = "accepted" if data["intention"] == str(Intention.ACCEPT_ENTRY) else "denied"
+            self.decisions[key] += 1
+            self._requests.pop(data.get("key"), None)
+        elif data["intention"] == str(Intention.UPDATE_ENTRIES) and data.get("key") in self._requests:
+            self.decisions["left"] += 1
+            self._requests.pop(data["key"])
+        elif data["intention"] == str(Intention.TRY_AGAIN) and data.get("key") in self._requests:
+            self.try_again += 1
+            server, increase, count, attempt = self._requests[data["key"]]
+            delay = backoff(data.get("retry_after", RETRY_AFTER), attempt, self._network.rng)
+            self._network.schedule(delay, self.request, server, increase, count, data["key"], attempt + 1)
+
+
+class Simulation:
+    """
+    Runs many `Server` instances on a `SimNetwork` and measures the protocol.
+    All latencies are in virtual seconds.
+    """
+    def __init__(self, seed=0, agreement=AGREEMENT_ENGINE, **network_options):
+        self.network = SimNetwork(seed, **network_options)
+        self.agreement = agreement
+        self.servers = []
+
+    def add_server(self, **options):
+        """`options` go to the `Server`, e.g. queue_limit and request_limit."""
+        server = Server(agreement=self.agreement, transport=SimTransport(self.network), **options)
+        start = self.network.now
+        self.network.call(server.QUEUE, server.start)
+        self.network.attach(server.QUEUE, server.handle)
+        self.network.stats.observe("join", self.network.now - start)
+        self.servers.append(server)
+        return server
+
+    def crash(self, server):
+        """Stops a server without it saying goodbye."""
+        self.network.detach(server.QUEUE)
+        if server._heartbeat_timer is not None:
+            server._heartbeat_timer.cancel()
+        server._tcp_handler.join()
+        server._broadcast_handler.join()
+        server._rom_handler.join()
+        self.servers.remove(server)
+
+    def leader(self):
+        for server in self.servers:
+            if server._state == State.LEADER:
+                return server
+        return None
+
+    def converged(self):
+        """Every server agrees on one live leader and nobody is in an election."""
+        uuids = set(server._uuid for server in self.servers)
+        leaders = set(server._current_leader for server in self.servers)
+        return (
+            len(leaders) == 1
+            and leaders.pop() in uuids
+            and not any(server._participating for server in self.servers)
+            and all(len(server._group_view) == len(self.servers) for server in self.servers)
+        )
+
+    def run_for(self, seconds):
+        self.network.run_for(seconds)
+
+    def measure(self, name, predicate, timeout):
+        """Runs until `predicate` holds and records how long that took."""
+        start = self.network.now
+        done = self.network.run_until(predicate, start + timeout)
+        if done:
+            self.network.stats.observe(name, self.network.now - start)
+        return done
+
+    def elect(self, timeout=120):
+        """Crashes the leader and measures until the rest converged again."""
+        self.crash(self.leader())
+        return self.measure("election", self.converged, timeout)
+
+    def agree(self, timeout=60):
+        """Forces an agreement run on the leader and waits for every correction."""
+        leader = self.leader()
+        self.network.call(leader.QUEUE, leader._maybe_byzantine, True)
+        return self.measure(
+            "agreement",
+            lambda: leader._byzantine_leader_cache is None and not any(s._byzantine_epochs for s in self.servers),
+            timeout,
+        )
+
+    def admit(self, requests, timeout=60, namespaces=None):
+        """
+        Sends `requests` entry requests round robin to the servers, and to the
+        `namespaces` if given.
+        """
+        clients = [SimClient(self.network, namespace) for namespace in namespaces or [None]]
+        for i in range(requests):
+            clients[i % len(clients)].request(self.servers[i % len(self.servers)])
+        self.network.run_until(lambda: not any(client._pending for client in clients), self.network.now + timeout)
+        return {
+            key: sum(client.decisions[key] for client in clients)
+            for key in ("accepted", "denied")
+        }
+
+    def report(self):
+        return {
+            "servers": len(self.servers),
+            "virtual_time": self.network.now,
+            "events": self.network.events,
+            **self.network.stats.report(),
+        }
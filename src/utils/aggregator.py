@@ -0,0 +1,209 @@
+import csv
+import io
+import json
+import logging
+import queue
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlparse
+
+from src.utils.broadcast_handler import BroadcastHandler
+from src.utils.constants import (LOGGING_LEVEL, METRICS_ADDRESS,
+                                 MONITOR_HISTORY, Intention)
+from src.utils.signals import ON_BROADCAST_MESSAGE
+
+FIELDS = ["time", "uuid", "entries", "clients", "state", "election", "byzantine"]
+
+
+class ServerHistory:
+    """
+    The last `size` states of one server. A sample is only stored when
+    something changed, repeated MONITOR_MESSAGEs just move `last_seen`.
+    """
+    def __init__(self, uuid, size=MONITOR_HISTORY):
+        self.uuid = uuid
+        self.info = {}
+        self.last_seen = None
+        self.samples = deque(maxlen=size)  # (time, entries, clients, state, election, byzantine)
+
+    def add(self, now, data):
+        self.info = {key: data.get(key) for key in ("hostname", "ip", "port")}
+        self.last_seen = now
+        sample = (
+            now,
+            data.get("entries"),
+            len(data.get("clients") or ()),
+            data.get("state"),
+            data.get("election"),
+            data.get("byzantine"),
+        )
+        if not self.samples or self.samples[-1][1:] != sample[1:]:
+            self.samples.append(sample)
+
+    def left(self, now):
+        self.last_seen = now
+        if self.samples and self.samples[-1][3] != "LEFT":
+            self.samples.append((now, None, 0, "LEFT", False, False))
+
+    def snapshot(self):
+        latest = self.samples[-1] if self.samples else (None,) * len(FIELDS[1:])
+        return {
+            "uuid": self.uuid,
+            **self.info,
+            "last_seen": self.last_seen,
+            **dict(zip(FIELDS[2:], latest[1:])),
+        }
+
+    def range(self, since=None, until=None):
+        return [
+            dict(zip(FIELDS, (sample[0], self.uuid) + sample[1:]))
+            for sample in self.samples
+            if (since is None or sample[0] >= since) and (until is None or sample[0] <= until)
+        ]
+
+
+class Aggregator:
+    """Collects MONITOR_MESSAGE broadcasts into a `ServerHistory` per server."""
+    def __init__(self, size=MONITOR_HISTORY, clock=time.time):
+        self.size = size
+        self._clock = clock
+        self._servers = {}
+        self._lock = Lock()
+
+    def add(self, data):
+        if data.get("intention") != str(Intention.MONITOR_MESSAGE):
+            return
+        now = self._clock()
+        with self._lock:
+            if data.get("view_version") is not None:
+                # what the leader changed in the group view
+                for uuid in data["joined"]:
+                    self._history(uuid)
+                for uuid in data["left"]:
+                    self._history(uuid).left(now)
+            elif data.get("leaving"):
+                self._history(data["uuid"]).left(now)
+            else:
+                self._history(data["uuid"]).add(now, data)
+
+    def _history(self, uuid):
+        history = self._servers.get(uuid)
+        if history is None:
+            history = self._servers[uuid] = ServerHistory(uuid, self.size)
+        return history
+
+    def snapshot(self):
+        with self._lock:
+            servers = [history.snapshot() for history in self._servers.values()]
+        active = [s for s in servers if s["state"] not in (None, "LEFT")]
+        return {
+            "time": self._clock(),
+            "servers": servers,
+            "active": len(active),
+            "leaders": sum(1 for s in active if s["state"] == "LEADER"),
+            "elections": sum(1 for s in active if s["election"]),
+            # every server reports the replicated count, they should agree
+            "entries": sorted({s["entries"] for s in active if s["entries"] is not None}),
+        }
+
+    def history(self, uuid=None, since=None, until=None):
+        with self._lock:
+            if uuid is None:
+                histories = list(self._servers.values())
+            else:
+                histories = [self._servers[uuid]] if uuid in self._servers else []
+            rows = [row for history in histories for row in history.range(since, until)]
+        rows.sort(key=lambda row: row["time"])
+        return rows
+
+    def to_csv(self, rows, f):
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    def consume(self, items):
+        """Blocks on the queue of a `BroadcastHandler`, run it in a thread."""
+        while True:
+            item = items.get()
+            if item is None:
+                return
+            if item.signal == ON_BROADCAST_MESSAGE:
+                self.add(item.kwargs["data"])
+
+
+# http api --------------------------------------------------------------------
+
+class _AggregatorRequestHandler(BaseHTTPRequestHandler):
+    aggregator = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            since = float(query["since"]) if "since" in query else None
+            until = float(query["until"]) if "until" in query else None
+        except ValueError:
+            self.send_error(400, "since and until are unix timestamps")
+            return
+
+        if url.path in ("/", "/snapshot"):
+            self._reply("application/json", json.dumps(self.aggregator.snapshot()))
+        elif url.path == "/history":
+            rows = self.aggregator.history(query.get("uuid"), since, until)
+            self._reply("application/json", json.dumps(rows))
+        elif url.path == "/history.csv":
+            f = io.StringIO()
+            self.aggregator.to_csv(self.aggregator.history(query.get("uuid"), since, until), f)
+            self._reply("text/csv", f.getvalue())
+        else:
+            self.send_error(404)
+
+    def _reply(self, content_type, body):
+        body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_headless(port, csv_path=None, address=METRICS_ADDRESS, seeds=None, gossip_port=0):
+    """
+    Monitor without a display: keeps the history of every server and serves
+    /snapshot, /history and /history.csv (?uuid=&since=&until=) on
+    http://address:port until interrupted. Writes the whole history to
+    `csv_path` on the way out. With `seeds` the servers are found by gossip
+    on `gossip_port` instead of by broadcast.
+    """
+    logger = logging.getLogger("Aggregator")
+    logger.setLevel(LOGGING_LEVEL)
+
+    aggregator = Aggregator()
+    items = queue.SimpleQueue()
+    broadcast_handler = BroadcastHandler(items, seeds=seeds, port=gossip_port)
+    broadcast_handler.start()
+    consumer = Thread(target=aggregator.consume, args=(items,), daemon=True)
+    consumer.start()
+
+    handler = type("AggregatorRequestHandler", (_AggregatorRequestHandler,), {"aggregator": aggregator})
+    httpd = ThreadingHTTPServer((address, port), handler)
+    httpd.daemon_threads = True
+    logger.info("Serving the cluster history on http://%s:%s/snapshot", address, httpd.server_address[1])
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        broadcast_handler.join()
+        items.put(None)
+        consumer.join(1)
+        if csv_path is not None:
+            with open(csv_path, "w", newline="") as f:
+                aggregator.to_csv(aggregator.history(), f)
+            logger.info("Wrote history to %s", csv_path)
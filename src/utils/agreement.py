@@ -0,0 +1,330 @@
+import hashlib
+import hmac
+import json
+import os
+from collections import Counter, defaultdict
+
+from src.utils.byzantine import ByzantineMemberCache
+from src.utils.constants import AGREEMENT_KEY_FILE
+
+
+def majority(values):
+    """Most common value, ties are broken the same way on every member."""
+    c = Counter(values)
+    return sorted(c.items(), key=lambda kv: (-kv[1], str(kv[0])))[0]
+
+
+class Keyring:
+    """
+    Pairwise HMAC keys used by the signed message engine.
+    The key file is a json object mapping the uuid of every other server to
+    the hex encoded key this server shares with it, so it needs stable uuids
+    (`--data-dir`). A signature is a tag per recipient, nobody but the signer
+    can produce a tag the recipient accepts. Unlike public key signatures a
+    faulty signer can hand out tags only some recipients accept, which makes
+    its message invalid for the others but never forges anyone elses.
+    """
+    def __init__(self, keys):
+        self._keys = {uuid: bytes.fromhex(key) for uuid, key in keys.items()}
+
+    @classmethod
+    def load(cls, path=AGREEMENT_KEY_FILE):
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def _tag(self, uuid, message):
+        return hmac.new(self._keys[uuid], message, hashlib.sha256).hexdigest()
+
+    def sign(self, message, recipients):
+        """Tags `message` for every recipient we share a key with."""
+        return {uuid: self._tag(uuid, message) for uuid in recipients if uuid in self._keys}
+
+    def verify(self, signer, me, message, signature):
+        """Checks the tag `signer` made for us, unlisted signers are rejected."""
+        if signer not in self._keys or not isinstance(signature, dict) or me not in signature:
+            return False
+        return hmac.compare_digest(self._tag(signer, message), str(signature[me]))
+
+
+_keyring = None
+
+
+def get_keyring():
+    global _keyring
+    if _keyring is None:
+        _keyring = Keyring.load()
+    return _keyring
+
+
+class AgreementEngine:
+    """
+    Member side of a single agreement run.
+    The leader builds the first message with `initial`, afterwards every
+    received message is handed to `add` and `advance` returns the messages we
+    have to send as (uuid, payload) tuples. Once `done` is set `result` holds
+    the value we report back to the leader, or `error` says why we could not
+    take part.
+    """
+    name = None
+
+    def __init__(self, id, me, value):
+        self.id = id
+        self.me = me
+        self.value = value
+        self.done = False
+        self.result = None
+        self.error = None
+
+    @classmethod
+    def available(cls):
+        return True
+
+    @classmethod
+    def initial(cls, id, leader, members, value, faulty):
+        raise NotImplementedError
+
+    def add(self, om):
+        raise NotImplementedError
+
+    def advance(self):
+        raise NotImplementedError
+
+    def _finish(self, result):
+        self.done = True
+        self.result = result
+
+    def _abort(self, error):
+        self.done = True
+        self.error = error
+
+
+class OralMessagesEngine(AgreementEngine):
+    """Lamports OM(f), O(n^2 * f) messages thanks to round batching."""
+    name = "om"
+
+    def __init__(self, id, me, value):
+        super().__init__(id, me, value)
+        self._cache = ByzantineMemberCache(id)
+
+    @classmethod
+    def initial(cls, id, leader, members, value, faulty):
+        return {"round": 1, "members": members, "faulty": faulty, "entries": [[[], value]]}
+
+    def add(self, om):
+        self._cache.add(om)
+
+    def advance(self):
+        out = [
+            (uuid, {"round": round, "entries": entries})
+            for uuid, round, entries in self._cache.advance(self.me, self.value)
+        ]
+        if self._cache.is_full():
+            self._finish(self._cache.tree.complete())
+        return out
+
+
+class PhaseKingEngine(AgreementEngine):
+    """
+    Phase king on the leaders value.
+    The leader sends its value to every member, the members then run the
+    three round phase king among themselves with it as their input, so like
+    OM(f) they agree on the leaders value when it is correct and on one
+    common value when it is not. Every phase a member keeps a value that
+    p - f of the p participants sent twice and otherwise takes the value of
+    that phases king. A faulty leader leaves at most f - 1 faulty
+    participants, so this holds for f < n / 3 like OM(f). Uses the f passed
+    by the leader and needs f + 1 phases of three steps, O(p^2 * f)
+    messages in total. None means no value got enough support, the server
+    keeps its entries then.
+    """
+    name = "king"
+
+    def __init__(self, id, me, value):
+        super().__init__(id, me, value)
+        self.participants = None
+        self.faulty = 0
+        self.phase = 0
+        self.step = 1
+        self._sent = False
+        self._strong = False
+        self._pending = defaultdict(dict)  # { (phase, step): { sender: v } }
+
+    @classmethod
+    def initial(cls, id, leader, members, value, faulty):
+        return {"phase": -1, "members": members, "leader": leader, "faulty": faulty, "value": value}
+
+    def add(self, om):
+        if om["phase"] == -1:
+            self.participants = sorted(set(om["members"]) - set([om["leader"]]))
+            self.faulty = om["faulty"]
+            self.value = om["value"]
+            return
+        self._pending[(om["phase"], om["step"])][om["from"]] = om["v"]
+
+    def _king(self):
+        return self.participants[self.phase % len(self.participants)]
+
+    def _others(self):
+        return [uuid for uuid in self.participants if uuid != self.me]
+
+    def _send(self, out, step, value, to):
+        self._pending[(self.phase, step)][self.me] = value
+        for uuid in to:
+            out.append((uuid, {"phase": self.phase, "step": step, "v": value}))
+
+    def _supported(self):
+        """The value most participants sent in this step and how many did, None if nobody sent one."""
+        values = [v for v in self._pending[(self.phase, self.step)].values() if v is not None]
+        return majority(values) if values else (None, 0)
+
+    def advance(self):
+        out = []
+        while self.participants is not None and not self.done:
+            if not self._sent and self.step < 3:
+                self._sent = True
+                self._send(out, self.step, self.value, self._others())
+            if self.step < 3:
+                if not set(self.participants).issubset(self._pending[(self.phase, self.step)].keys()):
+                    break
+                value, mult = self._supported()
+                if self.step == 1:
+                    # p - f of the same value can only ever be one value
+                    self.value = value if mult >= len(self.participants) - self.faulty else None
+                else:
+                    self.value = value if mult > self.faulty else None
+                    self._strong = mult >= len(self.participants) - self.faulty
+                    if self._king() == self.me:
+                        self._send(out, 3, self.value, self._others())
+                self.step += 1
+                self._sent = False
+                continue
+
+            received = self._pending[(self.phase, 3)]
+            if self._king() not in received:
+                break
+            if not self._strong:
+                self.value = received[self._king()]
+
+            for step in (1, 2, 3):
+                del self._pending[(self.phase, step)]
+            self.phase += 1
+            self.step = 1
+            if self.phase > self.faulty:
+                self._finish(self.value)
+        return out
+
+
+class SignedMessagesEngine(AgreementEngine):
+    """
+    Dolev-Strong style SM(f) with chains of pairwise HMAC signatures.
+    Every member relays at most two distinct values, so a run costs
+    O(n^2 * f) messages independent of how many paths OM(f) would take.
+    Without a valid value from the leader every member decides None, no
+    agreement, the server keeps its entries then.
+    """
+    name = "signed"
+
+    def __init__(self, id, me, value):
+        super().__init__(id, me, value)
+        self.members = None
+        self.leader = None
+        self.faulty = 0
+        self.round = 1
+        self._extracted = []
+        self._pending = defaultdict(dict)  # { round: { sender: values } }
+        self._keyring = get_keyring()
+
+    @classmethod
+    def available(cls):
+        return get_keyring() is not None
+
+    @staticmethod
+    def _message(id, value, signers):
+        return json.dumps([id, value, signers]).encode()
+
+    @classmethod
+    def initial(cls, id, leader, members, value, faulty):
+        recipients = [uuid for uuid in members if uuid != leader]
+        signature = get_keyring().sign(cls._message(id, value, [leader]), recipients)
+        return {
+            "round": 1,
+            "members": members,
+            "faulty": faulty,
+            "values": [[value, [[leader, signature]]]],
+        }
+
+    def add(self, om):
+        if om["round"] == 1:
+            self.members = om["members"]
+            self.leader = om["from"]
+            self.faulty = om["faulty"]
+        self._pending[om["round"]][om["from"]] = om["values"]
+
+    def _valid(self, value, chain, sender):
+        signers = [signer for signer, _ in chain]
+        if len(chain) != self.round or signers[0] != self.leader or signers[-1] != sender:
+            return False
+        if len(set(signers)) != len(signers) or self.me in signers:
+            return False
+        for i, (signer, signature) in enumerate(chain):
+            message = self._message(self.id, value, signers[:i + 1])
+            if not self._keyring.verify(signer, self.me, message, signature):
+                return False
+        return True
+
+    def _expected(self):
+        if self.round == 1:
+            return set([self.leader])
+        return set(self.members) - set([self.leader, self.me])
+
+    def advance(self):
+        out = []
+        if self._keyring is None and not self.done:
+            self._abort(f"no key file at {AGREEMENT_KEY_FILE}, cannot verify signatures")
+            return out
+        while self.members is not None and not self.done:
+            received = self._pending[self.round]
+            if not self._expected().issubset(received.keys()):
+                break
+
+            relays = []
+            for sender in sorted(received.keys()):
+                for value, chain in received[sender]:
+                    if value in self._extracted or len(self._extracted) >= 2:
+                        continue
+                    if not self._valid(value, chain, sender):
+                        continue
+                    self._extracted.append(value)
+                    signers = [signer for signer, _ in chain] + [self.me]
+                    recipients = set(self.members) - set(signers)
+                    signature = self._keyring.sign(self._message(self.id, value, signers), recipients)
+                    relays.append([value, chain + [[self.me, signature]]])
+
+            del self._pending[self.round]
+            self.round += 1
+            if self.round > self.faulty + 1:
+                if len(self._extracted) == 1:
+                    self._finish(self._extracted[0])
+                elif self._extracted:
+                    # the leader equivocated, every correct member saw the same set
+                    self._finish(sorted(self._extracted, key=str)[0])
+                else:
+                    # the leader was silent or faulty, our own value isn't common
+                    self._finish(None)
+                break
+
+            for uuid in sorted(set(self.members) - set([self.leader, self.me])):
+                values = [
+                    relay for relay in relays
+                    if uuid not in [signer for signer, _ in relay[1]]
+                ]
+                out.append((uuid, {"round": self.round, "values": values}))
+        return out
+
+
+ENGINES = {
+    engine.name: engine
+    for engine in (OralMessagesEngine, PhaseKingEngine, SignedMessagesEngine)
+}
@@ -1,50 +1,103 @@
 import json
 import logging
+import random
 import socket
 import sys
+import time
 import uuid
 from collections import deque
 
-from src.utils.common import SocketThread
-from src.utils.constants import (BROADCAST_PORT, BUFFER_SIZE, LOGGING_LEVEL,
-                                 MAX_MSG_BUFF_SIZE, TIMEOUT)
+from src.utils.common import SocketThread, get_real_ip
+from src.utils.constants import (BROADCAST_PORT, BUFFER_SIZE, GOSSIP_FANOUT,
+                                 GOSSIP_INTERVAL, LOGGING_LEVEL,
+                                 MAX_MSG_BUFF_SIZE, PEER_TIMEOUT, TIMEOUT,
+                                 Intention)
+from src.utils.metrics import count_message
 from src.utils.signals import ON_BROADCAST_MESSAGE
 
+# broadcasts only servers send, their senders are peers like the ones in a GOSSIP
+SERVER_INTENTIONS = frozenset(
+    str(intention) for intention in (Intention.IDENT_SERVER, Intention.MONITOR_MESSAGE, Intention.MONITOR_STATS)
+)
+
+
+def parse_seeds(value, port=BROADCAST_PORT):
+    """"host[:port],host[:port]" to a list of (ip, port), hosts are resolved once."""
+    seeds = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, seed_port = item.partition(":")
+        seeds.append((socket.gethostbyname(host), int(seed_port) if seed_port else port))
+    return seeds
+
 
 class BroadcastHandler(SocketThread):
     """
     For handling broadcasts for a participant.
     Expects and returns json data due to our implementation choices.
+
+    With `seeds` there is no broadcast domain: the socket listens on `port`
+    (0 for any), messages are sent to every known peer one by one and the
+    peers are learned from the seeds by gossip. Every GOSSIP_INTERVAL the
+    peer list goes to GOSSIP_FANOUT random peers, split into datagrams of at
+    most BUFFER_SIZE bytes. Peers nobody heard of for PEER_TIMEOUT are
+    dropped, seeds never are. Only senders of a GOSSIP or of a server
+    broadcast become peers, a client asking for a server does not.
     """
-    def __init__(self, server_queue):
+    def __init__(self, server_queue, seeds=None, port=BROADCAST_PORT):
         """Set up a socket for this listener."""
         super().__init__(server_queue)
         self.listen_socket = socket.socket(
             socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP
         )
-        # Set the socket to broadcast and enable reusing addresses
-        if sys.platform == "win32":
-            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        else:
-            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self._unicast = bool(seeds)
+        if not self._unicast:
+            # Set the socket to broadcast and enable reusing addresses
+            if sys.platform == "win32":
+                self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            else:
+                self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            port = BROADCAST_PORT
         # Bind socket to address and port
-        self.listen_socket.bind(("", BROADCAST_PORT))
+        self.listen_socket.bind(("", port))
         self.listen_socket.settimeout(TIMEOUT)
 
         socketname = self.listen_socket.getsockname()
+        self.port = socketname[1]
 
         self._msg_buffer = deque([], maxlen=MAX_MSG_BUFF_SIZE)
+        self._local = self._local_addresses(seeds or ())
+        # the first server of a cluster is usually one of the seeds itself
+        self._seeds = {seed for seed in seeds or () if not self._is_self(seed)}
+        self._peers = {seed: time.monotonic() for seed in self._seeds}  # { (ip, port): last heard of }
+        self._gossiped_at = 0
+        self._random = random.Random()
 
         self._logger = logging.getLogger(f"UDPListener")
         self._logger.setLevel(LOGGING_LEVEL)
-        self._logger.debug(f"Binding to addr: {':'.join(map(str, socketname))}")
+        self._logger.debug("Binding to addr: %s", ':'.join(map(str, socketname)))
+
+    @property
+    def peers(self):
+        return list(self._peers)
 
     def send(self, msg):
         """Broadcasts json data to all participants."""
         port = BROADCAST_PORT
         msg["msg_uuid"] = str(uuid.uuid4())
 
+        if self._unicast:
+            # our own copy would come back through peers that know us
+            self._msg_buffer.append(msg["msg_uuid"])
+            payload = str.encode(json.dumps(msg))
+            for peer in self.peers:
+                self._sendto(payload, peer)
+            count_message("broadcast", "out", msg, len(payload))
+            return
+
         # Create a UDP socket
         broadcast_socket = socket.socket(
             socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP
@@ -55,29 +108,119 @@ class BroadcastHandler(SocketThread):
         else:
             broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        broadcast_socket.sendto(
-            str.encode(json.dumps(msg)), ("<broadcast>", port)
-        )
+        payload = str.encode(json.dumps(msg))
+        broadcast_socket.sendto(payload, ("<broadcast>", port))
+        count_message("broadcast", "out", msg, len(payload))
         broadcast_socket.close()
 
+    def _sendto(self, payload, peer):
+        # from the listening socket, so the receiver learns where we listen
+        try:
+            self.listen_socket.sendto(payload, peer)
+        except OSError as e:
+            self._logger.debug("Could not reach peer %s: %s", peer, e)
+
+    def _gossip(self):
+        now = time.monotonic()
+        for peer, heard in list(self._peers.items()):
+            if peer not in self._seeds and now - heard > PEER_TIMEOUT:
+                del self._peers[peer]
+        peers = self.peers
+        if not peers:
+            return
+        # ages instead of times, the clocks of the peers don't matter
+        entries = [[ip, port, round(now - heard, 3)] for (ip, port), heard in self._peers.items()]
+        targets = self._random.sample(peers, min(GOSSIP_FANOUT, len(peers)))
+        for mesg, payload in self._gossip_pages(entries):
+            for peer in targets:
+                self._sendto(payload, peer)
+            count_message("broadcast", "out", mesg, len(payload))
+        self._gossiped_at = now
+
+    @staticmethod
+    def _gossip_pages(entries, size=BUFFER_SIZE):
+        """Splits the peer list into GOSSIP messages that fit into one datagram each."""
+        page = []
+        for entry in entries:
+            candidate = {"intention": str(Intention.GOSSIP), "peers": page + [entry]}
+            if page and len(json.dumps(candidate)) > size:
+                mesg = {"intention": str(Intention.GOSSIP), "peers": page}
+                yield mesg, str.encode(json.dumps(mesg))
+                page = [entry]
+            else:
+                page.append(entry)
+        if page:
+            mesg = {"intention": str(Intention.GOSSIP), "peers": page}
+            yield mesg, str.encode(json.dumps(mesg))
+
+    def _on_gossip(self, data):
+        now = time.monotonic()
+        for entry in data.get("peers", ()):
+            try:
+                ip, port, age = entry
+                peer = (str(ip), int(port))
+                heard = now - float(age)
+            except (TypeError, ValueError):
+                continue
+            if not self._is_self(peer):
+                self._peers[peer] = max(self._peers.get(peer, 0), heard)
+
+    def _is_self(self, peer):
+        return peer[1] == self.port and peer[0] in self._local
+
+    def _local_addresses(self, seeds):
+        addresses = {"127.0.0.1", "0.0.0.0"}
+        addresses.update(get_real_ip(ip) for ip, _ in seeds)
+        try:
+            addresses.update(socket.gethostbyname_ex(socket.gethostname())[2])
+        except OSError:
+            pass
+        return addresses
+
+    def _on_datagram(self, loaded_data, addr):
+        if loaded_data.get("msg_uuid") in self._msg_buffer:
+            return
+        self._msg_buffer.append(loaded_data["msg_uuid"])
+        self.emit(
+            signal=ON_BROADCAST_MESSAGE,
+            data=loaded_data,
+            addr=addr,
+        )
+
+    def _on_receive(self, data, addr):
+        try:
+            loaded_data = json.loads(data.decode())
+        except ValueError:
+            self._logger.debug("Ignoring a datagram from %s that is no json.", addr)
+            return
+        if not isinstance(loaded_data, dict):
+            return
+        count_message("broadcast", "in", loaded_data, len(data))
+        if self._unicast:
+            intention = loaded_data.get("intention")
+            if intention == str(Intention.GOSSIP):
+                self._peers[addr] = time.monotonic()
+                self._on_gossip(loaded_data)
+                return
+            if intention in SERVER_INTENTIONS:
+                self._peers[addr] = time.monotonic()
+        if "msg_uuid" in loaded_data:
+            self._on_datagram(loaded_data, addr)
+
     def run(self):
         #self._logger.debug("Listening to broadcast messages")
         while not self.stopped:
+            if self._unicast and time.monotonic() - self._gossiped_at >= GOSSIP_INTERVAL:
+                self._gossip()
             try:
                 data, addr = self.listen_socket.recvfrom(BUFFER_SIZE)
             except socket.timeout:
                 continue
+            except OSError:
+                # e.g. a peer that is gone, reported on the next receive
+                continue
             if data:
-                loaded_data = json.loads(data.decode())
-                if loaded_data.get("msg_uuid") in self._msg_buffer:
-                    continue
-                else:
-                    self._msg_buffer.append(loaded_data["msg_uuid"])
-                self.emit(
-                    signal=ON_BROADCAST_MESSAGE,
-                    data=loaded_data,
-                    addr=addr,
-                )
+                self._on_receive(data, addr)
 
         self._logger.debug("Shutting down.")
 
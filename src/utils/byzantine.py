@@ -1,5 +1,5 @@
 import math
-from collections import Counter
+from collections import Counter, defaultdict
 from enum import Enum
 
 
@@ -69,10 +69,90 @@ class ByzantineLeaderCache:
         self.counter = Counter()
 
 
+def compress_path(path, index):
+    """
+    Strip a relay path down to what the receiver can't infer itself.
+    The head of the path is always the sender of the round message and the
+    tail is always the leader, so only the member indices in between are sent.
+    """
+    return [index[uuid] for uuid in path[1:-1]]
+
+
+def expand_path(sender, compressed, members, leader):
+    """Inverse of `compress_path`."""
+    if sender == leader:
+        return [leader]
+    return [sender] + [members[i] for i in compressed] + [leader]
+
+
 class ByzantineMemberCache:
-    def __init__(self, id, n):
+    """
+    Round based bookkeeping of a member during OM(f).
+    Round 1 is the leaders value, every following round a member receives one
+    aggregated message per peer containing all values that peer owes it. A
+    round is only processed after the previous one is complete so that every
+    path finds its parent in the tree.
+    """
+    def __init__(self, id):
         self.id = id
-        self.tree = ByzantineTree(n)
+        self.tree = None
+        self.members = None
+        self.leader = None
+        self.faulty = 0
+        self.round = 1
+        self._index = {}
+        self._pending = defaultdict(dict)  # { round: { sender: entries } }
+
+    @property
+    def started(self):
+        return self.tree is not None
+
+    def is_full(self):
+        return self.started and self.tree.is_full()
+
+    def add(self, om):
+        if om["round"] == 1:
+            self.members = om["members"]
+            self.leader = om["from"]
+            self.faulty = om["faulty"]
+            self._index = {uuid: i for i, uuid in enumerate(self.members)}
+            self.tree = ByzantineTree(len(self.members))
+        self._pending[om["round"]][om["from"]] = om["entries"]
+
+    def _expected(self, me):
+        if self.round == 1:
+            return set([self.leader])
+        return set(self.members) - set([self.leader, me])
+
+    def advance(self, me, v):
+        """
+        Processes every complete round and returns the messages we owe our
+        peers as a list of (uuid, round, entries) tuples.
+        """
+        out = []
+        while self.started and self.round <= self.faulty + 1:
+            received = self._pending[self.round]
+            if not self._expected(me).issubset(received.keys()):
+                break
+
+            relays = {}
+            for sender in sorted(received.keys()):
+                for compressed, value in received[sender]:
+                    path = expand_path(sender, compressed, self.members, self.leader)
+                    self.tree.push(list(path), value)
+                    if self.round <= self.faulty:
+                        for uuid in self.members:
+                            if uuid != me and uuid not in path:
+                                relays.setdefault(uuid, []).append(
+                                    [compress_path([me] + path, self._index), v]
+                                )
+
+            del self._pending[self.round]
+            self.round += 1
+            if self.round <= self.faulty + 1:
+                for uuid in sorted(set(self.members) - set([self.leader, me])):
+                    out.append((uuid, self.round, relays.get(uuid, [])))
+        return out
 
 
 class ByzantineStates(Enum):
@@ -1,3 +1,4 @@
+import math
 import socket
 from threading import Thread, Timer
 
@@ -54,10 +55,47 @@ class RepeatTimer(Timer):
         while not self.finished.wait(self.interval):
             self.function(*self.args, **self.kwargs)
 
-def get_real_ip():
+def get_real_ip(target="1.1.1.1"):
+    """
+    Address of the interface that routes to `target`. Connecting a UDP socket
+    sends nothing, but needs a route, without one (offline, isolated racks)
+    the addresses of the hostname are tried before falling back to loopback.
+    """
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.connect(('1.1.1.1', 1))
-    return sock.getsockname()[0]
+    try:
+        sock.connect((target, 1))
+        return sock.getsockname()[0]
+    except OSError:
+        pass
+    finally:
+        sock.close()
+    try:
+        addresses = socket.gethostbyname_ex(socket.gethostname())[2]
+    except OSError:
+        addresses = []
+    for address in addresses:
+        if not address.startswith("127."):
+            return address
+    return "127.0.0.1"
 
 def get_hostname():
     return socket.gethostname()
+
+def percentile(values, q):
+    """Nearest rank percentile of an already sorted list."""
+    if not values:
+        return None
+    rank = max(0, math.ceil(q / 100 * len(values)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p99": percentile(values, 99),
+        "max": values[-1],
+    }
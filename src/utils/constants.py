@@ -1,4 +1,5 @@
 import logging
+import os
 from enum import Enum
 
 BROADCAST_IP = "192.168.0.255"
@@ -8,11 +9,64 @@ MULTICAST_PORT = 5007
 TIMEOUT = 0.1
 MAX_TRIES = 3
 MAX_ENTRIES = 20
+DEFAULT_NAMESPACE = "default"  # namespace of clients that don't pick one
+NAMESPACE_CAPACITIES = {}  # { namespace: capacity }, namespaces not listed get MAX_ENTRIES
+HASH_REPLICAS = 64  # points per server on the ring that assigns namespaces to servers
 BUFFER_SIZE = 1024
+TCP_WORKER_START_TIMEOUT = 10  # seconds a TCP worker process may take to listen
+QUEUE_LIMIT = 5000  # server queue items above which client requests are answered with TRY_AGAIN, 0 for none
+REQUEST_QUEUE_LIMIT = 500  # requests waiting for the lock of a namespace, further ones get TRY_AGAIN, 0 for none
+RETRY_AFTER = 0.2  # seconds a client is told to wait after TRY_AGAIN
+TRY_AGAIN_BACKLOG = 1000  # TRY_AGAINs waiting to be sent, further shed clients get none and time out
+RETRY_BACKOFF_MAX = 5  # seconds a client waits at most between TRY_AGAINs of one request
 MAX_MSG_BUFF_SIZE = 50
 HEARTBEAT_TIMEOUT = 10  # seconds
 MAX_TIMEOUTS = 2
 LOGGING_LEVEL = logging.INFO
+AGREEMENT_ENGINE = "om"  # one of om, king, signed
+AGREEMENT_SAFETY_INTERVAL = 300  # seconds between agreement runs without divergence
+AGREEMENT_PENDING_RUNS = 2  # runs a member keeps early messages of until their epoch mark
+DIGEST_HISTORY = 256  # number of state digests the leader keeps to compare heartbeats
+DELTA_HISTORY = 1024  # entry updates the leader keeps to catch up restarted servers
+WAL_SIZE = 1 << 20  # bytes the write-ahead log is created with, it doubles when full
+WAL_SYNC_INTERVAL = 0.05  # seconds between msyncs of the write-ahead log, 0 syncs every record
+SNAPSHOT_EVERY = 10000  # write-ahead log records between snapshots
+STATE_CHUNK_SIZE = 16384  # characters of serialized state per STATE_CHUNK
+STATE_TRANSFERS = 8  # joins the leader keeps the state snapshot of for resuming
+ROM_TRANSFER_BUFFER = 10000  # ROM messages a joiner holds back during the state transfer
+ROM_REPAIR_INTERVAL = 0.5  # seconds between resending proposals and NACKs that got no answer
+ROM_FINISHED_HISTORY = 10000  # FIN_SEQs a sender remembers to answer proposals sent again
+JOIN_WINDOW = 0.2  # seconds the leader collects join requests to admit them together
+JOIN_BATCH_MAX = 64  # joins admitted at once, a full batch doesn't wait for the window
+JOIN_WAIT = 2  # seconds a starting server waits for a leader without a cached join time
+JOIN_WAIT_MIN = 0.5  # seconds a starting server waits for a leader at least, with a cached join time
+JOIN_WAIT_FACTOR = 4  # times the last join took, how long a starting server waits for a leader
+MEMBERS_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".admission_handler", "members.json")
+GOSSIP_INTERVAL = 1  # seconds between peer lists sent to other peers when discovering by seeds
+GOSSIP_FANOUT = 3  # peers each peer list is sent to
+PEER_TIMEOUT = 30  # seconds after which a peer nobody heard of is forgotten, seeds never are
+TRACE_SAMPLE_RATE = 0.01  # share of client requests traced once a trace file is set
+TRACE_MAX_PER_MESSAGE = 8  # trace ids carried on one ROM message, keeps it below BUFFER_SIZE
+DEDUP_CACHE_SIZE = 4096  # decisions every server remembers by the idempotency key of their request
+DEDUP_PER_MESSAGE = 8  # decisions carried on one ROM message, keeps it below BUFFER_SIZE
+DIAGNOSTICS_CHUNK_SIZE = 16384  # characters of a diagnostics result per TCP message
+DIAGNOSTICS_MAX_SECONDS = 60  # longest profile a diagnostics request can ask for
+DIAGNOSTICS_MAX_LIMIT = 200  # most functions, stacks or allocation sites in a diagnostics result
+METRICS_ADDRESS = "127.0.0.1"  # the scrape endpoint is local only
+MONITOR_FRAME_INTERVAL = 16  # ms, the monitor applies received updates at most once per frame
+MONITOR_HISTORY = 10000  # state changes the headless monitor keeps per server
+MONITOR_HTTP_PORT = 9465  # headless monitor api, on METRICS_ADDRESS
+MONITOR_STATS_INTERVAL = 1  # seconds between the stats a server broadcasts for the monitor
+MONITOR_STATS_HISTORY = 300  # stats the monitor charts per server
+LOG_FORMAT = "%(levelname)s %(name)s - %(message)s"
+LOG_QUEUE_SIZE = 10000  # records waiting for the writer thread, further records are dropped
+LOG_RATE_LIMIT = (20, 100)  # records per second and burst per message template below WARNING
+LOG_SAMPLING = {  # message template: keep one record in n
+    "Received heartbeat from %s.": 100,
+    "Checking heartbeats.": 10,
+    "skipping message %s from %s with %s and %s": 100,
+}
+AGREEMENT_KEY_FILE = os.path.join(os.path.expanduser("~"), ".admission_handler", "agreement_keys.json")
 
 class State(Enum):
     PENDING = 0
@@ -48,6 +102,15 @@ class Intention(Enum):
     OM_RESTART = 25
     MANUAL_VALUE_OVERRIDE = 26
     RUN_BYZ = 27
+    BYZ_EPOCH = 28
+    DIAGNOSTICS = 29
+    DIAGNOSTICS_RESULT = 30
+    MONITOR_STATS = 31
+    STATE_REQUEST = 32
+    STATE_CHUNK = 33
+    VIEW_SYNC = 34
+    GOSSIP = 35
+    DECISIONS = 36
 
 class LockState(Enum):
     OPEN = 0
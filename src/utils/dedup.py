@@ -0,0 +1,46 @@
+import hashlib
+from collections import OrderedDict
+
+from src.utils.constants import DEDUP_CACHE_SIZE, DEDUP_PER_MESSAGE
+
+
+def short_key(key):
+    """Idempotency keys are chosen by clients, 12 hex characters of their hash go over ROM."""
+    return hashlib.blake2b(str(key).encode(), digest_size=6).hexdigest()
+
+
+class DecisionCache:
+    """
+    The last `size` decisions ("accepted", "denied" or "left") by the short
+    idempotency key of their request. The decisions travel with the entry
+    updates, so every server has the ones of a namespace before it can take
+    the namespace lock after them.
+    """
+    def __init__(self, size=DEDUP_CACHE_SIZE):
+        self.size = size
+        self._decisions = OrderedDict()
+
+    def __len__(self):
+        return len(self._decisions)
+
+    def get(self, key):
+        return self._decisions.get(key)
+
+    def add(self, key, decision):
+        self._decisions[key] = decision
+        self._decisions.move_to_end(key)
+        while len(self._decisions) > self.size:
+            self._decisions.popitem(last=False)
+
+    def update(self, decisions):
+        for key, decision in decisions.items():
+            self.add(key, decision)
+
+    def items(self):
+        return list(self._decisions.items())
+
+
+def chunked(decisions, size=DEDUP_PER_MESSAGE):
+    """Splits { key: decision } into dicts of at most `size`, one per ROM message."""
+    items = list(decisions.items())
+    return [dict(items[i:i + size]) for i in range(0, len(items), size)]
@@ -0,0 +1,213 @@
+import collections
+import json
+import logging
+import math
+import os
+import queue
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+from src.utils.common import get_real_ip
+from src.utils.constants import (DIAGNOSTICS_CHUNK_SIZE, LOGGING_LEVEL,
+                                 Intention)
+from src.utils.tcp_handler import TCPHandler
+
+
+class SamplingProfiler:
+    """
+    A statistical CPU profiler that looks at the stacks of all threads every
+    `interval` seconds via `sys._current_frames`. Unlike cProfile it doesn't
+    slow down the code it watches, so it can run on a live server.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+        self._stacks = collections.Counter()
+        self._leaves = collections.Counter()
+        self._threads = collections.Counter()
+        self._samples = 0
+        self._started = None
+        self._callback = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds=None, callback=None):
+        """
+        Starts sampling. With `seconds` the profiler stops by itself and hands
+        the result to `callback`. Returns False if it is already running.
+        """
+        if self.running:
+            return False
+        self._stacks.clear()
+        self._leaves.clear()
+        self._threads.clear()
+        self._samples = 0
+        self._started = time.monotonic()
+        self._callback = callback
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(seconds,), daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self, limit=30):
+        if self._thread is None:
+            return {"error": "profiler is not running"}
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        return self.result(limit)
+
+    def result(self, limit=30):
+        return {
+            "samples": self._samples,
+            "interval": self.interval,
+            "duration": time.monotonic() - self._started,
+            "threads": dict(self._threads.most_common()),
+            # where the time is spent right now
+            "top": self._leaves.most_common(limit),
+            # collapsed stacks, root first, ready for flamegraph.pl
+            "stacks": self._stacks.most_common(limit),
+        }
+
+    def _run(self, seconds):
+        own = threading.get_ident()
+        deadline = None if seconds is None else time.monotonic() + seconds
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                self._leaves[stack[0]] += 1
+                self._stacks[";".join(reversed(stack))] += 1
+                self._threads[names.get(ident, str(ident))] += 1
+            self._samples += 1
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+        if self._callback is not None and not self._stop.is_set():
+            callback, self._callback = self._callback, None
+            callback(self.stop())
+
+
+class HeapTracker:
+    """
+    tracemalloc snapshots diffed against the previous one, so two calls some
+    minutes apart show what keeps growing.
+    """
+    def __init__(self, frames=1):
+        self.frames = frames
+        self._snapshot = None
+
+    def diff(self, limit=30):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._snapshot = tracemalloc.take_snapshot()
+            return {"started": True, "note": "tracing started, diff again later to see the growth"}
+
+        snapshot = tracemalloc.take_snapshot()
+        stats = snapshot.compare_to(self._snapshot, "lineno")
+        self._snapshot = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "current": current,
+            "peak": peak,
+            "top": [
+                {
+                    "where": str(stat.traceback),
+                    "size": stat.size,
+                    "size_diff": stat.size_diff,
+                    "count": stat.count,
+                    "count_diff": stat.count_diff,
+                }
+                for stat in stats[:limit]
+            ],
+        }
+
+    def stop(self):
+        tracemalloc.stop()
+        self._snapshot = None
+        return {"stopped": True}
+
+
+# transfer --------------------------------------------------------------------
+
+def chunks(request, sender, result, size=DIAGNOSTICS_CHUNK_SIZE):
+    """Splits a result into DIAGNOSTICS_RESULT messages of at most `size` characters of payload."""
+    payload = json.dumps(result, default=str)
+    count = max(1, math.ceil(len(payload) / size))
+    for i in range(count):
+        yield {
+            "intention": str(Intention.DIAGNOSTICS_RESULT),
+            "request": request,
+            "uuid": sender,
+            "chunk": i,
+            "chunks": count,
+            "data": payload[i * size:(i + 1) * size],
+        }
+
+
+class Reassembler:
+    def __init__(self):
+        self._parts = {}  # { request: { chunk: data } }
+
+    def add(self, mesg):
+        """Returns the decoded result once the last chunk of a request arrived."""
+        parts = self._parts.setdefault(mesg["request"], {})
+        parts[mesg["chunk"]] = mesg["data"]
+        if len(parts) < mesg["chunks"]:
+            return None
+        del self._parts[mesg["request"]]
+        return json.loads("".join(parts[i] for i in range(mesg["chunks"])))
+
+
+def request(dest, command, timeout=10, **options):
+    """
+    Sends a DIAGNOSTICS command to the server at `dest` and waits for the
+    complete answer. `profile` commands answer after their `seconds`, which
+    are added to `timeout`.
+    """
+    logger = logging.getLogger("Diagnostics")
+    logger.setLevel(LOGGING_LEVEL)
+
+    listener = TCPHandler(queue.SimpleQueue())
+    id = str(uuid.uuid4())
+    mesg = {
+        "intention": str(Intention.DIAGNOSTICS),
+        "request": id,
+        "command": command,
+        "address": get_real_ip(),
+        "port": listener.port,
+        **options,
+    }
+    try:
+        if not listener.send(mesg, dest):
+            return {"error": f"could not reach {dest[0]}:{dest[1]}"}
+
+        reassembler = Reassembler()
+        deadline = time.monotonic() + timeout + options.get("seconds", 0)
+        while time.monotonic() < deadline:
+            data, _ = listener.listen()
+            if data is None or data.get("intention") != str(Intention.DIAGNOSTICS_RESULT):
+                continue
+            if data["request"] != id:
+                continue
+            logger.debug("Got chunk %s/%s", data['chunk'] + 1, data['chunks'])
+            result = reassembler.add(data)
+            if result is not None:
+                return result
+        return {"error": "timed out"}
+    finally:
+        listener.close()
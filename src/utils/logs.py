@@ -0,0 +1,267 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import struct
+import time
+from threading import Lock
+
+from src.utils.constants import (LOG_FORMAT, LOG_QUEUE_SIZE, LOG_RATE_LIMIT,
+                                 LOG_SAMPLING)
+
+# args that can't change between the call and the writer thread formatting them
+_IMMUTABLE = (str, int, float, bool, type(None))
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per logger and message template: `rate` records per second,
+    bursts of up to `burst`. WARNING and above always pass. The next record
+    that passes carries the number it stands for in `suppressed`.
+    """
+    def __init__(self, rate, burst, clock=time.monotonic):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._buckets = {}  # { (name, msg): [tokens, last, suppressed] }
+        self._lock = Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                return False
+            bucket[0] = tokens - 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.suppressed = getattr(record, "suppressed", 0) + suppressed
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one record in n for the message templates in `rates` ({ template: n })."""
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self._counts = {}  # { (name, msg): count }
+
+    def filter(self, record):
+        n = self.rates.get(record.msg)
+        if n is None or record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        # a lost increment between threads only shifts the sample
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        if count % n:
+            return False
+        record.suppressed = getattr(record, "suppressed", 0) + (n - 1 if count else 0)
+        return True
+
+
+class Formatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += f" ({suppressed} similar suppressed)"
+        return text
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread without formatting them. Only args that
+    could change before the writer gets to them are turned into strings.
+    Never blocks, records that don't fit into the queue are counted and dropped.
+    """
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        args = record.args
+        if isinstance(args, dict):
+            record.msg = record.getMessage()
+            record.args = None
+        elif args:
+            record.args = tuple(arg if isinstance(arg, _IMMUTABLE) else str(arg) for arg in args)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # wait for room instead of failing on a full queue at shutdown
+        self.queue.put(self._sentinel)
+
+
+# binary log ------------------------------------------------------------------
+#
+# A sequence of frames: kind (1 byte), payload length (4 bytes), payload.
+# STRING frames define an id for a logger name or message template the first
+# time it is used, RECORD frames refer to those ids and carry the arguments as
+# JSON, so the same template is never written twice.
+
+_FRAME = struct.Struct("<BI")
+_STRING = struct.Struct("<I")
+_RECORD = struct.Struct("<dBIII")  # created, level, name id, template id, suppressed
+_KIND_STRING = 0
+_KIND_RECORD = 1
+
+
+class BinaryLogHandler(logging.Handler):
+    def __init__(self, path):
+        super().__init__()
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "ab")
+        self._strings = {}
+
+    def _string(self, value):
+        id = self._strings.get(value)
+        if id is None:
+            id = self._strings[value] = len(self._strings)
+            payload = _STRING.pack(id) + value.encode()
+            self._file.write(_FRAME.pack(_KIND_STRING, len(payload)) + payload)
+        return id
+
+    def emit(self, record):
+        try:
+            msg = str(record.msg)
+            if record.exc_text:
+                msg = f"{record.getMessage()}\n{record.exc_text}"
+                args = []
+            else:
+                args = list(record.args or ())
+            payload = _RECORD.pack(
+                record.created,
+                record.levelno,
+                self._string(record.name),
+                self._string(msg),
+                getattr(record, "suppressed", 0),
+            ) + json.dumps(args, default=str).encode()
+            self._file.write(_FRAME.pack(_KIND_RECORD, len(payload)) + payload)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def read_binary_log(path):
+    """Yields the records of a binary log as dicts, with the message formatted again."""
+    strings = {}
+    with open(os.path.expanduser(path), "rb") as f:
+        while True:
+            header = f.read(_FRAME.size)
+            if len(header) < _FRAME.size:
+                return
+            kind, length = _FRAME.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                # the writer was killed mid frame
+                return
+            if kind == _KIND_STRING:
+                (id,) = _STRING.unpack_from(payload)
+                strings[id] = payload[_STRING.size:].decode()
+                continue
+            created, level, name, template, suppressed = _RECORD.unpack_from(payload)
+            args = json.loads(payload[_RECORD.size:])
+            template = strings[template]
+            yield {
+                "created": created,
+                "level": logging.getLevelName(level),
+                "name": strings[name],
+                "template": template,
+                "args": args,
+                "suppressed": suppressed,
+                "message": template % tuple(args) if args else template,
+            }
+
+
+# setup -----------------------------------------------------------------------
+
+_listener = None
+
+
+def setup_logging(level=logging.DEBUG, path=None, binary=None, rate_limit=LOG_RATE_LIMIT, sampling=LOG_SAMPLING):
+    """
+    Routes all logging through a bounded queue to a writer thread, so a log
+    call on the admission path costs a level check, the filters and a put.
+
+    Arguments:
+    level -- level of the root logger, the loggers of the handlers set their own;
+    path -- write text to this file instead of stderr;
+    binary -- also write the structured binary format to this file, see `read_binary_log`;
+    rate_limit -- (rate, burst) per message template, None to log everything;
+    sampling -- { template: n } to only keep one record in n of very frequent templates
+    """
+    global _listener
+    stop_logging()
+
+    if path is not None:
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        text = logging.FileHandler(path)
+    else:
+        text = logging.StreamHandler()
+    text.setFormatter(Formatter(LOG_FORMAT))
+    handlers = [text]
+    if binary is not None:
+        handlers.append(BinaryLogHandler(binary))
+
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    handler = _QueueHandler(records)
+    if sampling:
+        handler.addFilter(SamplingFilter(sampling))
+    if rate_limit:
+        handler.addFilter(RateLimitFilter(*rate_limit))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = _QueueListener(records, *handlers)
+    _listener.start()
+    return handler
+
+
+def stop_logging():
+    """Writes out what is still queued and stops the writer thread."""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,327 @@
+import bisect
+import logging
+import math
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+from src.utils.constants import LOGGING_LEVEL, METRICS_ADDRESS
+
+# seconds, from sub millisecond local work up to slow elections
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def expose(self):
+        """Renders every metric in the Prometheus text format (version 0.0.4)."""
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    """
+    Common part of all metrics. A metric with label names hands out one child
+    per combination of label values via `labels`, children are cached so the
+    hot path is a dict lookup and an addition under a lock.
+    """
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = Lock()
+        if not self.label_names:
+            self._children[()] = self._new_child()
+        registry.register(self)
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} expects labels {self.label_names}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def remove(self, *values):
+        """Drops the child of these label values, e.g. of a server that shut down."""
+        with self._lock:
+            self._children.pop(tuple(str(value) for value in values), None)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            yield from child.samples(self.name, self.label_names, values)
+
+
+class _CounterChild:
+    def __init__(self):
+        self._value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def samples(self, name, names, values):
+        yield f"{name}{_format_labels(names, values)} {_format_value(self._value)}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+
+class _GaugeChild:
+    def __init__(self):
+        self._value = 0
+        self._function = None
+        self._lock = Lock()
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """Evaluate `function` on scrape instead of tracking the value, costs nothing in between."""
+        self._function = function
+
+    def samples(self, name, names, values):
+        value = self._value
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception:
+                value = math.nan
+        yield f"{name}{_format_labels(names, values)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._children[()].set(value)
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self._children[()].dec(amount)
+
+    def set_function(self, function):
+        self._children[()].set_function(function)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def samples(self, name, names, values):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        for bound, count in zip(list(self._buckets) + [math.inf], counts):
+            cumulative += count
+            le = _format_labels(names, values, [("le", _format_value(float(bound)))])
+            yield f"{name}_bucket{le} {cumulative}"
+        yield f"{name}_sum{_format_labels(names, values)} {_format_value(total)}"
+        yield f"{name}_count{_format_labels(names, values)} {cumulative}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self._buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self._buckets)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+
+# the metrics of a server -----------------------------------------------------
+
+MESSAGES = Counter(
+    "admission_messages_total",
+    "Messages sent and received per transport and intention (purpose for ROM control messages).",
+    labels=("transport", "direction", "intention"),
+)
+MESSAGE_BYTES = Counter(
+    "admission_message_bytes_total",
+    "Encoded message bytes sent and received per transport and intention.",
+    labels=("transport", "direction", "intention"),
+)
+# labelled by server uuid, every server in a process (e.g. the simulator) has its own queues
+QUEUE_DEPTH = Gauge("admission_queue_depth", "Items waiting in the main server queue.", labels=("server",))
+ROM_HOLDBACK = Gauge(
+    "admission_rom_holdback_depth",
+    "ROM messages held back waiting for a gap to be filled.",
+    labels=("server",),
+)
+ROM_PENDING = Gauge(
+    "admission_rom_pending_depth",
+    "ROM messages received but not yet delivered in total order.",
+    labels=("server",),
+)
+ROM_NACKS = Counter("admission_rom_nacks_total", "Sequence numbers requested again or retransmitted.", labels=("direction",))
+ROM_DELIVERY = Histogram("admission_rom_delivery_seconds", "From first receipt of a ROM message to its delivery in total order.")
+LOCK_WAIT = Histogram("admission_lock_wait_seconds", "From requesting the admission lock to getting it.")
+LOCK_HOLD = Histogram("admission_lock_hold_seconds", "From getting the admission lock to releasing it.")
+SHED = Counter(
+    "admission_shed_requests_total",
+    "Client requests answered with TRY_AGAIN because the server queue or the requests of a namespace were full.",
+    labels=("queue",),
+)
+DUPLICATES = Counter(
+    "admission_duplicate_requests_total",
+    "Retried requests answered from the decision cache instead of being decided again.",
+    labels=("decision",),
+)
+DECISION = Histogram(
+    "admission_decision_seconds",
+    "From receiving a REQUEST_ACTION to answering it.",
+    labels=("decision",),
+)
+HEARTBEAT_RTT = Histogram("admission_heartbeat_rtt_seconds", "Connect and send of a heartbeat to the leader, one TCP round trip.")
+ELECTION = Histogram("admission_election_seconds", "From joining an election to knowing the new leader.")
+AGREEMENT = Histogram("admission_agreement_seconds", "Leader side duration of an agreement run.", labels=("engine",))
+
+
+class StatsWindow:
+    """
+    Decisions since the last `take`, for the stats a server broadcasts to the
+    monitor every MONITOR_STATS_INTERVAL. Only used by the server thread.
+    """
+    def __init__(self):
+        self._admissions = 0
+        self._latencies = []
+
+    def decision(self, decision, seconds, count=1):
+        """`count` is the size of the group the decision was for."""
+        if decision == "accepted":
+            self._admissions += count
+        if decision != "left":
+            self._latencies.append(seconds)
+
+    def take(self):
+        """Returns (admissions, sorted decision latencies) and starts a new window."""
+        admissions, latencies = self._admissions, sorted(self._latencies)
+        self._admissions = 0
+        self._latencies = []
+        return admissions, latencies
+
+
+def count_message(transport, direction, mesg, size):
+    """Counts one message, `mesg` is the decoded dict and `size` its encoded length."""
+    intention = mesg.get("intention") or mesg.get("purpose") or "unknown"
+    MESSAGES.labels(transport, direction, intention).inc()
+    MESSAGE_BYTES.labels(transport, direction, intention).inc(size)
+
+
+# scrape endpoint -------------------------------------------------------------
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.expose().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, address=METRICS_ADDRESS, registry=REGISTRY):
+    """
+    Serves `registry` on http://address:port/metrics from a daemon thread.
+    Nothing is computed until a scrape comes in.
+    """
+    handler = type("MetricsRequestHandler", (_MetricsRequestHandler,), {"registry": registry})
+    httpd = ThreadingHTTPServer((address, port), handler)
+    httpd.daemon_threads = True
+    thread = Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    logger = logging.getLogger("Metrics")
+    logger.setLevel(LOGGING_LEVEL)
+    logger.info("Serving metrics on http://%s:%s/metrics", address, httpd.server_address[1])
+    return httpd
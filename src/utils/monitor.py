@@ -1,3 +1,5 @@
+import collections
+import json
 import os
 import queue
 import signal
@@ -7,58 +9,310 @@ import threading
 from PySide2 import QtCore, QtGui, QtWidgets
 from src.utils.tcp_handler import TCPHandler
 
+from ..utils import diagnostics
 from ..utils.broadcast_handler import BroadcastHandler
-from ..utils.constants import Intention
+from ..utils.constants import (MONITOR_FRAME_INTERVAL, MONITOR_STATS_HISTORY,
+                               Intention)
 from ..utils.signals import ON_BROADCAST_MESSAGE
 
 os.environ['QT_MAC_WANTS_LAYER'] = '1'
 
-class UPDThread(QtCore.QThread):
+class PendingUpdates:
+    """
+    Monitor messages received since the last frame, only the newest state of
+    every server is kept. Filled by the UDP thread, drained by the UI.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers = {}  # { uuid: data, None if it left }
+        self._stats = []
+
+    def add(self, data):
+        with self._lock:
+            if data["intention"] == str(Intention.MONITOR_STATS):
+                self._stats.append(data)
+            elif data.get("view_version") is not None:
+                # joined servers get a row with their first own message
+                for uuid in data["left"]:
+                    self._servers[uuid] = None
+            elif data.get("leaving"):
+                self._servers[data["uuid"]] = None
+            else:
+                self._servers[data["uuid"]] = data
+
+    def take(self):
+        """Returns ({ uuid: data or None }, [stats]) and starts over."""
+        with self._lock:
+            servers, stats = self._servers, self._stats
+            self._servers = {}
+            self._stats = []
+        return servers, stats
 
-    udp_message = QtCore.Signal(object)
 
-    def __init__(self, queue, parent=None):
+class UPDThread(QtCore.QThread):
+
+    def __init__(self, queue, pending, parent=None):
         super().__init__(parent)
         self._queue = queue
+        self._pending = pending
         self._stopped = False
 
     def run(self):
         while not self._stopped:
             try:
-                item = self._queue.get(block=False)
-                if item.signal == ON_BROADCAST_MESSAGE:
-                    self.udp_message.emit(item.kwargs["data"])
-
+                # the timeout only bounds how long stop() has to wait
+                item = self._queue.get(timeout=0.1)
             except queue.Empty:
-                pass
+                continue
+            if item.signal != ON_BROADCAST_MESSAGE:
+                continue
+            data = item.kwargs["data"]
+            if data.get("intention") in (str(Intention.MONITOR_MESSAGE), str(Intention.MONITOR_STATS)):
+                self._pending.add(data)
 
     def stop(self):
         self._stopped = True
         return self.wait()
+
+
+class ServerModel(QtCore.QAbstractTableModel):
+    """
+    One row per server, found by uuid through an index instead of a scan.
+    Updates only announce the cells that actually changed.
+    """
+
+    HEADERS = ["Server", "Name", "Clients", "Entries", "Participating", "Byzantine", "State"]
+    ENTRIES_COLUMN = 3
+    ADDRESS_ROLE = QtCore.Qt.UserRole + 3
+
+    entries_edited = QtCore.Signal(object, int)  # address, value
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._rows = []  # [ [uuid, address, cells] ]
+        self._index = {}  # { uuid: row }
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        uuid, address, cells = self._rows[index.row()]
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.EditRole):
+            return cells[index.column()]
+        if role == self.ADDRESS_ROLE:
+            return address
+        return None
+
+    def flags(self, index):
+        flags = super().flags(index)
+        if index.column() == self.ENTRIES_COLUMN:
+            flags |= QtCore.Qt.ItemIsEditable
+        return flags
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        # only the user edits, updates from the servers go through update_servers
+        if role != QtCore.Qt.EditRole or index.column() != self.ENTRIES_COLUMN:
+            return False
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            return False
+        self.entries_edited.emit(self._rows[index.row()][1], value)
+        return True
+
+    def row_of(self, uuid):
+        return self._index.get(uuid)
+
+    def address(self, row):
+        return self._rows[row][1]
+
+    def apply(self, servers):
+        """Applies the servers `PendingUpdates.take` returned."""
+        self._remove([uuid for uuid, data in servers.items() if data is None and uuid in self._index])
+
+        new = []
+        for uuid, data in servers.items():
+            if data is None:
+                continue
+            row = self._index.get(uuid)
+            if row is None:
+                new.append(data)
+                continue
+            cells = self._cells(data)
+            old = self._rows[row][2]
+            changed = [column for column, (a, b) in enumerate(zip(old, cells)) if a != b]
+            self._rows[row][1] = (data.get("ip"), data.get("port"))
+            if changed:
+                self._rows[row][2] = cells
+                self.dataChanged.emit(self.index(row, changed[0]), self.index(row, changed[-1]))
+        self._insert(new)
+
+    def _insert(self, servers):
+        if not servers:
+            return
+        first = len(self._rows)
+        self.beginInsertRows(QtCore.QModelIndex(), first, first + len(servers) - 1)
+        for server in servers:
+            self._index[server["uuid"]] = len(self._rows)
+            self._rows.append([server["uuid"], (server.get("ip"), server.get("port")), self._cells(server)])
+        self.endInsertRows()
+
+    def _remove(self, uuids):
+        rows = sorted((self._index[uuid] for uuid in uuids), reverse=True)
+        if not rows:
+            return
+        for row in rows:
+            self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+            del self._rows[row]
+            self.endRemoveRows()
+        self._index = {uuid: row for row, (uuid, _, _) in enumerate(self._rows)}
+
+    @staticmethod
+    def _cells(server):
+        return (
+            server["uuid"],
+            f"{server.get('hostname')} | {server.get('ip')}:{server.get('port')}",
+            '\n'.join(server.get('clients', [])),
+            f'{server.get("entries")}',
+            f'{server.get("election")}',
+            f'{server.get("byzantine")}',
+            f'{server.get("state")}',
+        )
+
+
+class Sparkline(QtWidgets.QWidget):
+    """One small line chart, a line per server on a shared y axis starting at 0."""
+
+    def __init__(self, title, unit="", parent=None):
+        super().__init__(parent)
+        self._title = title
+        self._unit = unit
+        self._series = {}  # { uuid: deque of values, None where nothing was reported }
+        self.setMinimumSize(180, 90)
+
+    def set_series(self, series):
+        self._series = series
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        rect = self.rect().adjusted(4, 18, -4, -4)
+        painter.fillRect(rect, self.palette().base())
+
+        values = [v for values in self._series.values() for v in values if v is not None]
+        top = max(values, default=0) or 1
+        latest = [values[-1] for values in self._series.values() if values and values[-1] is not None]
+        painter.drawText(4, 13, f"{self._title}  max {max(latest, default=0):g}{self._unit}")
+
+        step = rect.width() / max(1, MONITOR_STATS_HISTORY - 1)
+        for uuid, values in self._series.items():
+            painter.setPen(QtGui.QPen(_color(uuid), 1.5))
+            path = QtGui.QPainterPath()
+            drawing = False
+            # right aligned, the newest value is at the right edge
+            x = rect.right() - (len(values) - 1) * step
+            for value in values:
+                if value is None:
+                    drawing = False
+                else:
+                    point = QtCore.QPointF(x, rect.bottom() - value / top * rect.height())
+                    if drawing:
+                        path.lineTo(point)
+                    else:
+                        path.moveTo(point)
+                        drawing = True
+                x += step
+            painter.drawPath(path)
+        painter.end()
+
+
+def _color(uuid):
+    # the same server keeps its color in every chart
+    return QtGui.QColor.fromHsv(hash(uuid) % 360, 200, 200)
+
+
+class StatsPanel(QtWidgets.QWidget):
+    """Live charts of the MONITOR_STATS every server broadcasts."""
+
+    CHARTS = [
+        ("admissions", "Admissions/s", ""),
+        ("p50", "Decision p50", " ms"),
+        ("p99", "Decision p99", " ms"),
+        ("queue", "Queue depth", ""),
+        ("holdback", "ROM holdback", ""),
+        ("rtt", "Heartbeat RTT", " ms"),
+    ]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._series = {key: {} for key, _, _ in self.CHARTS}  # { key: { uuid: deque } }
+        self._charts = {}
+
+        lyt = QtWidgets.QGridLayout(self)
+        for i, (key, title, unit) in enumerate(self.CHARTS):
+            chart = Sparkline(title, unit)
+            self._charts[key] = chart
+            lyt.addWidget(chart, i // 3, i % 3)
+
+    def add(self, stats):
+        for data in stats:
+            for key, series in self._series.items():
+                values = series.get(data["uuid"])
+                if values is None:
+                    values = series[data["uuid"]] = collections.deque(maxlen=MONITOR_STATS_HISTORY)
+                values.append(data.get(key))
+        for key, chart in self._charts.items():
+            chart.set_series(self._series[key])
+
+    def remove(self, uuid):
+        for key, series in self._series.items():
+            series.pop(uuid, None)
+            self._charts[key].set_series(series)
+
+
+class DiagnosticsThread(QtCore.QThread):
+
+    result = QtCore.Signal(object)
+
+    def __init__(self, address, command, parent=None):
+        super().__init__(parent)
+        self._address = address
+        self._command = command
+
+    def run(self):
+        self.result.emit(diagnostics.request(self._address, self._command))
+
+
 class Monitor(QtWidgets.QDialog):
 
     QUEUE = queue.SimpleQueue()
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, seeds=None, gossip_port=0):
         super().__init__(parent)
-        self._broadcast_handler = BroadcastHandler(self.QUEUE)
+        self._broadcast_handler = BroadcastHandler(self.QUEUE, seeds=seeds, port=gossip_port)
 
-        self._thread = UPDThread(self.QUEUE, self)
+        self._pending = PendingUpdates()
+        self._thread = UPDThread(self.QUEUE, self._pending, self)
         self._thread.start()
 
         self._tcp_handler = TCPHandler(queue.SimpleQueue())
         self._tcp_handler.start()
 
-        self._thread.udp_message.connect(self._on_udp_msg)
-
-        self._allow_signal = True
-
         lyt = QtWidgets.QVBoxLayout(self)
 
-        self._model = QtGui.QStandardItemModel()
-        self._model.dataChanged.connect(self._on_data_changed)
-
-        self._model.setHorizontalHeaderLabels(["Server", "Name", "Clients", "Entries", "Participating", "Byzantine", "State"])
+        self._model = ServerModel(self)
+        self._model.entries_edited.connect(self._on_entries_edited)
 
         self._view = QtWidgets.QTableView()
         self._view.setModel(self._model)
@@ -67,7 +321,18 @@ class Monitor(QtWidgets.QDialog):
         self._view.horizontalHeader().setSectionResizeMode(0, QtWidgets.QHeaderView.ResizeToContents)
         self._view.horizontalHeader().setSectionResizeMode(1, QtWidgets.QHeaderView.ResizeToContents)
         self._view.verticalHeader().setSectionResizeMode(QtWidgets.QHeaderView.ResizeToContents)
-        lyt.addWidget(self._view)
+        self._stats_panel = StatsPanel()
+
+        splitter = QtWidgets.QSplitter(QtCore.Qt.Vertical)
+        splitter.addWidget(self._view)
+        splitter.addWidget(self._stats_panel)
+        lyt.addWidget(splitter)
+
+        # everything received within a frame is applied at once
+        self._frame_timer = QtCore.QTimer(self)
+        self._frame_timer.setInterval(MONITOR_FRAME_INTERVAL)
+        self._frame_timer.timeout.connect(self._apply_pending)
+        self._frame_timer.start()
 
         hbox = QtWidgets.QHBoxLayout()
         lyt.addLayout(hbox)
@@ -77,108 +342,66 @@ class Monitor(QtWidgets.QDialog):
         hbox.addWidget(self._byz_btn)
 
         self._byz_btn.clicked.connect(self._run_byz)
-        self._broadcast_handler.start()
-
-    def _run_byz(self):
-        self._broadcast_handler.send({"intention": str(Intention.RUN_BYZ)})
-
-    def _on_udp_msg(self, data=None, addr=None):
-        if data["intention"] == str(Intention.MONITOR_MESSAGE):
-            if data.get("group_view") is not None:
-                for key in data["group_view"]:
-                    if not self._model.findItems(key):
-                        self._add_server({"uuid": key})
-
-                for i in range(self._model.rowCount()):
-                    uuid = self._model.index(i, 0).data()
-                    if uuid not in data["group_view"]:
-                        self._model.removeRow(i)
-
-            elif data.get("leaving"):
-                self._remove_server(data["uuid"])
-
-            elif self._model.findItems(data["uuid"]):
-                self._allow_signal = False
-                self._update_server(data)
-
-            else:
-                self._allow_signal = False
-                self._add_server(data)
-
-            self._allow_signal = True
-
-    def _on_data_changed(self, tl, br, roles):
-        if self._allow_signal:
-            value = tl.data()
-            index = self._model.index(tl.row(), 0)
-            address = index.data(QtCore.Qt.UserRole+3)
-
-            print(f"setting entries on {address} to {value}")
-
-            print(self._tcp_handler.send({"intention": str(Intention.MANUAL_VALUE_OVERRIDE), "value": value}, address))
-
-    def _remove_server(self, uuid):
-        for item in self._model.findItems(uuid):
-            row = self._model.indexFromItem(item).row()
-            self._model.removeRow(row)
-
-    def _add_server(self, server):
-        item = QtGui.QStandardItem(server["uuid"])
-        item.setData((server.get("ip"), server.get("port")), QtCore.Qt.UserRole+3)
-        name_item = QtGui.QStandardItem(self._get_name(server))
-        clients_item = QtGui.QStandardItem('\n'.join([i for i in server.get('clients', [])]))
-        entries_item = QtGui.QStandardItem(f'{server.get("entries")}')
-        election_item = QtGui.QStandardItem(f'{server.get("election")}')
-        state_item = QtGui.QStandardItem(f'{server.get("state")}')
-        byzantine_item = QtGui.QStandardItem(f'{server.get("byzantine")}')
-
-        row = [
-            item,
-            name_item,
-            clients_item,
-            entries_item,
-            election_item,
-            byzantine_item,
-            state_item,
-        ]
 
-        self._model.appendRow(row)
+        self._state_btn = QtWidgets.QPushButton("Dump State")
+        hbox.addWidget(self._state_btn)
+        self._state_btn.clicked.connect(lambda: self._run_diagnostics("state"))
 
-    def _get_name(self, data):
-        return f"{data.get('hostname')} | {data.get('ip')}:{data.get('port')}"
+        self._heap_btn = QtWidgets.QPushButton("Heap Diff")
+        hbox.addWidget(self._heap_btn)
+        self._heap_btn.clicked.connect(lambda: self._run_diagnostics("heap"))
 
-    def _update_server(self, server):
-        for item in self._model.findItems(server["uuid"]):
-            index = self._model.indexFromItem(item)
-            row = index.row()
-
-            name_index = self._model.index(row, 1)
-            self._model.setData(name_index, self._get_name(server))
-
-            clients_index = self._model.index(row, 2)
-            self._model.setData(clients_index, '\n'.join([i for i in server.get('clients', [])]))
-
-            entries_index = self._model.index(row, 3)
-            self._model.setData(entries_index, f'{server.get("entries")}')
-
-            election_index = self._model.index(row, 4)
-            self._model.setData(election_index, f'{server.get("election")}')
+        self._diagnostics_threads = []
+        self._broadcast_handler.start()
 
-            byzantine_index = self._model.index(row, 5)
-            self._model.setData(byzantine_index, f'{server.get("byzantine")}')
+    def _run_byz(self):
+        self._broadcast_handler.send({"intention": str(Intention.RUN_BYZ)})
 
-            state_index = self._model.index(row, 6)
-            self._model.setData(state_index, f'{server.get("state")}')
+    def _run_diagnostics(self, command):
+        index = self._view.currentIndex()
+        if not index.isValid():
+            return
+        address = self._model.address(index.row())
+        thread = DiagnosticsThread(tuple(address), command, self)
+        thread.result.connect(lambda result: self._show_diagnostics(command, result))
+        thread.finished.connect(lambda: self._diagnostics_threads.remove(thread))
+        self._diagnostics_threads.append(thread)
+        thread.start()
+
+    def _show_diagnostics(self, command, result):
+        dialog = QtWidgets.QDialog(self)
+        dialog.setWindowTitle(f"Diagnostics: {command}")
+        lyt = QtWidgets.QVBoxLayout(dialog)
+        text = QtWidgets.QPlainTextEdit(json.dumps(result, indent=2))
+        text.setReadOnly(True)
+        lyt.addWidget(text)
+        dialog.resize(600, 500)
+        dialog.show()
+
+    def _apply_pending(self):
+        servers, stats = self._pending.take()
+        if servers:
+            self._model.apply(servers)
+            for uuid, data in servers.items():
+                if data is None:
+                    self._stats_panel.remove(uuid)
+        if stats:
+            self._stats_panel.add(stats)
+
+    def _on_entries_edited(self, address, value):
+        print(f"setting entries on {address} to {value}")
+
+        print(self._tcp_handler.send({"intention": str(Intention.MANUAL_VALUE_OVERRIDE), "value": value}, address))
 
     def closeEvent(self, event):
         self._thread.stop()
         super().closeEvent(event)
 
-def start_monitor():
+def start_monitor(seeds=None, gossip_port=0):
     app = QtWidgets.QApplication().instance()
     signal.signal(signal.SIGINT, signal.SIG_DFL)
 
-    monitor = Monitor()
+    monitor = Monitor(seeds=seeds, gossip_port=gossip_port)
     monitor.show()
 
     sys.exit(app.exec_())
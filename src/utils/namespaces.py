@@ -0,0 +1,61 @@
+import bisect
+import hashlib
+from queue import Queue
+
+from src.utils.constants import HASH_REPLICAS, LockState
+
+
+class Namespace:
+    """
+    Counter, capacity and admission lock of one venue or area. Each
+    namespace has its own lock in the total order, so decisions for
+    different namespaces never wait for each other.
+    """
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = capacity
+        self.entries = 0
+        # entries as of the last delivered ROM message, our own updates are
+        # applied to `entries` before they are ordered
+        self.delivered_entries = 0
+        # sum of the agreement corrections delivered so far, updates computed
+        # before one was delivered are rebased by the difference
+        self.corrected = 0
+        self.lock = LockState.OPEN
+        self.requests = Queue()
+        self.lock_requested_at = None
+        self.lock_acquired_at = None
+        self.commit_traces = []  # sampled requests of the batch we are committing
+        self.commit_started = None
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of namespaces onto servers with `replicas` points per
+    server, so a server joining or leaving only moves the namespaces next to
+    its points.
+    """
+    def __init__(self, replicas=HASH_REPLICAS):
+        self.replicas = replicas
+        self._members = frozenset()
+        self._points = []
+        self._owners = []
+
+    def update(self, members):
+        members = frozenset(members)
+        if members == self._members:
+            return
+        self._members = members
+        points = sorted((_hash(f"{member}#{i}"), member) for member in members for i in range(self.replicas))
+        self._points = [point for point, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, key):
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[i]
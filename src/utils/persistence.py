@@ -0,0 +1,276 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from threading import Event, Lock, Thread
+
+try:
+    import fcntl
+except ImportError:  # windows, no locking of the data directory
+    fcntl = None
+
+from src.utils.constants import (DEDUP_CACHE_SIZE, DEFAULT_NAMESPACE,
+                                 LOGGING_LEVEL, SNAPSHOT_EVERY, WAL_SIZE,
+                                 WAL_SYNC_INTERVAL)
+
+_MAGIC = b"AWAL"
+_HEADER = struct.Struct("<4sI")  # magic, generation
+_RECORD = struct.Struct("<III")  # payload length, generation, crc32 of the payload
+
+
+class WriteAheadLog:
+    """
+    Append only log of JSON records in a memory mapped file.
+
+    `append` only copies into the mapping, a background thread msyncs dirty
+    pages every `sync_interval` seconds, so a crash of the process loses
+    nothing and a crash of the machine at most the last interval. With a
+    `sync_interval` of 0 every append is synced before it returns.
+
+    Records carry the generation of the log. `reset` starts a new generation
+    at the beginning of the file instead of truncating it, reading stops at
+    the first record of an older generation or with a bad checksum, which is
+    where a torn write ends.
+    """
+    def __init__(self, path, size=WAL_SIZE, sync_interval=WAL_SYNC_INTERVAL):
+        self.path = path
+        self.sync_interval = sync_interval
+        self._file = open(path, "a+b")
+        if os.fstat(self._file.fileno()).st_size < size:
+            self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._lock = Lock()  # remapping vs syncing
+        self._dirty = False
+
+        magic, self._generation = _HEADER.unpack_from(self._map)
+        if magic != _MAGIC:
+            self._generation = 1
+            _HEADER.pack_into(self._map, 0, _MAGIC, self._generation)
+        self._offset = _HEADER.size
+        self.recovered = list(self._read())
+
+        self._stopped = Event()
+        self._thread = None
+        if sync_interval > 0:
+            self._thread = Thread(target=self._sync_loop, daemon=True)
+            self._thread.start()
+
+    def _read(self):
+        while self._offset + _RECORD.size <= len(self._map):
+            length, generation, crc = _RECORD.unpack_from(self._map, self._offset)
+            start = self._offset + _RECORD.size
+            if length == 0 or generation != self._generation or start + length > len(self._map):
+                return
+            payload = self._map[start:start + length]
+            if zlib.crc32(payload) != crc:
+                return
+            yield json.loads(payload)
+            self._offset = start + length
+
+    def append(self, record):
+        payload = json.dumps(record, separators=(",", ":")).encode()
+        end = self._offset + _RECORD.size + len(payload)
+        if end + _RECORD.size > len(self._map):
+            self._grow(end + _RECORD.size)
+        _RECORD.pack_into(self._map, self._offset, len(payload), self._generation, zlib.crc32(payload))
+        self._map[self._offset + _RECORD.size:end] = payload
+        self._offset = end
+        self._dirty = True
+        if self.sync_interval <= 0:
+            self.sync()
+
+    def _grow(self, needed):
+        size = len(self._map)
+        while size < needed:
+            size *= 2
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._file.truncate(size)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def reset(self):
+        """Drops all records, e.g. once a snapshot covers them."""
+        self._generation += 1
+        _HEADER.pack_into(self._map, 0, _MAGIC, self._generation)
+        self._offset = _HEADER.size
+        self._dirty = True
+        self.sync()
+
+    def sync(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            # appends while we flush mark it dirty again
+            self._dirty = False
+            self._map.flush()
+
+    def _sync_loop(self):
+        while not self._stopped.wait(self.sync_interval):
+            self.sync()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.sync()
+        self._map.close()
+        self._file.close()
+
+
+def write_snapshot(path, state):
+    """Replaces the snapshot at `path` atomically, it is either the old or the new one."""
+    # per process, servers on one host may share a file (see MembersCache)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def apply(state, record):
+    """Folds one WAL record into the state of a server."""
+    kind = record["type"]
+    if kind == "identity":
+        state["uuid"] = record["uuid"]
+    elif kind == "entries":
+        namespace = record.get("namespace", DEFAULT_NAMESPACE)
+        if namespace == DEFAULT_NAMESPACE:
+            state["entries"] = record["entries"]
+        else:
+            state.setdefault("namespaces", {})[namespace] = record["entries"]
+        if record.get("seq") is not None:
+            state["seq"] = record["seq"]
+    elif kind == "decision":
+        decisions = state.setdefault("decisions", {})
+        # people, a group is one decision
+        decisions[record["decision"]] = decisions.get(record["decision"], 0) + record.get("count", 1)
+    elif kind == "dedup":
+        # the decision cache by idempotency key, oldest first like DecisionCache
+        dedup = state.setdefault("dedup", {})
+        for key, decision in record["decisions"].items():
+            dedup.pop(key, None)
+            dedup[key] = decision
+        for key in list(dedup)[:max(0, len(dedup) - DEDUP_CACHE_SIZE)]:
+            del dedup[key]
+    elif kind == "client":
+        state.setdefault("clients", {})[record["uuid"]] = record["address"]
+    elif kind == "client_gone":
+        state.setdefault("clients", {}).pop(record["uuid"], None)
+    return state
+
+
+class MembersCache:
+    """
+    Where the group was when we last saw it: the address of the leader, of
+    the other members and how long joining took. A starting server asks them
+    directly instead of waiting for an answer to its broadcast. Several
+    servers on one host can share the file, a stale entry costs one refused
+    connection.
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self._written = None
+
+        self._logger = logging.getLogger("MembersCache")
+        self._logger.setLevel(LOGGING_LEVEL)
+
+    def read(self):
+        try:
+            return read_snapshot(self.path)
+        except (OSError, ValueError) as e:
+            self._logger.warning("Ignoring the members cache %s: %s", self.path, e)
+            return None
+
+    def write(self, leader, members, join_seconds=None):
+        """Addresses as (ip, port), only writes if something changed."""
+        if join_seconds is None:
+            # a server that founded the group never joined, keep what others measured
+            join_seconds = (self.read() or self._written or {}).get("join_seconds")
+        cache = {
+            "leader": list(leader) if leader is not None else None,
+            "members": sorted(list(address) for address in {tuple(address) for address in members}),
+            "join_seconds": join_seconds,
+        }
+        if cache == self._written:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            write_snapshot(self.path, cache)
+        except OSError as e:
+            # e.g. another server on this host writing at the same time
+            self._logger.debug("Could not write the members cache: %s", e)
+            return
+        self._written = cache
+
+
+class Store:
+    """
+    The durable state of one server in `directory`: a snapshot plus the WAL
+    of everything since. `state` is always the snapshot with the WAL applied,
+    every SNAPSHOT_EVERY records it becomes the new snapshot and the WAL
+    starts over. Only one server can use a directory at a time.
+    """
+    def __init__(self, directory, snapshot_every=SNAPSHOT_EVERY, sync_interval=WAL_SYNC_INTERVAL):
+        self.directory = os.path.expanduser(directory)
+        self.snapshot_every = snapshot_every
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._lock_file = open(os.path.join(self.directory, "lock"), "w")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._lock_file.close()
+                raise RuntimeError(f"{self.directory} is used by another server")
+
+        self._logger = logging.getLogger("Store")
+        self._logger.setLevel(LOGGING_LEVEL)
+
+        start = time.monotonic()
+        self._snapshot_path = os.path.join(self.directory, "snapshot.json")
+        self.state = read_snapshot(self._snapshot_path) or {}
+        self._wal = WriteAheadLog(os.path.join(self.directory, "wal"), sync_interval=sync_interval)
+        for record in self._wal.recovered:
+            apply(self.state, record)
+        # True if there was state from an earlier run
+        self.recovered = "uuid" in self.state
+        self._since_snapshot = len(self._wal.recovered)
+        self._logger.info(
+            "Recovered %s WAL records on top of the snapshot in %.1f ms",
+            self._since_snapshot, 1000 * (time.monotonic() - start),
+        )
+
+    def log(self, kind, **fields):
+        record = {"type": kind, **fields}
+        apply(self.state, record)
+        self._wal.append(record)
+        self._since_snapshot += 1
+        if self._since_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        write_snapshot(self._snapshot_path, self.state)
+        self._wal.reset()
+        self._since_snapshot = 0
+
+    def close(self):
+        self._wal.close()
+        self._lock_file.close()
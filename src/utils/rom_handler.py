@@ -6,17 +6,42 @@ import select
 import socket
 import struct
 import sys
+import threading
+import time
 import uuid
+from collections import OrderedDict, deque
 
 from src.utils.common import SocketThread
-from src.utils.constants import (LOGGING_LEVEL, MULTICAST_IP, MULTICAST_PORT,
+from src.utils.constants import (BUFFER_SIZE, LOGGING_LEVEL, MULTICAST_IP,
+                                 MULTICAST_PORT, ROM_FINISHED_HISTORY,
+                                 ROM_REPAIR_INTERVAL, ROM_TRANSFER_BUFFER,
                                  TIMEOUT, Intention, Purpose)
+from src.utils.metrics import (ROM_DELIVERY, ROM_HOLDBACK, ROM_NACKS,
+                               ROM_PENDING, count_message)
+from src.utils.tracing import TRACER
 from src.utils.signals import ON_MULTICAST_MESSAGE
 
 
 class ROMulticastHandler(SocketThread):
-    def __init__(self, id, view, server_queue, timeout=TIMEOUT):
+    """
+    Reliable totally ordered multicast within the group view.
+
+    Ordering is ISIS style: every member proposes a sequence number to the
+    original sender, which multicasts the largest one (ties broken by the
+    proposer) as FIN_SEQ. Members deliver in agreed order once the head of
+    their queue is agreed upon. Proposals are plain datagrams without a
+    sequence number, so every ROM_REPAIR_INTERVAL a member sends its proposal
+    again for messages that are still not agreed upon, a sender that finished
+    the message already answers with its FIN_SEQ again. Gaps in the sequence
+    numbers of a sender are NACKed again on the same interval.
+
+    With `unicast_port`, for networks without multicast, messages are sent to
+    every member of the view one by one from a socket bound to `unicast_port`
+    instead, members listen on the port of their TCP handler.
+    """
+    def __init__(self, id, view, server_queue, timeout=TIMEOUT, unicast_port=None):
         super().__init__(server_queue)
+        self._unicast_port = unicast_port
         self._name = id
         self._snumber = 0
         self._rnumbers = {self._name: self._snumber}
@@ -28,6 +53,15 @@ class ROMulticastHandler(SocketThread):
         self._out_a = {}
         self._group_view_backlog = {}
         self._deliver_queue = {}
+        self._addresses = {}  # { sender: addr } of the senders sockets
+        # { id: (seq, proposer, deliverable) }, messages are delivered in
+        # (seq, proposer) order once the head of the queue is agreed upon
+        self._priorities = {}
+        self._received_at = {}  # { id: `_clock` time of the first copy }
+        self._proposals = {}  # { id: [PROP_SEQ, addr, sent at] } ours, until the message is agreed upon
+        self._finished = OrderedDict()  # { id: S of our FIN_SEQ }
+        self._repaired_at = 0
+        self._traces = {}  # { id: (trace ids, start) } of our own sampled messages
 
         self._aq = 0  # Largest agreed seqeunce number
         self._pq = 0  # Largest proposed sequence number
@@ -35,6 +69,19 @@ class ROMulticastHandler(SocketThread):
         self._paused_queue = queue.Queue()
         self._paused = False
 
+        # messages received while a joiner waits for the state of the group
+        self._transfer_buffer = None
+        self._handle_lock = threading.RLock()
+
+        self._open_sockets(timeout)
+
+        ROM_HOLDBACK.labels(self._name).set_function(lambda: len(self._holdback))
+        ROM_PENDING.labels(self._name).set_function(lambda: len(self._priorities))
+
+        self._logger = logging.getLogger("ROMulticast")
+        self._logger.setLevel(LOGGING_LEVEL)
+
+    def _open_sockets(self, timeout):
         self._listener_socket = socket.socket(
             socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP
         )
@@ -43,22 +90,45 @@ class ROMulticastHandler(SocketThread):
         else:
             self._listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self._listener_socket.bind(("", MULTICAST_PORT))
-        mreq = struct.pack("4sl", socket.inet_aton(MULTICAST_IP), socket.INADDR_ANY)
-        self._listener_socket.setsockopt(
-            socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq
-        )
+        if self._unicast_port is None:
+            mreq = struct.pack("4sl", socket.inet_aton(MULTICAST_IP), socket.INADDR_ANY)
+            self._listener_socket.setsockopt(
+                socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq
+            )
         self._listener_socket.settimeout(timeout)
 
         self._sender_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._sender_socket.settimeout(0.2)
-        ttl = struct.pack("b", 1)
-        self._sender_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        if self._unicast_port is not None:
+            # members send to and answer this socket, it is read in `run` too
+            self._sender_socket.bind(("", self._unicast_port))
+        else:
+            ttl = struct.pack("b", 1)
+            self._sender_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+
+    def _multicast(self, mesg: dict):
+        payload = json.dumps(mesg).encode()
+        if self._unicast_port is not None:
+            # including ourselves, our own messages are ordered like the others
+            for addr in list(self._current_group_view.values()):
+                self._sender_socket.sendto(payload, (addr[0], addr[1]))
+        else:
+            self._sender_socket.sendto(payload, (MULTICAST_IP, MULTICAST_PORT))
+        count_message("rom", "out", mesg, len(payload))
 
-        self._logger = logging.getLogger("ROMulticast")
-        self._logger.setLevel(LOGGING_LEVEL)
+    def _unicast(self, mesg: dict, addr):
+        payload = json.dumps(mesg).encode()
+        self._sender_socket.sendto(payload, addr)
+        count_message("rom", "out", mesg, len(payload))
+
+    def _clock(self):
+        return time.monotonic()
 
     def set_group_view(self, view):
         self._current_group_view = view
+        # Messages of members that left will never be agreed upon and would
+        # block everything behind them
+        self._drop_unagreed(lambda original: original not in view)
         # we need to make a copy because while we iterate thought it there is a
         # good chance that thread/louie suspends the iterating to process a new
         # message but because we are still iterating a removal of a value from
@@ -71,12 +141,69 @@ class ROMulticastHandler(SocketThread):
             if done:
                 del self._out_a[id]
 
+    def _drop_unagreed(self, gone):
+        for id in list(self._priorities.keys()):
+            original = self._deliver_queue.get(id, {}).get("original")
+            if not self._priorities[id][2] and original is not None and gone(original):
+                del self._priorities[id]
+                self._deliver_queue.pop(id, None)
+                self._received_at.pop(id, None)
+                self._proposals.pop(id, None)
+        self._deliver_agreed()
+
     def register_new_member(self, id):
         self._rnumbers[id] = 0
-
-    def sync_state(self, rnumbers, deliver_queue):
-        self._rnumbers.update(rnumbers)
-        self._deliver_queue.update(deliver_queue)
+        # a restarted member forgot what it sent before, nobody finishes that
+        self._drop_unagreed(lambda original: original == id)
+
+    def sync_state(self, rnumbers, deliver_queue, agreed=None):
+        """
+        Takes over the state of another member. Messages it already agreed on
+        keep their sequence number, for the others we send our own proposal:
+        their sender may still wait for one from our uuid, e.g. after we
+        restarted, and answers with the FIN_SEQ if it is done already. Our own
+        number stays, after a restart theirs is the one of our old incarnation.
+        """
+        self._rnumbers.update({sender: r for sender, r in rnumbers.items() if sender != self._name})
+        agreed = agreed or {}
+        for id, data in deliver_queue.items():
+            if id in self._priorities or (id not in agreed and data.get("original") == self._name):
+                # unfinished ones of our previous incarnation are dropped by everyone
+                continue
+            if id in agreed:
+                a, proposer = agreed[id]
+                self._deliver_queue[id] = data
+                self._priorities[id] = (a, proposer, True)
+                self._aq = max(self._aq, a)
+            else:
+                self._propose_order(data, None)
+        self._deliver_agreed()
+
+    def agreed(self):
+        """{ id: (sequence number, proposer) } of the undelivered messages we agreed on."""
+        return {id: (a, proposer) for id, (a, proposer, deliverable) in self._priorities.items() if deliverable}
+
+    def begin_transfer(self):
+        """Holds back incoming messages until `finish_transfer`, at most ROM_TRANSFER_BUFFER."""
+        with self._handle_lock:
+            if self._transfer_buffer is None:
+                self._transfer_buffer = deque(maxlen=ROM_TRANSFER_BUFFER)
+
+    def finish_transfer(self, rnumbers, deliver_queue, agreed=None):
+        """
+        Applies the transferred state and replays what was held back. Messages
+        the state already covers are skipped by their sequence number, the
+        ones after it are delivered, anything the buffer dropped is NACKed.
+        """
+        with self._handle_lock:
+            self.sync_state(rnumbers, deliver_queue, agreed)
+            buffered, self._transfer_buffer = self._transfer_buffer or (), None
+            for data, addr in buffered:
+                self._handle(data, addr)
+
+    def cancel_transfer(self):
+        with self._handle_lock:
+            self._transfer_buffer = None
 
     def pause(self, sendout=True):
         if not self._paused:
@@ -101,9 +228,7 @@ class ROMulticastHandler(SocketThread):
         mesg["S"] = self._snumber
 
         self._out[self._snumber] = mesg
-        self._sender_socket.sendto(
-            json.dumps(mesg).encode(), (MULTICAST_IP, MULTICAST_PORT)
-        )
+        self._multicast(mesg)
 
     def send(self, mesg: dict):
         # Inject purpose
@@ -117,6 +242,8 @@ class ROMulticastHandler(SocketThread):
         if "sender" not in mesg:
             mesg["original"] = self._name
             self._out_a[mesg["id"]] = {}
+            if "traces" in mesg:
+                self._traces[mesg["id"]] = (mesg["traces"], time.time())
             self._group_view_backlog[mesg["id"]] = copy.deepcopy(
                 self._current_group_view
             )
@@ -133,6 +260,8 @@ class ROMulticastHandler(SocketThread):
     def _propose_order(self, data: dict, addr):
         self._deliver_queue[data["id"]] = data
         self._pq = max(self._aq, self._pq) + 1
+        self._priorities[data["id"]] = (self._pq, self._name, False)
+        self._received_at[data["id"]] = self._clock()
         mesg = {
             "purpose": str(Purpose.PROP_SEQ),
             "mesg_id": data["id"],
@@ -140,13 +269,60 @@ class ROMulticastHandler(SocketThread):
             "id": str(uuid.uuid4()),
             "sender": self._name,
         }
-        self._sender_socket.sendto(json.dumps(mesg).encode(), addr)
+        if "traces" in data:
+            mesg["traces"] = data["traces"]
+        # The first copy we got might be relayed, but only the original sender
+        # collects the proposals
+        original = self._addresses.get(data.get("original"))
+        self._proposals[data["id"]] = [mesg, original, self._clock()]
+        self._send_proposal(mesg, original)
+
+    def _send_proposal(self, mesg, addr):
+        if addr is not None:
+            self._unicast(mesg, addr)
+        else:
+            self._multicast(mesg)
+
+    def _repair(self):
+        """
+        Retries what got lost: our proposals for messages that are still not
+        agreed upon and the NACKs for gaps in front of held back messages.
+        """
+        now = self._clock()
+        if now - self._repaired_at < ROM_REPAIR_INTERVAL:
+            return
+        self._repaired_at = now
+        for proposal in list(self._proposals.values()):
+            mesg, addr, sent_at = proposal
+            if now - sent_at < ROM_REPAIR_INTERVAL:
+                continue
+            proposal[2] = now
+            ROM_NACKS.labels("reproposed").inc()
+            self._send_proposal(mesg, addr)
+
+        highest = {}  # { sender: highest S held back }
+        for id, held in list(self._holdback.items()):
+            sender, s = held["data"]["sender"], held["data"]["S"]
+            if s <= self._rnumbers.get(sender, s):
+                # covered by now, e.g. by a state transfer
+                del self._holdback[id]
+                continue
+            highest[sender] = max(highest.get(sender, 0), s)
+        for sender, s in highest.items():
+            addr = self._addresses.get(sender)
+            if addr is not None and sender in self._rnumbers:
+                self._send_nacks(self._missing(sender, self._rnumbers[sender], s), addr)
 
-    def _collect_order_proposals(self, data: dict):
+    def _collect_order_proposals(self, data: dict, addr):
         id = data["mesg_id"]
         pq = data["pq"]
 
         if id not in self._out_a:
+            # a proposal sent again, the member never got our FIN_SEQ
+            s = self._finished.get(id)
+            if s is not None and s in self._out:
+                ROM_NACKS.labels("retransmitted").inc()
+                self._unicast(self._out[s], addr)
             return
         self._out_a[id][data["sender"]] = pq
         done = self._complete_proposal(id, self._out_a[id])
@@ -160,14 +336,22 @@ class ROMulticastHandler(SocketThread):
 
         if len(diff) > 0:
             return False
-        a = max(value.values())
+        a, proposer = max((pq, sender) for sender, pq in value.items())
         mesg = {
             "purpose": str(Purpose.FIN_SEQ),
             "mesg_id": id,
             "a": a,
+            "proposer": proposer,
             "id": str(uuid.uuid4()),
         }
+        if id in self._traces:
+            traces, start = self._traces.pop(id)
+            mesg["traces"] = traces
+            TRACER.spans(traces, "rom.propose", self._name, start, time.time())
         self._send(mesg)
+        self._finished[id] = self._snumber
+        if len(self._finished) > ROM_FINISHED_HISTORY:
+            self._finished.popitem(last=False)
         return True
 
     def _deliver_message(self, data: dict):
@@ -180,9 +364,29 @@ class ROMulticastHandler(SocketThread):
                     "Something went wrong with putting the message into the _deliver_queue"
                 )
             return
-        mesg = self._deliver_queue.pop(id)
-        mesg["a"] = a
-
+        self._priorities[id] = (a, data.get("proposer", ""), True)
+        self._deliver_agreed()
+
+    def _deliver_agreed(self):
+        while self._priorities:
+            id = min(self._priorities, key=lambda i: self._priorities[i][:2])
+            a, _, deliverable = self._priorities[id]
+            if not deliverable:
+                return
+            del self._priorities[id]
+            self._proposals.pop(id, None)
+            mesg = self._deliver_queue.pop(id)
+            mesg["a"] = a
+            received_at = self._received_at.pop(id, None)
+            if received_at is not None:
+                waited = self._clock() - received_at
+                ROM_DELIVERY.observe(waited)
+                if "traces" in mesg:
+                    now = time.time()
+                    TRACER.spans(mesg["traces"], "rom.deliver", self._name, now - waited, now)
+            self._deliver(mesg)
+
+    def _deliver(self, mesg: dict):
         if mesg["purpose"] == str(Purpose.STOP):
             self.pause(False)
             return
@@ -211,7 +415,7 @@ class ROMulticastHandler(SocketThread):
         elif data["purpose"] == str(Purpose.FIN_SEQ):
             self._deliver_message(data)
         else:
-            self._logger.error(f"Bad message {data}")
+            self._logger.error("Bad message %s", data)
 
     def _check_for_next_msg(self, s, sender):
         found = None
@@ -223,48 +427,57 @@ class ROMulticastHandler(SocketThread):
             return self._holdback.pop(found)
         return None
 
-    def _request_missing(self, data: dict, addr, s, r):
-        self._holdback[data["id"]] = {"data": data, "addr": addr}
-        sender = data["sender"]
-        r_i = r + 1
-        stop = False
-        nacks = []
-        while r_i < s:
-            # Check if we have the message already in the holdback queue. If we
-            # have, take it out and deliver it
-            msg = self._check_for_next_msg(r_i, sender)
-            if msg is not None:
-                if not stop:
-                    self._process_message(msg["data"], msg["addr"])
-            else:
-                stop = True
-                nacks.append(r_i)
-            r_i += 1
+    def _process_held(self, s, sender):
+        """Processes the held back messages of `sender` from `s` on, as long as there is no gap."""
+        next_msg = self._check_for_next_msg(s, sender)
+        while next_msg is not None:
+            self._process_message(next_msg["data"], next_msg["addr"])
+            s += 1
+            next_msg = self._check_for_next_msg(s, sender)
 
-        self._logger.debug(f"TODO nack: {nacks}")
+    def _missing(self, sender, r, s):
+        held = {msg["data"]["S"] for msg in self._holdback.values() if msg["data"]["sender"] == sender}
+        return [r_i for r_i in range(r + 1, s) if r_i not in held]
+
+    def _send_nacks(self, nacks, addr):
+        if not nacks:
+            return
+        ROM_NACKS.labels("requested").inc(len(nacks))
         mesg = {
             "purpose": str(Purpose.NACK),
-            "id": str(uuid.uuid4),
+            "id": str(uuid.uuid4()),
             "nacks": nacks,
         }
-        self._sender_socket.sendto(json.dumps(mesg).encode(), addr)
+        self._unicast(mesg, addr)
+
+    def _request_missing(self, data: dict, addr, s, r):
+        # held back until the gap in front of it is filled, see `_process_held`
+        self._holdback[data["id"]] = {"data": data, "addr": addr}
+        self._send_nacks(self._missing(data["sender"], r, s), addr)
 
     def _handle(self, data: dict, addr):
+        with self._handle_lock:
+            if self._transfer_buffer is not None:
+                self._transfer_buffer.append((data, addr))
+                return
+            self._handle_message(data, addr)
+
+    def _handle_message(self, data: dict, addr):
         if data["purpose"] == str(Purpose.PROP_SEQ):
-            self._collect_order_proposals(data)
+            self._collect_order_proposals(data, addr)
             return
         elif data["purpose"] == str(Purpose.NACK):
             for nack in data["nacks"]:
                 if nack in self._out:
-                    self._sender_socket.sendto(
-                        json.dumps(self._out[nack]).encode(), addr
-                    )
+                    ROM_NACKS.labels("retransmitted").inc()
+                    self._unicast(self._out[nack], addr)
             return
 
         sender = data["sender"]
         id = data["id"]
+        self._addresses[sender] = addr
         if sender not in self._rnumbers:
-            self._logger.error(f"Don't know rnumer {data['sender']}")
+            self._logger.error("Don't know rnumer %s", data['sender'])
             return
 
         # Reliable Multicast
@@ -280,32 +493,45 @@ class ROMulticastHandler(SocketThread):
             s = data["S"]
             if s == self._rnumbers[sender] + 1:
                 self._process_message(data, addr)
-                s += 1
-                next_msg = self._check_for_next_msg(s, sender)
-                while next_msg is not None:
-                    self._process_message(next_msg["data"], addr)
-                    s += 1
-                    next_msg = self._check_for_next_msg(s, sender)
+                self._process_held(s + 1, sender)
             elif s <= self._rnumbers[sender]:
                 self._logger.debug(
-                    f"skipping message {id} from {sender} with {s} and {self._rnumbers}"
+                    "skipping message %s from %s with %s and %s", id, sender, s, self._rnumbers
                 )
             else:
                 self._request_missing(data, addr, s, self._rnumbers[sender])
         else:
+            # another copy of a message we have, it still fills its place in
+            # the sequence of this sender
             if data["S"] == self._rnumbers[sender] + 1:
                 self._rnumbers[data["sender"]] += 1
+                self._process_held(data["S"] + 1, sender)
+
+    def _on_receive(self, data, addr):
+        # with seeds we listen on a public socket, anybody can send us anything
+        try:
+            loaded_data = json.loads(data.decode())
+        except (ValueError, UnicodeDecodeError):
+            self._logger.debug("Ignoring a datagram from %s that is no json.", addr)
+            return
+        if not isinstance(loaded_data, dict) or "purpose" not in loaded_data:
+            self._logger.debug("Ignoring a datagram from %s that is no ROM message.", addr)
+            return
+        count_message("rom", "in", loaded_data, len(data))
+        self._handle(loaded_data, addr)
 
     def run(self):
-        self._logger.debug(f"Listening to rom messages {self._name}")
+        self._logger.debug("Listening to rom messages %s", self._name)
         while not self.stopped:
             try:
                 ready_socks, _, _ = select.select(
                     [self._listener_socket, self._sender_socket], [], [], TIMEOUT
                 )
                 for sock in ready_socks:
-                    data, addr = sock.recvfrom(1024)
-                    self._handle(json.loads(data.decode()), addr)
+                    data, addr = sock.recvfrom(BUFFER_SIZE)
+                    self._on_receive(data, addr)
+                with self._handle_lock:
+                    self._repair()
             except socket.timeout:
                 continue
 
@@ -315,4 +541,4 @@ class ROMulticastHandler(SocketThread):
             self._listener_socket.close()
             self._sender_socket.close()
         except Exception as e:
-            self._logger.error(f"Could not close socket: {e}.")
+            self._logger.error("Could not close socket: %s.", e)
@@ -3,3 +3,5 @@ ON_TCP_MESSAGE = "bar"
 ON_MULTICAST_MESSAGE = "baz"
 ON_ENTRY_REQUEST = "fou"
 ON_HEARTBEAT_TIMEOUT = "tmt"
+ON_STATS_TIMEOUT = "sts"
+ON_JOIN_WINDOW = "jwn"
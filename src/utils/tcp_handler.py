@@ -1,18 +1,41 @@
 import json
 import logging
+import multiprocessing
+import queue
 import socket
 import sys
+import threading
 
 from src.utils.common import SocketThread
-from src.utils.constants import BUFFER_SIZE, LOGGING_LEVEL, MAX_TRIES, TIMEOUT
+from src.utils.constants import (BUFFER_SIZE, LOGGING_LEVEL, MAX_TRIES,
+                                 RETRY_AFTER, TCP_WORKER_START_TIMEOUT,
+                                 TIMEOUT, TRY_AGAIN_BACKLOG, Intention)
+from src.utils.metrics import SHED, count_message
 from src.utils.signals import ON_TCP_MESSAGE
 
 
+def decode_message(payload):
+    """The message in `payload`, None if it isn't a JSON object with an intention."""
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("intention"), str):
+        return None
+    return data
+
+
 class TCPHandler(SocketThread):
     """
     For handling the TCP connections of a participant.
     Expects and returns json data due to our implementation choices.
     """
+    _request_limit = 0  # see limit_requests
+    _retry_after = RETRY_AFTER
+    shed = 0  # requests answered with TRY_AGAIN instead of queued
+    _replies = None  # TRY_AGAINs waiting for the sender thread, see _reply
+    _replies_lock = threading.Lock()
+
     def __init__(self, server_queue, timeout=TIMEOUT):
         """Set up a socket for this listener."""
         super().__init__(server_queue)
@@ -31,7 +54,7 @@ class TCPHandler(SocketThread):
 
         self._logger = logging.getLogger(f"TCPListener")
         self._logger.setLevel(LOGGING_LEVEL)
-        self._logger.debug(f"Binding to addr: {':'.join(map(str, socketname))}")
+        self._logger.debug("Binding to addr: %s", ':'.join(map(str, socketname)))
 
     @property
     def port(self):
@@ -47,6 +70,62 @@ class TCPHandler(SocketThread):
     def set_timeout(self, value):
         self._socket.settimeout(value)
 
+    def limit_requests(self, limit, retry_after=RETRY_AFTER):
+        """
+        Answers REQUEST_ACTIONs with TRY_AGAIN instead of queueing them while
+        `limit` items wait in the server queue, 0 for no limit. Only client
+        requests are bounded this way, everything else is always queued and
+        the server queue itself stays unbounded, the group must not lose
+        protocol messages.
+        """
+        self._request_limit = limit
+        self._retry_after = retry_after
+
+    def try_again(self, data, retry_after=None):
+        """Tells the client of the REQUEST_ACTION `data` to send it again later."""
+        mes = {"intention": str(Intention.TRY_AGAIN), "retry_after": retry_after or self._retry_after}
+        if "key" in data:
+            mes["key"] = data["key"]
+        if "address" in data and "port" in data:
+            self._reply(mes, (data["address"], data["port"]))
+
+    def _reply(self, mes, dest):
+        """
+        Sends `mes` from a sender thread, connecting to every shed client
+        would stall the listener when it is busiest. Drops the reply while
+        TRY_AGAIN_BACKLOG wait, the client sends its request again after its
+        timeout.
+        """
+        with self._replies_lock:
+            if self._replies is None:
+                self._replies = queue.Queue(TRY_AGAIN_BACKLOG)
+                threading.Thread(target=self._send_replies, args=(self._replies,), daemon=True).start()
+        try:
+            self._replies.put_nowait((mes, dest))
+        except queue.Full:
+            self._logger.debug("Dropped a TRY_AGAIN to %s, too many are waiting.", dest)
+
+    def _send_replies(self, replies):
+        while self._open:
+            try:
+                mes, dest = replies.get(timeout=TIMEOUT)
+            except queue.Empty:
+                continue
+            self.send(mes, dest)
+
+    def _emit_message(self, data, addr):
+        if (
+            self._request_limit
+            and data.get("intention") == str(Intention.REQUEST_ACTION)
+            and self._queue.qsize() >= self._request_limit
+        ):
+            # shed before it costs the server anything, accepted work keeps its latency
+            SHED.labels("dispatch").inc()
+            self.shed += 1
+            self.try_again(data)
+            return
+        self.emit(signal=ON_TCP_MESSAGE, data=data, addr=addr)
+
     def send(self, json_msg, dest):
         """
         Encodes and sends json data to the given destination.
@@ -67,6 +146,7 @@ class TCPHandler(SocketThread):
                     sock.close()
                     if res == length:
                         # Successfully sent the correct amount of data
+                        count_message("tcp", "out", json_msg, length)
                         return True
                 except:
                     return False
@@ -82,17 +162,22 @@ class TCPHandler(SocketThread):
             self._socket.listen()
             conn, addr = self._socket.accept()
 
-            msg_data = ""
+            parts = []
 
             while True:
                 res = conn.recv(BUFFER_SIZE)
                 if res:
-                    msg_data += res.decode()
+                    parts.append(res)
                     continue
                 else:
                     break
 
-            data = json.loads(msg_data)
+            payload = b"".join(parts)
+            data = decode_message(payload)
+            if data is None:
+                self._logger.warning("Dropped an invalid message of %s bytes from %s.", len(payload), addr)
+                return None, None
+            count_message("tcp", "in", data, len(payload))
             return data, addr
         except socket.timeout:
             return None, None
@@ -111,11 +196,133 @@ class TCPHandler(SocketThread):
             if not self._paused:
                 data, addr = self.listen()
                 if data:
-                    self.emit(
-                        signal=ON_TCP_MESSAGE,
-                        data=data,
-                        addr=addr,
-                    )
+                    self._emit_message(data, addr)
 
         self._logger.debug("Shutting down.")
         self.close()
+
+
+def _accept_loop(port, events, ready, stopped):
+    """
+    Worker process of a `PooledTCPHandler`. Accepts connections on its own
+    socket bound to `port`, reads and decodes them and puts (data, addr,
+    size) on `events`, data is None for a message that isn't a JSON object
+    with an intention. Doesn't log, the server process does.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("", port))
+    sock.listen()
+    sock.settimeout(TIMEOUT)
+    ready.release()
+
+    while not stopped.is_set():
+        try:
+            conn, addr = sock.accept()
+        except socket.timeout:
+            continue
+        except OSError:
+            break
+        parts = []
+        with conn:
+            try:
+                while True:
+                    part = conn.recv(BUFFER_SIZE)
+                    if not part:
+                        break
+                    parts.append(part)
+            except OSError:
+                pass
+        payload = b"".join(parts)
+        events.put((decode_message(payload), addr, len(payload)))
+    sock.close()
+
+
+class PooledTCPHandler(TCPHandler):
+    """
+    A `TCPHandler` whose connections are accepted, read and decoded by
+    `workers` processes. Each has its own socket bound to our port with
+    SO_REUSEPORT, the kernel spreads the connections over them. This thread
+    only hands the decoded messages on, every decision stays with the one
+    server process.
+
+    The queue pickles the decoded dicts. Unpickling one costs the server
+    process about a third of decoding its JSON for a client request and up
+    to three quarters for an OM round (`python -m src.bench --filter
+    'tcp.pool*'`), plus one pipe read. Passing `marshal` bytes
+    instead halves that for OM rounds but makes the small client requests
+    slower, and those are what floods a server. Pooling pays off when JSON
+    decoding is what keeps the server busy, not for a few small messages.
+    """
+    def __init__(self, server_queue, workers, timeout=TIMEOUT):
+        SocketThread.__init__(self, server_queue)
+        # only holds the port, a socket that doesn't listen gets no connections
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._socket.bind(("", 0))
+        socketname = self._socket.getsockname()
+        self._address = socketname[0]
+        self._port = socketname[1]
+        self._timeout = timeout
+        self._open = True
+        self._paused = False
+
+        self._logger = logging.getLogger(f"TCPListener")
+        self._logger.setLevel(LOGGING_LEVEL)
+
+        # spawn, forking a process with running threads can deadlock the child
+        context = multiprocessing.get_context("spawn")
+        self._events = context.Queue()
+        self._workers_stopped = context.Event()
+        ready = context.Semaphore(0)
+        self._workers = [
+            context.Process(
+                target=_accept_loop,
+                args=(self._port, self._events, ready, self._workers_stopped),
+                daemon=True,
+            )
+            for _ in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+        # we are announced with this port next, somebody has to listen on it
+        for _ in self._workers:
+            if not ready.acquire(timeout=TCP_WORKER_START_TIMEOUT):
+                self.close()
+                raise RuntimeError("TCP workers did not start")
+        self._logger.debug(
+            "Binding to addr: %s with %s worker processes", ':'.join(map(str, socketname)), workers
+        )
+
+    @staticmethod
+    def available():
+        return hasattr(socket, "SO_REUSEPORT")
+
+    def reset_timeout(self):
+        self._timeout = TIMEOUT
+
+    def set_timeout(self, value):
+        self._timeout = value
+
+    def listen(self):
+        """Returns the next message a worker decoded and its sender, if there is one."""
+        try:
+            data, addr, size = self._events.get(timeout=self._timeout)
+        except queue.Empty:
+            return None, None
+        if data is None:
+            self._logger.warning("Dropped an invalid message of %s bytes from %s.", size, addr)
+            return None, None
+        count_message("tcp", "in", data, size)
+        return data, tuple(addr)
+
+    def close(self):
+        if self._open:
+            self._open = False
+            self._workers_stopped.set()
+            for worker in self._workers:
+                if worker.is_alive():
+                    worker.join(2 * TIMEOUT)
+                if worker.is_alive():
+                    worker.terminate()
+            self._socket.close()
@@ -0,0 +1,117 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import uuid
+from threading import Thread
+
+from src.utils.common import summarize
+from src.utils.constants import LOGGING_LEVEL, TRACE_MAX_PER_MESSAGE
+
+
+class Tracer:
+    """
+    Records spans of sampled admission requests to a JSONL file.
+
+    The client decides whether a request is sampled by attaching a trace id to
+    its REQUEST_ACTION, every message caused by that request carries the id on.
+    Servers only record spans for messages that carry an id and only if a trace
+    file is configured, so unsampled requests cost one dict lookup per stage.
+    Lines are written by a background thread, one JSON object per span:
+    {"trace", "span", "service", "start", "duration", ...attributes}.
+    """
+    def __init__(self):
+        self.path = None
+        self.sample_rate = 0.0
+        self._queue = None
+        self._thread = None
+        self._random = random.Random()
+        self._logger = logging.getLogger("Tracer")
+        self._logger.setLevel(LOGGING_LEVEL)
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def configure(self, path, sample_rate=0.0):
+        """Start writing spans to `path`, sampling `sample_rate` of the requests we originate."""
+        self.close()
+        self.path = os.path.expanduser(path)
+        self.sample_rate = sample_rate
+        self._queue = queue.SimpleQueue()
+        self._thread = Thread(target=self._write, args=(self._queue, self.path), daemon=True)
+        self._thread.start()
+        self._logger.info("Writing traces to %s with sample rate %s", self.path, sample_rate)
+
+    def new_trace(self):
+        """Returns a fresh trace id if this request should be sampled, None otherwise."""
+        if not self.enabled or self._random.random() >= self.sample_rate:
+            return None
+        return uuid.uuid4().hex[:16]
+
+    def span(self, trace, name, service, start, end, **attributes):
+        if not self.enabled or trace is None:
+            return
+        self._queue.put({
+            "trace": trace,
+            "span": name,
+            "service": service,
+            "start": start,
+            "duration": end - start,
+            **attributes,
+        })
+
+    def spans(self, traces, name, service, start, end, **attributes):
+        """Same span for every trace of a batch, e.g. all requests behind one LOCK."""
+        for trace in traces or ():
+            self.span(trace, name, service, start, end, **attributes)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(2)
+        self.path = None
+        self._queue = None
+        self._thread = None
+
+    def _write(self, spans, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "a") as f:
+            while True:
+                span = spans.get()
+                if span is None:
+                    break
+                f.write(json.dumps(span) + "\n")
+                # only hit the disk once the burst is written
+                try:
+                    while True:
+                        span = spans.get_nowait()
+                        if span is None:
+                            return
+                        f.write(json.dumps(span) + "\n")
+                except queue.Empty:
+                    f.flush()
+
+
+def attach(mesg, traces):
+    """Carries up to TRACE_MAX_PER_MESSAGE trace ids on `mesg`, keeps datagrams small."""
+    traces = [trace for trace in traces if trace is not None][:TRACE_MAX_PER_MESSAGE]
+    if traces:
+        mesg["traces"] = traces
+    return mesg
+
+
+def report(path):
+    """Duration summary per span name of a trace file, in milliseconds."""
+    durations = {}
+    with open(os.path.expanduser(path)) as f:
+        for line in f:
+            span = json.loads(line)
+            durations.setdefault(span["span"], []).append(1000 * span["duration"])
+    return {name: summarize(values) for name, values in sorted(durations.items())}
+
+
+TRACER = Tracer()
+atexit.register(TRACER.close)
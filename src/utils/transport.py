@@ -0,0 +1,77 @@
+import datetime
+import logging
+import queue
+import time
+from threading import Timer
+from uuid import uuid4
+
+from src.utils.broadcast_handler import BroadcastHandler
+from src.utils.common import RepeatTimer, get_hostname, get_real_ip
+from src.utils.constants import BROADCAST_PORT, LOGGING_LEVEL
+from src.utils.rom_handler import ROMulticastHandler
+from src.utils.tcp_handler import PooledTCPHandler, TCPHandler
+
+
+class SocketTransport:
+    """
+    Everything a server needs from the outside world: sockets, timers, the
+    clock and identifiers. The simulator in `src.sim` provides the same
+    interface on top of a virtual network.
+
+    With `seeds`, a list of (ip, port), peers are discovered by gossip with
+    the seeds on `gossip_port` instead of by broadcast and ROM messages are
+    sent to each member instead of multicast, for networks that have neither.
+    With `tcp_workers` incoming TCP messages are read and decoded by that many
+    processes, see `PooledTCPHandler`.
+    """
+    def __init__(self, seeds=None, gossip_port=BROADCAST_PORT, tcp_workers=0):
+        self._seeds = seeds
+        self._gossip_port = gossip_port
+        self._tcp_workers = tcp_workers
+
+    def queue(self):
+        return queue.SimpleQueue()
+
+    def tcp_handler(self, server_queue):
+        if self._tcp_workers > 0:
+            if PooledTCPHandler.available():
+                return PooledTCPHandler(server_queue, self._tcp_workers)
+            logger = logging.getLogger("Transport")
+            logger.setLevel(LOGGING_LEVEL)
+            logger.error("SO_REUSEPORT is not available, reading TCP messages in this process.")
+        return TCPHandler(server_queue)
+
+    def broadcast_handler(self, server_queue):
+        return BroadcastHandler(server_queue, seeds=self._seeds, port=self._gossip_port)
+
+    def rom_handler(self, id, view, server_queue, port=None):
+        """`port` is where members reach us without multicast, only used with seeds."""
+        return ROMulticastHandler(id, view, server_queue, unicast_port=port if self._seeds else None)
+
+    def timer(self, interval, function, args=None):
+        return RepeatTimer(interval, function, args=args)
+
+    def call_later(self, delay, function, args=None):
+        """Calls `function` once after `delay` seconds, `cancel` on the result stops it."""
+        timer = Timer(delay, function, args=args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def now(self):
+        return datetime.datetime.now().timestamp()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def uuid(self):
+        return str(uuid4())
+
+    def address(self):
+        if self._seeds:
+            # the interface the seeds are reachable on
+            return get_real_ip(self._seeds[0][0])
+        return get_real_ip()
+
+    def hostname(self):
+        return get_hostname()
@@ -0,0 +1,36 @@
+import logging
+
+import pytest
+
+from src.sim.simulation import Simulation
+
+
+@pytest.fixture(autouse=True)
+def quiet_logs():
+    logging.disable(logging.CRITICAL)
+    yield
+    logging.disable(logging.NOTSET)
+
+
+@pytest.fixture
+def cluster():
+    """Starts a simulated cluster of `servers` and waits until it converged."""
+    def start(servers=4, seed=0, agreement="om", server_options=None, **network_options):
+        sim = Simulation(seed=seed, agreement=agreement, **network_options)
+        for _ in range(servers):
+            sim.add_server(**(server_options or {}))
+            sim.run_for(0.5)
+        assert sim.measure("converge", sim.converged, 60)
+        return sim
+    return start
+
+
+def settled(sim, expected, namespace=None, timeout=30):
+    """Runs until every server delivered `expected` as count of `namespace`, returns the counts."""
+    def counts():
+        return {
+            server._namespace(namespace).delivered_entries if namespace else server._default.delivered_entries
+            for server in sim.servers
+        }
+    sim.network.run_until(lambda: counts() == {expected}, sim.network.now + timeout)
+    return counts()
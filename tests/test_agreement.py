@@ -0,0 +1,80 @@
+import secrets
+
+from src.utils import agreement
+from src.utils.agreement import ENGINES, Keyring
+
+
+def pairwise_keyrings(members):
+    shared = {}
+    for a in members:
+        for b in members:
+            if a < b:
+                shared[(a, b)] = shared[(b, a)] = secrets.token_hex(32)
+    return {me: Keyring({uuid: shared[(me, uuid)] for uuid in members if uuid != me}) for me in members}
+
+
+def run(name, values, leader_value, faulty=1, keyrings=None, leader_keyring=None, monkeypatch=None):
+    """
+    Runs one agreement between the leader `l` and members holding `values`,
+    returns their engines. A dict as `leader_value` is a leader that tells
+    every member something else.
+    """
+    members = sorted(values) + ["l"]
+    if monkeypatch is not None:
+        monkeypatch.setattr(agreement, "get_keyring", lambda: leader_keyring)
+    if not isinstance(leader_value, dict):
+        leader_value = dict.fromkeys(values, leader_value)
+    engines = {uuid: ENGINES[name]("run", uuid, value) for uuid, value in values.items()}
+    if keyrings is not None:
+        for uuid, engine in engines.items():
+            engine._keyring = keyrings.get(uuid)
+    queue = [
+        (uuid, {"id": "run", "from": "l", **ENGINES[name].initial("run", "l", sorted(members), leader_value[uuid], faulty)})
+        for uuid in engines
+    ]
+    while queue:
+        uuid, message = queue.pop(0)
+        engine = engines[uuid]
+        engine.add(message)
+        for to, payload in engine.advance():
+            queue.append((to, {"id": "run", "from": uuid, **payload}))
+    return engines
+
+
+def test_king_agrees_on_leader_value():
+    engines = run("king", {"a": 1, "b": 2, "c": 3, "d": 4, "e": 5}, 7)
+    assert {engine.result for engine in engines.values()} == {7}
+    # the leaders f, not one derived from the participants
+    assert {engine.faulty for engine in engines.values()} == {1}
+
+
+def test_king_agrees_when_the_leader_equivocates():
+    engines = run("king", {"a": 1, "b": 2, "c": 3}, {"a": 5, "b": 6, "c": 7})
+    assert len({engine.result for engine in engines.values()}) == 1
+
+
+def test_signed_agrees_with_pairwise_keys(monkeypatch):
+    keyrings = pairwise_keyrings(["a", "b", "c", "l"])
+    engines = run("signed", {"a": 1, "b": 2, "c": 3}, 7, keyrings=keyrings,
+                  leader_keyring=keyrings["l"], monkeypatch=monkeypatch)
+    assert {engine.result for engine in engines.values()} == {7}
+
+
+def test_signed_rejects_unlisted_and_forged_signers(monkeypatch):
+    keyrings = pairwise_keyrings(["a", "b", "c", "l"])
+    # a member that shares no key with the leader can't forge its signature
+    forger = Keyring({uuid: secrets.token_hex(32) for uuid in ["a", "b", "c"]})
+    engines = run("signed", {"a": 1, "b": 2, "c": 3}, 7, keyrings=keyrings,
+                  leader_keyring=forger, monkeypatch=monkeypatch)
+    # nobody falls back to its own value, they agree on having no value
+    assert {engine.result for engine in engines.values()} == {None}
+    assert not Keyring({}).verify("l", "a", b"message", keyrings["l"].sign(b"message", ["a"]))
+
+
+def test_signed_without_key_file_reports(monkeypatch):
+    keyrings = pairwise_keyrings(["a", "b", "c", "l"])
+    keyrings.pop("b")
+    engines = run("signed", {"a": 1, "b": 2, "c": 3}, 7, keyrings=keyrings,
+                  leader_keyring=keyrings["l"], monkeypatch=monkeypatch)
+    assert engines["b"].done and engines["b"].result is None
+    assert "cannot verify" in engines["b"].error
@@ -0,0 +1,41 @@
+import json
+import queue
+
+import pytest
+
+from src.utils.broadcast_handler import BroadcastHandler
+from src.utils.constants import BUFFER_SIZE, Intention
+
+
+@pytest.fixture
+def handler():
+    handler = BroadcastHandler(queue.SimpleQueue(), seeds=[("127.0.0.1", 9)], port=0)
+    yield handler
+    handler.listen_socket.close()
+
+
+def test_gossip_fits_into_datagrams(handler):
+    for i in range(200):
+        handler._peers[(f"10.0.{i // 250}.{i % 250}", 40000 + i)] = 0
+    sent = []
+    handler._sendto = lambda payload, peer: sent.append(payload)
+    handler._gossip()
+    assert all(len(payload) <= BUFFER_SIZE for payload in sent)
+    gossiped = {(ip, port) for payload in sent for ip, port, _ in json.loads(payload)["peers"]}
+    assert gossiped == set(handler._peers)
+
+
+def test_only_servers_and_gossip_are_learned(handler):
+    def receive(mesg, addr):
+        handler._on_receive(json.dumps({"msg_uuid": addr[1], **mesg}).encode(), addr)
+
+    receive({"intention": str(Intention.IDENT_CLIENT)}, ("10.0.0.1", 1))
+    receive({"intention": str(Intention.IDENT_SERVER)}, ("10.0.0.2", 2))
+    receive({"intention": str(Intention.GOSSIP), "peers": [["10.0.0.4", 4, 0], "junk"]}, ("10.0.0.3", 3))
+    assert set(handler.peers) == {("127.0.0.1", 9), ("10.0.0.2", 2), ("10.0.0.3", 3), ("10.0.0.4", 4)}
+
+
+def test_malformed_datagrams_are_ignored(handler):
+    for data in (b"\xff\xfe", b"not json", b"[1, 2]", b'{"intention": "x"}'):
+        handler._on_receive(data, ("10.0.0.1", 1))
+    assert handler.peers == [("127.0.0.1", 9)]
@@ -0,0 +1,43 @@
+import pytest
+
+from src.client.client import Client
+from src.client.signals import ON_ACCESS_RESPONSE
+from src.utils.constants import Intention
+
+
+@pytest.fixture
+def client():
+    client = Client(1, seeds=[("127.0.0.1", 9)])
+    client.find_server = lambda: None
+    yield client
+    client._tcp_listener.close()
+    client._broadcast_handler.listen_socket.close()
+
+
+def responses(client):
+    found = []
+    while not client.UI_QUEUE.empty():
+        item = client.UI_QUEUE.get()
+        if item.signal == ON_ACCESS_RESPONSE:
+            found.append(item.kwargs["response"]["status"])
+    return found
+
+
+def test_requests_without_a_server_fail_visibly(client):
+    assert client._on_action_request() is None
+    assert client._pending is None
+    assert responses(client) == [False]
+
+
+@pytest.mark.parametrize("inc, answer", [
+    (True, Intention.ACCEPT_ENTRY), (True, Intention.DENY_ENTRY), (False, Intention.UPDATE_ENTRIES),
+])
+def test_decisions_forget_the_pending_request(client, inc, answer):
+    client.server = ("127.0.0.1", 9)
+    client._tcp_listener.send = lambda mes, dest: True
+    key = client._on_action_request(inc)
+    assert client._pending[0] == key
+    client._on_tcp_msg(data={"intention": str(answer), "key": "another", "entries": 1})
+    assert client._pending is not None
+    client._on_tcp_msg(data={"intention": str(answer), "key": key, "entries": 1})
+    assert client._pending is None
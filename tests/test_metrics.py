@@ -0,0 +1,12 @@
+from src.utils.metrics import QUEUE_DEPTH, REGISTRY, ROM_HOLDBACK, ROM_PENDING
+
+
+def test_queue_gauges_per_server(cluster):
+    sim = cluster(3)
+    exposed = REGISTRY.expose()
+    for gauge in (QUEUE_DEPTH, ROM_HOLDBACK, ROM_PENDING):
+        for server in sim.servers:
+            assert f'{gauge.name}{{server="{server._uuid}"}} 0' in exposed
+    server = sim.servers[0]
+    QUEUE_DEPTH.remove(server._uuid)
+    assert f'server="{server._uuid}"' not in "\n".join(QUEUE_DEPTH.samples())
@@ -0,0 +1,69 @@
+from src.utils.constants import ROM_REPAIR_INTERVAL, Purpose
+
+
+def test_proposals_go_to_the_original_sender(cluster):
+    sim = cluster(3)
+    member, original, relayer = sim.servers
+    original._rom_handler.send({"uuid": original._uuid, "intention": "test"})
+    sim.run_for(1)
+    sent = []
+    member._rom_handler._unicast = lambda mesg, addr: sent.append((mesg["purpose"], tuple(addr)))
+    # the first copy of the message reaches us relayed by somebody else
+    relayed = {
+        "purpose": str(Purpose.REAL_MSG), "id": "relayed", "original": original._uuid,
+        "sender": relayer._uuid, "uuid": original._uuid, "intention": "test",
+    }
+    member._rom_handler._propose_order(relayed, relayer._rom_handler._address)
+    assert sent == [(str(Purpose.PROP_SEQ), original._rom_handler._address)]
+
+
+def deliveries(sim):
+    """Records the labels of test messages every server delivers."""
+    delivered = {}
+    for server in sim.servers:
+        order, deliver = delivered.setdefault(server._uuid, []), server._rom_handler._deliver
+        server._rom_handler._deliver = lambda mesg, order=order, deliver=deliver: (
+            order.append(mesg["label"]) if "label" in mesg else deliver(mesg)
+        )
+    return delivered
+
+
+def test_lost_proposals_are_sent_again(cluster):
+    sim = cluster(3)
+    delivered = deliveries(sim)
+    member = sim.servers[1]
+    unicast, lost = member._rom_handler._unicast, []
+    # the only proposal of this member for the message gets lost
+    member._rom_handler._unicast = lambda mesg, addr: (
+        lost.append(mesg) if mesg["purpose"] == str(Purpose.PROP_SEQ) and not lost else unicast(mesg, addr)
+    )
+    sim.servers[0]._rom_handler.send({"uuid": sim.servers[0]._uuid, "intention": "test", "label": "a"})
+    sim.run_for(ROM_REPAIR_INTERVAL * 3)
+    assert lost
+    assert all(order == ["a"] for order in delivered.values())
+
+
+def test_lost_retransmissions_are_requested_again(cluster):
+    sim = cluster(3)
+    delivered = deliveries(sim)
+    sender, member = sim.servers[0], sim.servers[1]
+    handle, until = member._rom_handler._handle_message, sim.network.now + ROM_REPAIR_INTERVAL / 2
+    # every copy of "a" and the first retransmission after the NACK get lost
+    member._rom_handler._handle_message = lambda data, addr: (
+        None if data.get("label") == "a" and sim.network.now < until else handle(data, addr)
+    )
+    for label in ("a", "b"):
+        sender._rom_handler.send({"uuid": sender._uuid, "intention": "test", "label": label})
+    sim.run_for(ROM_REPAIR_INTERVAL * 3)
+    assert all(order == ["a", "b"] for order in delivered.values())
+
+
+def test_malformed_datagrams_are_ignored(cluster):
+    sim = cluster(3)
+    rom = sim.servers[0]._rom_handler
+    for data in (b"\xff\xfe", b"not json", b"[1, 2]", b'{"sender": "x"}'):
+        rom._on_receive(data, ("10.0.0.9", 1))
+    delivered = deliveries(sim)
+    sim.servers[1]._rom_handler.send({"uuid": sim.servers[1]._uuid, "intention": "test", "label": "a"})
+    sim.run_for(1)
+    assert all(order == ["a"] for order in delivered.values())
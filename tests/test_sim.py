@@ -0,0 +1,370 @@
+from src.sim.simulation import SimClient, Simulation
+from src.utils.constants import (AGREEMENT_PENDING_RUNS, DEFAULT_NAMESPACE,
+                                 DIAGNOSTICS_MAX_SECONDS, JOIN_WAIT,
+                                 JOIN_WAIT_MIN, JOIN_WINDOW, MAX_ENTRIES,
+                                 TIMEOUT, Intention, State)
+from src.utils.dedup import short_key
+from src.utils.persistence import MembersCache, Store
+
+from .conftest import settled
+
+
+def test_entries_converge(cluster):
+    sim = cluster(4)
+    decisions = sim.admit(30)
+    assert decisions == {"accepted": MAX_ENTRIES, "denied": 30 - MAX_ENTRIES}
+    assert settled(sim, MAX_ENTRIES) == {MAX_ENTRIES}
+    assert {server._default.entries for server in sim.servers} == {MAX_ENTRIES}
+
+
+def test_same_seed_same_run(cluster):
+    reports = []
+    for _ in range(2):
+        sim = cluster(3, seed=7)
+        sim.admit(10)
+        reports.append((sim.network.now, sim.network.events))
+    assert reports[0] == reports[1]
+
+
+def test_election_after_leader_crash(cluster):
+    sim = cluster(4)
+    old = sim.leader()
+    assert sim.elect()
+    leader = sim.leader()
+    assert leader is not None and leader is not old
+    assert all(server._current_leader == leader._uuid for server in sim.servers)
+    assert sum(server._state == State.LEADER for server in sim.servers) == 1
+    # the survivors still admit
+    assert sim.admit(5) == {"accepted": 5, "denied": 0}
+    assert settled(sim, 5) == {5}
+
+
+def test_lossy_network(cluster):
+    for seed in range(3):
+        sim = cluster(4, seed=seed, loss=0.05)
+        decisions = sim.admit(30, timeout=60)
+        assert decisions == {"accepted": MAX_ENTRIES, "denied": 30 - MAX_ENTRIES}
+        assert settled(sim, MAX_ENTRIES) == {MAX_ENTRIES}
+        # nothing is stuck waiting for an agreed order
+        sim.run_for(2)
+        assert not any(server._rom_handler._priorities for server in sim.servers)
+
+
+def test_agreement_corrects_divergence(cluster):
+    for engine in ("om", "king"):
+        sim = cluster(5, agreement=engine)
+        sim.admit(6)
+        assert settled(sim, 6) == {6}
+        faulty = next(server for server in sim.servers if server is not sim.leader())
+        faulty._default.entries = faulty._default.delivered_entries = 3
+        assert sim.agree()
+        assert {server._default.delivered_entries for server in sim.servers} == {6}
+
+
+def test_correction_rebases_updates_computed_before_it(cluster):
+    sim = cluster(4)
+    sim.admit(6)
+    assert settled(sim, 6) == {6}
+    server, holder = sim.servers[0], sim.servers[1]
+    server._byzantine_epochs = {"epoch": server._encode_state({DEFAULT_NAMESPACE: 6})}
+    server._on_rom_msg({
+        "uuid": holder._uuid, "intention": str(Intention.OM_RESULT),
+        "epoch": "epoch", "result": server._encode_state({DEFAULT_NAMESPACE: 4}),
+    })
+    assert server._default.delivered_entries == 4
+    # the holder counted one more entry before it delivered the correction
+    server._on_rom_msg({
+        "uuid": holder._uuid, "intention": str(Intention.UPDATE_ENTRIES),
+        "namespace": DEFAULT_NAMESPACE, "entries": 7, "corrected": 0,
+    })
+    assert server._default.delivered_entries == server._default.entries == 5
+
+
+def test_early_agreement_messages_are_bounded(cluster):
+    sim = cluster(4)
+    server = sim.servers[1]
+    for run in range(10):
+        server._on_byzantine_om({"id": f"run-{run}", "engine": "om", "from": "leader", "round": 1})
+    assert list(server._byzantine_pending) == [f"run-{run}" for run in range(10 - AGREEMENT_PENDING_RUNS, 10)]
+
+
+def test_digests_match_at_the_same_sequence(cluster):
+    sim = cluster(4)
+    sim.admit(6)
+    # a late joiner continues the count of the leader
+    sim.add_server()
+    assert sim.measure("converge", sim.converged, 60)
+    sim.admit(6)
+    assert settled(sim, 12) == {12}
+    sim.run_for(2)
+    assert len({server._delivered_seq for server in sim.servers}) == 1
+    assert len({server._digests[server._delivered_seq] for server in sim.servers}) == 1
+    assert not any(server._divergent for server in sim.servers)
+
+
+def test_exits_are_acknowledged_by_key(cluster):
+    sim = cluster(4)
+    sim.admit(3)
+    client = SimClient(sim.network, None)
+    client.request(sim.servers[1], increase=False)
+    sim.network.run_until(lambda: not client._requests, sim.network.now + 30)
+    assert client.decisions == {"accepted": 0, "denied": 0, "left": 1}
+    assert settled(sim, 2) == {2}
+
+
+def test_diagnostics_are_off_by_default(cluster):
+    for enabled in (False, True):
+        sim = cluster(1, server_options={"diagnostics": enabled})
+        server = sim.servers[0]
+        results = []
+        server._send_diagnostics = lambda data, result: results.append(result)
+        server._on_diagnostics({"command": "state", "address": "client", "port": 1})
+        assert ("error" in results[0]) != enabled
+        if enabled:
+            started = []
+            server._profiler.start = lambda seconds=None, callback=None: started.append(seconds) or True
+            server._on_diagnostics({"command": "profile", "seconds": 10 ** 6, "address": "client", "port": 1})
+            assert started == [DIAGNOSTICS_MAX_SECONDS]
+
+
+def test_decisions_survive_a_restart(cluster, tmp_path):
+    sim = cluster(1, server_options={"store": Store(tmp_path / "server")})
+    server = sim.servers[0]
+    client = SimClient(sim.network, None)
+    client.request(server, key="turnstile/1")
+    sim.network.run_until(lambda: not client._requests, sim.network.now + 30)
+    assert settled(sim, 1) == {1}
+    server._store.close()
+
+    store = Store(tmp_path / "server")
+    assert store.state["dedup"] == {short_key("turnstile/1"): "accepted"}
+    assert store.state["seq"] == server._delivered_seq
+    restarted = Simulation(seed=1).add_server(store=store)
+    assert restarted._decisions.get(short_key("turnstile/1")) == "accepted"
+    store.close()
+
+
+def test_concurrent_joins_are_admitted_in_batches(cluster):
+    sim = cluster(2)
+    leader = sim.leader()
+    distributed = []
+    distribute = leader._distribute_group_view
+    leader._distribute_group_view = lambda full=False: distributed.append(len(leader._group_view)) or distribute(full)
+    for i in range(5):
+        # something that listens, with a smaller uuid than the leader so there is no election
+        joiner = SimClient(sim.network, None)
+        leader._on_join_request({
+            "intention": str(Intention.IDENT_SERVER), "uuid": f"0-joiner-{i}",
+            "address": joiner.address, "port": joiner.port, "join": f"join-{i}",
+        })
+    sim.run_for(2 * JOIN_WINDOW)
+    # the first one right away, the others together after the window
+    assert distributed[:2] == [3, 7]
+
+
+def test_full_view_carries_restarts(cluster):
+    sim = cluster(3)
+    leader = sim.leader()
+    member, restarted = [server for server in sim.servers if server is not leader]
+    registered = []
+    member._rom_handler.register_new_member = registered.append
+    # the member missed the delta saying that `restarted` started over
+    leader._incarnations[restarted._uuid] = 1
+    member._on_received_grp_view(leader._full_view())
+    assert registered == [restarted._uuid]
+    member._on_received_grp_view(leader._full_view())
+    assert registered == [restarted._uuid]
+
+
+def test_restarted_member_rejoins(tmp_path):
+    for seed in (0, 4):
+        sim = Simulation(seed=seed)
+        for i in range(3):
+            sim.add_server(store=Store(tmp_path / f"{seed}-{i}"))
+            sim.run_for(0.5)
+        assert sim.measure("converge", sim.converged, 60)
+        sim.admit(4)
+        assert settled(sim, 4) == {4}
+        member = next(server for server in sim.servers if server is not sim.leader())
+        sim.crash(member)
+        member._store.close()
+        sim.run_for(1)
+        # back with the same uuid before the others noticed it was gone
+        sim.add_server(store=Store(member._store.directory))
+        assert sim.measure("converge", sim.converged, 60)
+        assert sim.admit(4) == {"accepted": 4, "denied": 0}
+        assert settled(sim, 8) == {8}
+
+
+def test_agreement_covers_every_namespace(cluster):
+    sim = cluster(5)
+    sim.admit(8, namespaces=["hall", "hall/balcony"])
+    assert settled(sim, 4, "hall") == {4}
+    faulty = next(server for server in sim.servers if server is not sim.leader())
+    balcony = faulty._namespace("hall/balcony")
+    balcony.entries = balcony.delivered_entries = 1
+    assert sim.agree()
+    assert settled(sim, 4, "hall/balcony") == {4}
+
+
+def test_exits_never_go_below_zero(cluster):
+    sim = cluster(3)
+    client = SimClient(sim.network, None)
+    client.request(sim.servers[0], increase=False, count=3)
+    sim.network.run_until(lambda: not client._requests, sim.network.now + 30)
+    assert settled(sim, 0) == {0}
+    assert {server._default.entries for server in sim.servers} == {0}
+
+
+def test_servers_join_from_the_members_cache(tmp_path):
+    sim = Simulation(seed=0)
+    for _ in range(2):
+        sim.add_server(members_cache=MembersCache(tmp_path / "members.json"))
+        sim.run_for(0.5)
+    assert sim.measure("converge", sim.converged, 60)
+    # nobody hears the broadcast, only asking the cached members directly works
+    sim.network.broadcast.clear()
+    start = sim.network.now
+    server = sim.add_server(members_cache=MembersCache(tmp_path / "members.json"))
+    assert sim.network.now - start < TIMEOUT
+    assert server._state == State.MEMBER
+    assert server._current_leader == sim.leader()._uuid
+
+
+def test_stale_members_cache_waits_less(tmp_path):
+    cache = MembersCache(tmp_path / "members.json")
+    cache.write(("10.9.9.9", 1), [("10.9.9.9", 1)], join_seconds=0.005)
+    sim = Simulation(seed=0)
+    start = sim.network.now
+    server = sim.add_server(members_cache=cache)
+    assert server._state == State.LEADER
+    assert sim.network.now - start < JOIN_WAIT
+    assert sim.network.now - start >= JOIN_WAIT_MIN
+
+
+def test_groups_are_admitted_all_or_nothing(cluster):
+    sim = cluster(3, server_options={"capacities": {"hall": 10}})
+    client = SimClient(sim.network, "hall")
+    for server, increase, count, expected in (
+        (sim.servers[0], True, 6, 6),
+        # would overfill the hall, nobody of the group gets in
+        (sim.servers[1], True, 6, 6),
+        (sim.servers[2], True, 4, 10),
+        (sim.servers[0], False, 3, 7),
+    ):
+        client.request(server, increase=increase, count=count)
+        sim.network.run_until(lambda: not client._requests, sim.network.now + 30)
+        assert settled(sim, expected, "hall") == {expected}
+    assert client.decisions == {"accepted": 2, "denied": 1, "left": 1}
+
+
+def test_retried_and_hedged_requests_count_once(cluster):
+    sim = cluster(3)
+    client = SimClient(sim.network, None)
+    client.request(sim.servers[0], key="turnstile/1")
+    sim.network.run_until(lambda: not client._requests, sim.network.now + 30)
+    # the reply got lost, the client asks again
+    client.request(sim.servers[0], key="turnstile/1")
+    # hedged to two servers at once
+    client.request(sim.servers[1], key="turnstile/2")
+    client.request(sim.servers[2], key="turnstile/2")
+    sim.network.run_until(lambda: client.decisions["accepted"] == 4, sim.network.now + 30)
+    assert client.decisions == {"accepted": 4, "denied": 0, "left": 0}
+    assert settled(sim, 2) == {2}
+
+
+def test_joiners_get_the_decisions(cluster):
+    sim = cluster(2)
+    client = SimClient(sim.network, None)
+    client.request(sim.servers[0], key="turnstile/1")
+    sim.network.run_until(lambda: not client._requests, sim.network.now + 30)
+    assert settled(sim, 1) == {1}
+    joiner = sim.add_server()
+    assert sim.measure("converge", sim.converged, 60)
+    assert joiner._decisions.get(short_key("turnstile/1")) == "accepted"
+    client.request(joiner, key="turnstile/1")
+    sim.network.run_until(lambda: not client._requests, sim.network.now + 30)
+    assert client.decisions["accepted"] == 2
+    assert settled(sim, 1) == {1}
+
+
+def test_shed_requests_are_sent_again(cluster):
+    sim = cluster(2, server_options={"request_limit": 2})
+    client = SimClient(sim.network, None)
+    for _ in range(10):
+        client.request(sim.servers[0])
+    sim.network.run_until(lambda: not client._requests, sim.network.now + 60)
+    assert client.try_again > 0
+    assert client.decisions == {"accepted": 10, "denied": 0, "left": 0}
+    assert settled(sim, 10) == {10}
+
+
+def test_king_tolerates_a_lying_participant(cluster):
+    sim = cluster(4, agreement="king")
+    sim.admit(6)
+    assert settled(sim, 6) == {6}
+    leader = sim.leader()
+    # the king of the first phase, it tells everyone a count of 3
+    liar = next(server for server in sim.servers if server._uuid == min(set(leader._group_view) - {leader._uuid}))
+    lie = liar._encode_state({DEFAULT_NAMESPACE: 3})
+    send = liar._tcp_handler.send
+    liar._tcp_handler.send = lambda mes, dest: send(dict(mes, v=lie) if "v" in mes else mes, dest)
+    assert sim.agree()
+    assert {server._default.delivered_entries for server in sim.servers if server is not liar} == {6}
+
+
+def test_no_common_value_keeps_the_entries(cluster):
+    sim = cluster(4)
+    sim.admit(6)
+    assert settled(sim, 6) == {6}
+    server = sim.servers[0]
+    server._byzantine_epochs = {"epoch": server._encode_state({DEFAULT_NAMESPACE: 6})}
+    server._on_rom_msg({
+        "uuid": sim.leader()._uuid, "intention": str(Intention.OM_RESULT), "epoch": "epoch", "result": None,
+    })
+    assert server._default.delivered_entries == 6
+    assert not server._byzantine_epochs
+
+
+def test_rom_delivers_in_one_order_everywhere(cluster):
+    sim = cluster(4)
+    orders = []
+    for server in sim.servers:
+        order, deliver = [], server._rom_handler._deliver
+        server._rom_handler._deliver = lambda mesg, order=order, deliver=deliver: (
+            order.append(mesg["label"]) if "label" in mesg else deliver(mesg)
+        )
+        orders.append(order)
+    # every server multicasts at once, the FIN_SEQs arrive in different orders
+    for round in range(5):
+        for i, server in enumerate(sim.servers):
+            server._rom_handler.send({"uuid": server._uuid, "intention": "test", "label": f"{round}-{i}"})
+    sim.run_for(2)
+    assert len(orders[0]) == 20
+    assert all(order == orders[0] for order in orders)
+
+
+def test_election_messages_skip_unreachable_neighbors(cluster):
+    sim = cluster(4)
+    server = next(server for server in sim.servers if server is not sim.leader())
+    neighbor = next(s for s in sim.servers if s._uuid == server._get_neighbor())
+    after = next(s for s in sim.servers if s._uuid == server._get_neighbor(neighbor._uuid))
+    sim.crash(neighbor)
+    received = []
+    emit = after._tcp_handler._emit_message
+    after._tcp_handler._emit_message = lambda data, addr: (
+        received.append(data["mid"]) if data["intention"] == str(Intention.ELECTION_MESSAGE) else emit(data, addr)
+    )
+    # a candidate we were passing on, restarting the election would replace it with our own
+    server._send_election_message({"intention": str(Intention.ELECTION_MESSAGE), "mid": "candidate", "is_leader": False})
+    sim.run_for(1)
+    assert received == ["candidate"]
+    assert neighbor._uuid not in server._group_view
+
+
+def test_join_wait_does_not_depend_on_the_capacity(monkeypatch):
+    monkeypatch.setattr("src.server.server.MAX_ENTRIES", 10 ** 6)
+    sim = Simulation(seed=0)
+    start = sim.network.now
+    assert sim.add_server()._state == State.LEADER
+    assert sim.network.now - start < 2 * JOIN_WAIT
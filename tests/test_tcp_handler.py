@@ -0,0 +1,66 @@
+import queue
+import socket
+import threading
+
+import pytest
+
+from src.utils.constants import Intention
+from src.utils.tcp_handler import TCPHandler
+
+
+@pytest.fixture
+def handlers():
+    server_queue = queue.Queue()
+    listener = TCPHandler(server_queue)
+    listener.limit_requests(2, retry_after=0.5)
+    client = TCPHandler(queue.Queue())
+    client._socket.listen()
+    yield listener, server_queue, client
+    listener.close()
+    client.close()
+
+
+def request(client, key):
+    return {
+        "intention": str(Intention.REQUEST_ACTION), "key": key,
+        "address": "127.0.0.1", "port": client.port, "increase": True,
+    }
+
+
+def test_only_requests_are_shed(handlers):
+    listener, server_queue, client = handlers
+    for key in ("a", "b", "c"):
+        listener._emit_message(request(client, key), ("127.0.0.1", client.port))
+    # protocol messages are queued however full the queue is
+    listener._emit_message({"intention": str(Intention.HEARTBEAT)}, ("127.0.0.1", 1))
+    assert server_queue.qsize() == 3
+    assert listener.shed == 1
+    data, _ = client.listen()
+    assert data == {"intention": str(Intention.TRY_AGAIN), "retry_after": 0.5, "key": "c"}
+
+
+def test_try_again_does_not_block_the_listener(handlers):
+    listener, server_queue, client = handlers
+    release = threading.Event()
+    sent = []
+    send = listener.send
+    # a client that takes its time to accept the connection
+    listener.send = lambda mes, dest: release.wait(10) and sent.append(send(mes, dest))
+    for key in ("a", "b", "c", "d"):
+        listener._emit_message(request(client, key), ("127.0.0.1", client.port))
+    assert listener.shed == 2 and not sent
+    release.set()
+    keys = {client.listen()[0]["key"] for _ in range(2)}
+    assert keys == {"c", "d"}
+
+
+def test_invalid_messages_are_dropped(handlers):
+    listener, _, client = handlers
+    listener._socket.listen()
+    for payload in (b"\xff\xfe", b"not json", b"[1, 2]", b'{"intention": 1}'):
+        with socket.create_connection(("127.0.0.1", listener.port)) as sock:
+            sock.sendall(payload)
+        assert listener.listen() == (None, None)
+    client.send({"intention": str(Intention.HEARTBEAT)}, ("127.0.0.1", listener.port))
+    data, _ = listener.listen()
+    assert data == {"intention": str(Intention.HEARTBEAT)}